@@ -0,0 +1,101 @@
+import time
+import argparse
+
+from utils.db import connect, execute_cmd, add_db_args, get_password
+from utils.queries import execute_query
+
+
+def parse_args():
+    description = """Benchmark prepared against unprepared execution of the hot statements"""
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-n',
+                        '--niter',
+                        type=int,
+                        default=10000,
+                        help='Number of times each statement is executed')
+    parser.add_argument('--sim_id',
+                        type=int,
+                        default=None,
+                        help='sim_id used as parameter, by default the latest simulation')
+
+    # Database specific arguments
+    add_db_args(parser)
+
+    return parser.parse_args()
+
+
+# Statements formatted the way they were sent before utils.queries existed
+TEXT_QUERIES = {'sim_stat_id': 'SELECT stat_id FROM sim WHERE id={sim_id}',
+                'param_args': 'SELECT args FROM param WHERE sim_id={sim_id}',
+                'fout_files': 'SELECT files FROM fout WHERE sim_id={sim_id}'}
+
+
+def server_time(conn):
+    """
+    Get the total planning and execution time (ms) spent by the server, requires the pg_stat_statements extension
+    Returns None if the extension is not available
+    :param conn:
+    :return:
+    """
+    try:
+        cmd = 'SELECT sum(total_plan_time), sum(total_exec_time) FROM pg_stat_statements ' \
+              'WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database());'
+        return execute_cmd(conn, cmd, fetch=True)[0]
+    except RuntimeError:
+        conn.rollback()
+        return
+
+
+def bench(conn, name, sim_id, niter, mode):
+    """
+    Execute a statement niter times
+    :param conn:
+    :param name: Name of the statement
+    :param sim_id:
+    :param niter:
+    :param mode: text (values formatted into the query), bound (client side binding) or prepared
+    :return: Client side wall time (s), server side planning time (ms), server side execution time (ms)
+    """
+    prepared = set()
+    before = server_time(conn)
+    t = time.perf_counter()
+    for _ in range(niter):
+        if mode == 'text':
+            execute_cmd(conn, TEXT_QUERIES[name].format(sim_id=sim_id), fetch=True)
+        elif mode == 'bound':
+            execute_query(conn, name, (sim_id, ), fetch=True)
+        else:
+            execute_query(conn, name, (sim_id, ), fetch=True, prepared=prepared)
+    wall = time.perf_counter() - t
+    after = server_time(conn)
+    if mode == 'prepared':
+        execute_cmd(conn, f'DEALLOCATE {name};', fetch=False)
+    if before is None or after is None:
+        return wall, None, None
+    return wall, (after[0] or 0) - (before[0] or 0), (after[1] or 0) - (before[1] or 0)
+
+
+def main(args):
+    conn = connect(args.dbname, args.user, get_password(args), args.host, args.port)
+    conn.autocommit = True
+    try:
+        sim_id = args.sim_id
+        if sim_id is None:
+            sim_id = execute_cmd(conn, 'SELECT max(id) FROM sim;', fetch=True)[0][0]
+
+        print(f'{"statement":<14}{"mode":<10}{"client us/query":>18}{"server plan us/query":>22}'
+              f'{"server exec us/query":>22}')
+        for name in TEXT_QUERIES.keys():
+            for mode in ('text', 'bound', 'prepared'):
+                wall, plan, execute = bench(conn, name, sim_id, args.niter, mode)
+                plan = 'n/a' if plan is None else f'{1000 * plan / args.niter:.1f}'
+                execute = 'n/a' if execute is None else f'{1000 * execute / args.niter:.1f}'
+                print(f'{name:<14}{mode:<10}{1e6 * wall / args.niter:>18.1f}{plan:>22}{execute:>22}')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -117,21 +117,29 @@ def populate_db(conn):
           ' (3, \'complete\', \'simulation completed\'),' \
           ' (4, \'depend\', \'Simulation depends on another simulation\'),' \
           ' (5, \'depend_failed\', \'Dependency failed\'),' \
-          ' (6, \'updating\', \'Simulation parameters are being updated\');'
+          ' (6, \'updating\', \'Simulation parameters are being updated\'),' \
+          ' (7, \'verifying\', \'Simulation finished, output files are being checked\');'
 
     execute_cmd(conn, cmd, fetch=False, commit=True)
 
     # Create worker table
 
     # This table registers all database workers, whether they are active, their (public) key and weight
-    # Currently this table is not used but included to facilitate future updates
+    # Every gmxdb daemon registers on startup and renews its lease with a heartbeat
+    # The sims owned by a daemon (sim.worker_id) can be claimed by other daemons once its lease expired
+    # Unowned sims are shared between daemons in proportion to weight times free capacity (published with the heartbeat)
 
     cmd = 'CREATE TABLE worker (id INT UNIQUE GENERATED ALWAYS AS IDENTITY,' \
-          ' host VARCHAR(40),' \
+          ' host VARCHAR(255),' \
           ' port SMALLINT,' \
+          ' pid INT,' \
           ' active BOOLEAN,' \
           ' key BYTEA,' \
-          ' weight SMALLINT );'
+          ' weight SMALLINT,' \
+          ' free INT,' \
+          ' grp VARCHAR(40) NOT NULL DEFAULT \'default\',' \
+          ' heartbeat TIMESTAMPTZ,' \
+          ' lease_until TIMESTAMPTZ );'
 
     execute_cmd(conn, cmd, fetch=False, commit=True)
 
@@ -139,11 +147,18 @@ def populate_db(conn):
 
     # The sim contains all unique simulations.
     # simulations are assigned a status from the sim_status_lookup table
-    # A simulation can depend on another simulation specified in the "depend" columns
+    # A simulation can depend on other simulations (see sim_edge), parent_id is the first of them
+    # Submitted, running and depend simulations are owned by the daemon (worker_id) handling them
+    # Simulations are only handled by daemons of the same group (grp), i.e. hosts sharing a filesystem
+    # Stages that exceeded their walltime are resubmitted from their last checkpoint, resubmits counts how often
 
     cmd = 'CREATE TABLE sim (id INT UNIQUE GENERATED ALWAYS AS IDENTITY,' \
           ' stat_id SMALLINT NOT NULL,' \
           ' parent_id INT,' \
+          ' created TIMESTAMPTZ NOT NULL DEFAULT now(),' \
+          ' worker_id INT,' \
+          ' grp VARCHAR(40) NOT NULL DEFAULT \'default\',' \
+          ' resubmits SMALLINT NOT NULL DEFAULT 0,' \
           'CONSTRAINT status_id_constrain ' \
           'FOREIGN KEY (stat_id) ' \
           'REFERENCES sim_status_lookup (id) ' \
@@ -151,51 +166,349 @@ def populate_db(conn):
 
     execute_cmd(conn, cmd, fetch=False, commit=True)
 
+    # Create sim_edge table
+
+    # The sim_edge table holds the dependencies of simulations, a simulation waits until all its parents completed
+    # pos is the position of the parent in the dependency list of the child, files of parent <pos> are inherited
+    # with %<pos>:<file_type>
+
+    cmd = 'CREATE TABLE sim_edge (child_id INT NOT NULL, ' \
+          'parent_id INT NOT NULL, ' \
+          'pos SMALLINT NOT NULL, ' \
+          'PRIMARY KEY (child_id, pos), ' \
+          'CONSTRAINT child FOREIGN KEY(child_id) REFERENCES sim(id) ON DELETE CASCADE, ' \
+          'CONSTRAINT parent FOREIGN KEY(parent_id) REFERENCES sim(id) ON DELETE CASCADE);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    cmd = 'CREATE INDEX sim_edge_parent_id_idx ON sim_edge (parent_id);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
     # Create param table
 
     # The param table contains the simulation parameters in json format and the primary gmx command (e.g. grompp)
     # The table is a child of sim and all parameters are associated with a specific simulation
+    # The executor is either local (run on a daemon host), cluster or NULL (decided by the daemon)
     # TODO Right now a simulation can have multiple param entries, is this something we want?
     cmd = 'CREATE TABLE param (id INT UNIQUE GENERATED ALWAYS AS IDENTITY, ' \
           'sim_id INT, ' \
           'path VARCHAR, ' \
           'cmd VARCHAR(16) NOT NULL, ' \
           'args JSONB NOT NULL, ' \
+          'executor VARCHAR(16), ' \
           'CONSTRAINT sim ' \
           'FOREIGN KEY(sim_id) ' \
           'REFERENCES sim(id) ' \
           'ON DELETE CASCADE);'
     execute_cmd(conn, cmd, fetch=False, commit=True)
 
-    # Create fout table
+    # Create outfile table
 
-    # The fout table keep track of output files
-    # Output files are stored in json format {"file_type": "/path/to/file"}
+    # The outfile table keeps track of output files, one row per simulation, file type and path
+    # File types with a list of files (e.g. JSCRIPTS) have one row per element, idx is the position in the list.
+    # A single file has idx -1
     # If a filetype is not recognized it is stored as unkn_<i> where <i> is a simple numeric index
-    # TODO Right now a simulation can have multiple fout entries, is this something we want?
+    # Inherited files are stored as %<file_type> until they are resolved from the parent
 
-    cmd = 'CREATE TABLE fout (id INT UNIQUE GENERATED ALWAYS AS IDENTITY, ' \
-          'sim_id INT, ' \
-          'files JSONB, ' \
+    cmd = 'CREATE TABLE outfile (sim_id INT NOT NULL, ' \
+          'ftype VARCHAR(32) NOT NULL, ' \
+          'idx SMALLINT NOT NULL DEFAULT -1, ' \
+          'path VARCHAR NOT NULL, ' \
+          'PRIMARY KEY (sim_id, ftype, idx), ' \
           'CONSTRAINT sim ' \
           'FOREIGN KEY(sim_id) ' \
           'REFERENCES sim(id) ' \
           'ON DELETE CASCADE);'
     execute_cmd(conn, cmd, fetch=False, commit=True)
 
+    # The fout view presents the output files of a simulation in json format {"file_type": "/path/to/file"}
+
+    cmd = 'CREATE VIEW fout AS SELECT sim_id, jsonb_object_agg(ftype, files) AS files FROM ' \
+          '(SELECT sim_id, ftype, CASE WHEN MIN(idx) < 0 THEN to_jsonb(MIN(path)) ' \
+          'ELSE jsonb_agg(path ORDER BY idx) END AS files FROM outfile GROUP BY sim_id, ftype) o ' \
+          'GROUP BY sim_id;'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
     # Create slurm table
 
     # The queue_info table contains the job_id of a simulation running on a queuing system
+    # Jobs run directly on a daemon host (executor: local) use the pid as job_id, and can only be monitored from that host
+    # Stages packed into a job array share the job_id and are identified by their task_id (-1 if not an array task)
 
     cmd = 'CREATE TABLE job_info (id INT UNIQUE GENERATED ALWAYS AS IDENTITY, ' \
           'sim_id INT, ' \
-          'job_id INT UNIQUE, ' \
+          'job_id INT, ' \
+          'task_id INT NOT NULL DEFAULT -1, ' \
+          'executor VARCHAR(16) NOT NULL DEFAULT \'cluster\', ' \
+          'host VARCHAR(255) NOT NULL DEFAULT \'\', ' \
+          'UNIQUE (job_id, task_id, executor, host), ' \
+          'CONSTRAINT sim ' \
+          'FOREIGN KEY(sim_id) ' \
+          'REFERENCES sim(id) ' \
+          'ON DELETE CASCADE);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create job_state table
+
+    # The job_state table caches the scheduler state of a job, shared between all daemons
+    # last_polled is the time the scheduler was last queried for the job
+    # started is the first time the job was found running (up to the polling interval), used for gmxdb stats
+
+    # Array tasks are stored as <job_id>_<task_id>
+
+    cmd = 'CREATE TABLE job_state (job_id VARCHAR(32) UNIQUE, ' \
+          'state VARCHAR(32), ' \
+          'last_polled TIMESTAMPTZ NOT NULL, ' \
+          'started TIMESTAMPTZ);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create sched_budget table
+
+    # Token buckets limiting the number of scheduler queries across all daemons
+    # exhausted counts how often a caller gave up waiting for a token and fell back to a cached state
+
+    cmd = 'CREATE TABLE sched_budget (name VARCHAR(40) UNIQUE, ' \
+          'rate REAL NOT NULL, ' \
+          'capacity REAL NOT NULL, ' \
+          'tokens REAL NOT NULL, ' \
+          'updated TIMESTAMPTZ NOT NULL, ' \
+          'exhausted BIGINT NOT NULL DEFAULT 0);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create indexes
+
+    # Simulations are searched by status, command, argument values, base directory and output files (gmxdb query)
+    # Arguments are matched with the containment (@>) operator on a GIN index, output files by path
+    # The base directory is matched by prefix, which requires varchar_pattern_ops
+    # Daemons only scan the simulations of their group
+
+    cmd = 'CREATE INDEX sim_stat_id_idx ON sim (stat_id); ' \
+          'CREATE INDEX sim_grp_stat_id_idx ON sim (grp, stat_id); ' \
+          'CREATE INDEX param_sim_id_idx ON param (sim_id); ' \
+          'CREATE INDEX param_cmd_idx ON param (cmd); ' \
+          'CREATE INDEX param_path_idx ON param (path varchar_pattern_ops); ' \
+          'CREATE INDEX param_args_idx ON param USING GIN (args); ' \
+          'CREATE INDEX outfile_path_idx ON outfile (path); ' \
+          'CREATE INDEX job_info_sim_id_idx ON job_info (sim_id);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # The oldest waiting (submitted or depend) simulation is the first entry of a partial index (gmxdb status)
+
+    cmd = 'CREATE INDEX sim_waiting_idx ON sim (id) WHERE stat_id IN (1, 4);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Jobscripts and logs are removed once a simulation completed (see Cleanup)
+
+    cmd = 'CREATE INDEX outfile_auxfiles_idx ON outfile (sim_id) WHERE ftype IN (\'JSCRIPTS\', \'JLOGS\');'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Every daemon lists the sims it owns once per loop
+
+    cmd = 'CREATE INDEX sim_worker_id_idx ON sim (worker_id) WHERE stat_id IN (1, 2, 4, 6);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create sim_counts table
+
+    # The sim_counts table counts simulations per status, command and base directory (gmxdb status)
+    # It is maintained by triggers on sim and param, so the summary never has to scan the sim table
+    # A simulation is counted once its parameters are inserted
+
+    cmd = 'CREATE TABLE sim_counts (stat_id SMALLINT NOT NULL, ' \
+          'cmd VARCHAR(16) NOT NULL, ' \
+          'path VARCHAR NOT NULL, ' \
+          'n BIGINT NOT NULL DEFAULT 0, ' \
+          'PRIMARY KEY (stat_id, cmd, path));'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Counters are updated once per statement from the transition tables, i.e. a bulk status update of many
+    # simulations results in one increment per counter. Rows are upserted in key order to avoid deadlocks
+    # Deleting a sim is counted before the delete, when its param rows still exist. The cascading delete of the
+    # param rows is then ignored since the sim does not exist anymore
+
+    cmd = 'CREATE FUNCTION sim_counts_add(delta BIGINT, stat SMALLINT, gmx_cmd VARCHAR, base VARCHAR) ' \
+          'RETURNS VOID AS $$ ' \
+          'INSERT INTO sim_counts AS c (stat_id, cmd, path, n) VALUES (stat, gmx_cmd, COALESCE(base, \'\'), delta) ' \
+          'ON CONFLICT (stat_id, cmd, path) DO UPDATE SET n = c.n + EXCLUDED.n; ' \
+          '$$ LANGUAGE sql; ' \
+          'CREATE FUNCTION sim_counts_sim_update() RETURNS trigger AS $$ ' \
+          'BEGIN ' \
+          'PERFORM sim_counts_add(d.n, d.stat_id, d.cmd, d.path) FROM (' \
+          'SELECT t.stat_id, t.cmd, t.path, SUM(t.d) AS n FROM (' \
+          'SELECT new_sim.stat_id, param.cmd, param.path, 1 AS d FROM new_sim ' \
+          'JOIN old_sim ON old_sim.id = new_sim.id JOIN param ON param.sim_id = new_sim.id ' \
+          'WHERE new_sim.stat_id IS DISTINCT FROM old_sim.stat_id ' \
+          'UNION ALL ' \
+          'SELECT old_sim.stat_id, param.cmd, param.path, -1 AS d FROM new_sim ' \
+          'JOIN old_sim ON old_sim.id = new_sim.id JOIN param ON param.sim_id = new_sim.id ' \
+          'WHERE new_sim.stat_id IS DISTINCT FROM old_sim.stat_id) t ' \
+          'GROUP BY t.stat_id, t.cmd, t.path ORDER BY t.stat_id, t.cmd, t.path) d; ' \
+          'RETURN NULL; ' \
+          'END; $$ LANGUAGE plpgsql; ' \
+          'CREATE FUNCTION sim_counts_sim_delete() RETURNS trigger AS $$ ' \
+          'BEGIN ' \
+          'PERFORM sim_counts_add(-1, OLD.stat_id, param.cmd, param.path) FROM param WHERE param.sim_id = OLD.id; ' \
+          'RETURN OLD; ' \
+          'END; $$ LANGUAGE plpgsql; ' \
+          'CREATE FUNCTION sim_counts_param_insert() RETURNS trigger AS $$ ' \
+          'BEGIN ' \
+          'PERFORM sim_counts_add(d.n, d.stat_id, d.cmd, d.path) FROM (' \
+          'SELECT sim.stat_id, new_param.cmd, new_param.path, COUNT(*) AS n FROM new_param ' \
+          'JOIN sim ON sim.id = new_param.sim_id ' \
+          'GROUP BY sim.stat_id, new_param.cmd, new_param.path ' \
+          'ORDER BY sim.stat_id, new_param.cmd, new_param.path) d; ' \
+          'RETURN NULL; ' \
+          'END; $$ LANGUAGE plpgsql; ' \
+          'CREATE FUNCTION sim_counts_param_delete() RETURNS trigger AS $$ ' \
+          'BEGIN ' \
+          'PERFORM sim_counts_add(-d.n, d.stat_id, d.cmd, d.path) FROM (' \
+          'SELECT sim.stat_id, old_param.cmd, old_param.path, COUNT(*) AS n FROM old_param ' \
+          'JOIN sim ON sim.id = old_param.sim_id ' \
+          'GROUP BY sim.stat_id, old_param.cmd, old_param.path ' \
+          'ORDER BY sim.stat_id, old_param.cmd, old_param.path) d; ' \
+          'RETURN NULL; ' \
+          'END; $$ LANGUAGE plpgsql;'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    cmd = 'CREATE TRIGGER sim_counts_sim_update AFTER UPDATE ON sim ' \
+          'REFERENCING OLD TABLE AS old_sim NEW TABLE AS new_sim ' \
+          'FOR EACH STATEMENT EXECUTE FUNCTION sim_counts_sim_update(); ' \
+          'CREATE TRIGGER sim_counts_sim_delete BEFORE DELETE ON sim ' \
+          'FOR EACH ROW EXECUTE FUNCTION sim_counts_sim_delete(); ' \
+          'CREATE TRIGGER sim_counts_param_insert AFTER INSERT ON param ' \
+          'REFERENCING NEW TABLE AS new_param ' \
+          'FOR EACH STATEMENT EXECUTE FUNCTION sim_counts_param_insert(); ' \
+          'CREATE TRIGGER sim_counts_param_delete AFTER DELETE ON param ' \
+          'REFERENCING OLD TABLE AS old_param ' \
+          'FOR EACH STATEMENT EXECUTE FUNCTION sim_counts_param_delete();'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create walltime table
+
+    # The walltime table records the walltime requested (and predicted) for g_submit stages and their runtime (hours)
+    # Stages with the same signature (see utils.predict) are used to predict the walltime of new stages
+
+    cmd = 'CREATE TABLE walltime (sim_id INT UNIQUE, ' \
+          'signature VARCHAR(40) NOT NULL, ' \
+          'requested REAL, ' \
+          'predicted REAL, ' \
+          'runtime REAL, ' \
+          'CONSTRAINT sim ' \
+          'FOREIGN KEY(sim_id) ' \
+          'REFERENCES sim(id) ' \
+          'ON DELETE CASCADE);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    cmd = 'CREATE INDEX walltime_signature_idx ON walltime (signature, sim_id DESC) WHERE runtime IS NOT NULL;'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create grompp_cache table
+
+    # The grompp_cache table maps the key of a grompp stage (a hash of its arguments and input files, see utils.memo)
+    # to the output files of the stage that produced them, with their size and modification time
+    # Stages with a known key copy the files instead of running grompp, the least recently used entries are evicted
+
+    cmd = 'CREATE TABLE grompp_cache (key VARCHAR(64) PRIMARY KEY, ' \
+          'sim_id INT, ' \
+          'files JSONB NOT NULL, ' \
+          'created TIMESTAMPTZ NOT NULL, ' \
+          'last_used TIMESTAMPTZ NOT NULL, ' \
           'CONSTRAINT sim ' \
           'FOREIGN KEY(sim_id) ' \
           'REFERENCES sim(id) ' \
           'ON DELETE CASCADE);'
     execute_cmd(conn, cmd, fetch=False, commit=True)
 
+    cmd = 'CREATE INDEX grompp_cache_last_used_idx ON grompp_cache (last_used);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create sim_transition table
+
+    # The sim_transition table is an append-only history of all status changes (gmxdb stats)
+    # old_stat is NULL for the registration of a simulation, worker_id is the daemon owning the simulation
+    # Transitions are only ever appended, so a BRIN index on the timestamp is sufficient to select a time window
+
+    cmd = 'CREATE TABLE sim_transition (id BIGINT UNIQUE GENERATED ALWAYS AS IDENTITY, ' \
+          'sim_id INT NOT NULL, ' \
+          'old_stat SMALLINT, ' \
+          'new_stat SMALLINT NOT NULL, ' \
+          't TIMESTAMPTZ NOT NULL DEFAULT now(), ' \
+          'worker_id INT);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    cmd = 'CREATE INDEX sim_transition_t_idx ON sim_transition USING BRIN (t); ' \
+          'CREATE INDEX sim_transition_sim_id_idx ON sim_transition (sim_id);'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    cmd = 'CREATE FUNCTION sim_transition_insert() RETURNS trigger AS $$ ' \
+          'BEGIN ' \
+          'INSERT INTO sim_transition(sim_id, old_stat, new_stat, worker_id) ' \
+          'SELECT new_sim.id, NULL, new_sim.stat_id, new_sim.worker_id FROM new_sim ORDER BY new_sim.id; ' \
+          'RETURN NULL; ' \
+          'END; $$ LANGUAGE plpgsql; ' \
+          'CREATE FUNCTION sim_transition_update() RETURNS trigger AS $$ ' \
+          'BEGIN ' \
+          'INSERT INTO sim_transition(sim_id, old_stat, new_stat, worker_id) ' \
+          'SELECT new_sim.id, old_sim.stat_id, new_sim.stat_id, new_sim.worker_id FROM new_sim ' \
+          'JOIN old_sim ON old_sim.id = new_sim.id WHERE new_sim.stat_id IS DISTINCT FROM old_sim.stat_id ' \
+          'ORDER BY new_sim.id; ' \
+          'RETURN NULL; ' \
+          'END; $$ LANGUAGE plpgsql;'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    cmd = 'CREATE TRIGGER sim_transition_insert AFTER INSERT ON sim ' \
+          'REFERENCING NEW TABLE AS new_sim ' \
+          'FOR EACH STATEMENT EXECUTE FUNCTION sim_transition_insert(); ' \
+          'CREATE TRIGGER sim_transition_update AFTER UPDATE ON sim ' \
+          'REFERENCING OLD TABLE AS old_sim NEW TABLE AS new_sim ' \
+          'FOR EACH STATEMENT EXECUTE FUNCTION sim_transition_update();'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
+    # Create sweep functions
+
+    # expand_sweep registers every instance (replica and point of a parameter grid) of a pipeline of stages in one
+    # statement (db_submit.py with a template config). {<name>} in a stage is replaced by the value of the variable
+    # <name> of the instance (sweep_format). Sim ids are allocated up front, so the parents of a stage are known
+    # without reading back the inserted rows: negative dependencies refer to stages of the same instance,
+    # positive dependencies are sim ids. The sim ids are returned ordered by instance and stage
+
+    cmd = 'CREATE FUNCTION sweep_format(template TEXT, vars JSONB) RETURNS TEXT AS $$ ' \
+          'DECLARE ' \
+          'v RECORD; ' \
+          'BEGIN ' \
+          'FOR v IN SELECT key, to_jsonb(value)::text AS quoted FROM jsonb_each_text(vars) LOOP ' \
+          'template := replace(template, \'{\' || v.key || \'}\', substr(v.quoted, 2, length(v.quoted) - 2)); ' \
+          'END LOOP; ' \
+          'RETURN template; ' \
+          'END; $$ LANGUAGE plpgsql IMMUTABLE; ' \
+          'CREATE FUNCTION expand_sweep(stages JSONB, instances JSONB, grp VARCHAR) RETURNS SETOF INT AS $$ ' \
+          'DECLARE ' \
+          'n INT := jsonb_array_length(stages); ' \
+          'ids INT[]; ' \
+          'BEGIN ' \
+          'ids := ARRAY(SELECT nextval(pg_get_serial_sequence(\'sim\', \'id\'))::int ' \
+          'FROM generate_series(1, n * jsonb_array_length(instances))); ' \
+          'WITH s AS MATERIALIZED (SELECT ids[(i.r - 1) * n + st.s] AS id, i.r, st.s, ' \
+          'sweep_format(st.stage::text, i.vars)::jsonb AS stage ' \
+          'FROM jsonb_array_elements(instances) WITH ORDINALITY i(vars, r), ' \
+          'jsonb_array_elements(stages) WITH ORDINALITY st(stage, s)), ' \
+          'e AS MATERIALIZED (SELECT s.id AS child_id, CASE WHEN p.dep::int < 0 ' \
+          'THEN ids[(s.r - 1) * n + s.s + p.dep::int] ELSE p.dep::int END AS parent_id, p.pos - 1 AS pos ' \
+          'FROM s, jsonb_array_elements(COALESCE(s.stage->\'dependency\', \'[]\')) WITH ORDINALITY p(dep, pos)), ' \
+          'new_sim AS (INSERT INTO sim(id, stat_id, parent_id, grp) OVERRIDING SYSTEM VALUE ' \
+          'SELECT s.id, CASE WHEN e.parent_id IS NULL THEN 1 ELSE 4 END, e.parent_id, ' \
+          'COALESCE(s.stage->>\'group\', grp) FROM s LEFT JOIN e ON e.child_id = s.id AND e.pos = 0), ' \
+          'new_edge AS (INSERT INTO sim_edge(child_id, parent_id, pos) SELECT child_id, parent_id, pos FROM e), ' \
+          'new_param AS (INSERT INTO param(sim_id, path, cmd, args, executor) ' \
+          'SELECT s.id, s.stage->>\'base\', s.stage->>\'cmd\', s.stage->\'args\', s.stage->>\'executor\' FROM s) ' \
+          'INSERT INTO outfile(sim_id, ftype, idx, path) ' \
+          'SELECT s.id, f.key, a.idx, a.path FROM s, jsonb_each(COALESCE(s.stage->\'fout\', \'{}\')) f, LATERAL ' \
+          '(SELECT -1 AS idx, f.value #>> \'{}\' AS path WHERE jsonb_typeof(f.value) <> \'array\' ' \
+          'UNION ALL SELECT l.ord - 1, l.path FROM jsonb_array_elements_text(CASE jsonb_typeof(f.value) ' \
+          'WHEN \'array\' THEN f.value ELSE \'[]\' END) WITH ORDINALITY l(path, ord)) a ' \
+          'WHERE a.path IS NOT NULL; ' \
+          'RETURN QUERY SELECT unnest(ids); ' \
+          'END; $$ LANGUAGE plpgsql;'
+    execute_cmd(conn, cmd, fetch=False, commit=True)
+
     return
 
 
@@ -1,11 +1,15 @@
 import os
+import sys
 import json
 import atexit
 import getpass
 import argparse
 import time
+import itertools
+from collections import deque
 
-from utils.db import connect, close, execute_cmd
+from utils.db import connect, close
+from utils.queries import execute_query, json_param
 
 
 def parse_args():
@@ -14,7 +18,21 @@ def parse_args():
     parser.add_argument('--cfg',
                         type=str,
                         default=None,
-                        help='A configuration file with instructions for one or more simulation')
+                        help='A configuration file with instructions for one or more simulation, or a template with '
+                             'replicas and a parameter sweep of a list of stages')
+    parser.add_argument('--stdin',
+                        default=False,
+                        action='store_true',
+                        help='Read newline delimited json job specifications (one job per line, same keys as in a '
+                             'configuration file) from stdin. The sim_id of each job is printed once it is committed')
+    parser.add_argument('--batch',
+                        type=int,
+                        default=100,
+                        help='Number of jobs committed at once when reading from stdin')
+    parser.add_argument('--window',
+                        type=int,
+                        default=1000,
+                        help='How many jobs back a relative (negative) dependency can reach when reading from stdin')
     parser.add_argument('--cmd',
                         type=str,
                         default=None,
@@ -26,13 +44,25 @@ def parse_args():
                              'string')
     parser.add_argument('--dependency',
                         type=int,
-                        default=0,
-                        help='sim_id of another simulation. Will delay running the simulation until dependency is '
-                             'complete')
+                        nargs='*',
+                        default=None,
+                        help='sim_ids of other simulations. Will delay running the simulation until all dependencies '
+                             'are complete')
     parser.add_argument('--base',
                         type=str,
                         default=os.path.abspath('../'),
                         help='The simulation base directory. By default the current directory is used.')
+    parser.add_argument('--executor',
+                        type=str,
+                        default=None,
+                        choices=('local', 'cluster'),
+                        help='Run a g_submit stage directly on the daemon host (local) or on the cluster. '
+                             'By default the daemon decides based on the requested walltime and idle cores')
+    parser.add_argument('--group',
+                        type=str,
+                        default='default',
+                        help='Only daemons of this group run the simulations, used for every job in a config file or '
+                             'on stdin without a "group" key')
     parser.add_argument('--wait',
                         default=False,
                         action='store_true',
@@ -69,7 +99,8 @@ def parse_args():
     return parser.parse_args()
 
 
-def register(conn, gmx_cmd, gmx_args, fout=None, depend=0, base='./'):
+def register(conn, gmx_cmd, gmx_args, fout=None, depend=0, base='./', executor=None, group='default', prepared=None,
+             commit=True):
     """
     Register a simulation with the database
     :param conn:
@@ -77,66 +108,183 @@ def register(conn, gmx_cmd, gmx_args, fout=None, depend=0, base='./'):
     :param gmx_args:
     :param fout: User defined outfiles
     :type fout: dict
-    :param depend: id of depend simulation
+    :param depend: id of depend simulation, or a list of ids if the simulation depends on several simulations
     :param base: A path or environment variable
+    :param executor: local, cluster or None to let the daemon decide
+    :param group: Only daemons of this group run the simulation
+    :param prepared: Names of the statements prepared on conn (see utils.queries.execute_query)
+    :param commit: Commit the simulation, if False the caller has to commit
     :return:
     """
 
-    # Get base path
-    if base is None:
-        base = os.path.abspath('./')
-    elif base[0] == '$':
-        base = os.environ[base[1:]]
-
-    if not os.path.isabs(base):
-        base = os.path.abspath(base)
+    base = resolve_base(base)
 
     # Add an entry for the simulation, flag it as updating, so that no process accesses it.
-    # If simulation has a dependency: provide the parent_id
-    if depend:
-        cmd = f'INSERT INTO sim(stat_id, parent_id) VALUES(6, {depend}) RETURNING id;'
-        sim_id = execute_cmd(conn, cmd, commit=True, fetch=True)[0][0]
-    else:
-        cmd = 'INSERT INTO sim(stat_id) VALUES(6) RETURNING id;'
-        sim_id = execute_cmd(conn, cmd, commit=True, fetch=True)[0][0]
+    # If simulation has a dependency: provide the parent_id (the first parent) and an edge to every parent
+    parents = [pid for pid in (depend if isinstance(depend, (list, tuple)) else [depend]) if pid]
+    parent_id = parents[0] if parents else None
+    sim_id = execute_query(conn, 'sim_register', (parent_id, group), commit=commit, fetch=True,
+                           prepared=prepared)[0][0]
+    if parents:
+        execute_query(conn, 'sim_edge_insert', (sim_id, parents), commit=commit, fetch=False, prepared=prepared)
 
     # Populate params
-    #  FIXME Sometimes a horrible oneliner is not the best solutions (sometimes)
-    json_str = '{'+','.join([f'"{kw}": "{arg}"' if isinstance(arg, str) else f'"{kw}": {arg}' for kw, arg in gmx_args.items()])+ ' }'
-    cmd = f'INSERT INTO param(sim_id, path, cmd, args) VALUES({sim_id}, \'{base}\', \'{gmx_cmd}\', \'{json_str}\');'
-    execute_cmd(conn, cmd, commit=True, fetch=False)
+    execute_query(conn, 'param_insert', (sim_id, base, gmx_cmd, json_param(gmx_args), executor),
+                  commit=commit, fetch=False, prepared=prepared)
 
     # Add user defined outfiles
     if fout is not None:
-        cmd = f'INSERT INTO fout(sim_id, files) VALUES({sim_id}, \'{json.dumps(fout)}\');'
-        execute_cmd(conn, cmd, commit=True, fetch=False)
+        execute_query(conn, 'fout_insert', (sim_id, json_param(fout)), commit=commit, fetch=False, prepared=prepared)
 
     # Flag simulation as submitted/depend
-    if depend:
-        cmd = f'UPDATE sim SET stat_id = 4 WHERE id={sim_id};'
-        execute_cmd(conn, cmd, commit=True, fetch=False)
+    if parents:
+        execute_query(conn, 'sim_set_stat_id', (sim_id, 4), commit=commit, fetch=False, prepared=prepared)
     else:
-        cmd = f'UPDATE sim SET stat_id = 1 WHERE id={sim_id};'
-        execute_cmd(conn, cmd, commit=True, fetch=False)
+        execute_query(conn, 'sim_set_stat_id', (sim_id, 1), commit=commit, fetch=False, prepared=prepared)
     return sim_id
 
 
-def wait(sim_ids, conn, interval=2):
+def resolve_base(base):
+    """
+    Get the absolute base path of a job
+    :param base: A path, an environment variable or None for the current directory
+    :return:
+    """
+    if base is None:
+        base = os.path.abspath('./')
+    elif base[0] == '$':
+        base = os.environ[base[1:]]
+
+    if not os.path.isabs(base):
+        base = os.path.abspath(base)
+    return base
+
+
+def resolve_dependency(dependency, previous):
+    """
+    Resolve the dependency of a job to sim_ids
+    Negative integers refer to preceding jobs (-1 is the job immediately prior), positive integers are sim_ids
+    :param dependency: None, an integer or a list of integers
+    :param previous: The sim_ids of the preceding jobs
+    :return: A list of sim_ids, empty if the job has no dependency
+    """
+    if dependency is None:
+        return []
+    resolved = []
+    for dep in (dependency if isinstance(dependency, list) else [dependency]):
+        if dep < 0:
+            if -dep > len(previous):
+                raise IndexError(f'Dependency could not be met: {dep}')
+            dep = previous[dep]
+        resolved.append(dep)
+    return resolved
+
+
+def submit_stream(conn, stream, batch_size=100, window=1000, group='default', prepared=None):
+    """
+    Register newline delimited json job specifications read from a stream
+    All jobs are registered over one connection and committed in batches.
+    Only the sim_ids of the last <window> jobs are kept, so memory use does not depend on the number of jobs
+    and relative dependencies can reach at most <window> jobs back.
+    :param conn:
+    :param stream: An iterable of lines, e.g. sys.stdin
+    :param batch_size: Number of jobs committed at once
+    :param window: Number of sim_ids kept for relative dependencies
+    :param group: Group of all jobs without a "group" key
+    :param prepared: Names of the statements prepared on conn (see utils.queries.execute_query)
+    :return: The number of registered jobs
+    """
+    recent = deque(maxlen=window)
+    pending = []
+    njobs = 0
+    for lineno, line in enumerate(stream, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        stage = json.loads(line)
+        try:
+            dependency = resolve_dependency(stage.get('dependency'), recent)
+        except IndexError:
+            raise ValueError(f'Dependency for job on line {lineno} could not be met: {stage.get("dependency")}')
+        _id = register(conn, stage['cmd'], stage['args'], fout=stage.get('fout'), depend=dependency,
+                       base=stage.get('base'), executor=stage.get('executor'), group=stage.get('group', group),
+                       prepared=prepared, commit=False)
+        recent.append(_id)
+        pending.append(_id)
+        njobs += 1
+        if len(pending) >= batch_size:
+            conn.commit()
+            print('\n'.join(map(str, pending)), flush=True)
+            pending = []
+    conn.commit()
+    if len(pending):
+        print('\n'.join(map(str, pending)), flush=True)
+    return njobs
+
+
+def sweep_instances(replicas=1, sweep=None):
+    """
+    Get the variables of every instance of a template, all combinations of the replicas and the sweep values
+    :param replicas: Number of replicas, numbered from 1
+    :param sweep: A dictionary {name: [values]}
+    :return: A list of dictionaries {"replica": i, name: value, ...}
+    """
+    sweep = sweep if sweep is not None else {}
+    names = list(sweep.keys())
+    instances = []
+    for replica in range(1, replicas + 1):
+        for values in itertools.product(*[sweep[name] for name in names]):
+            instances.append(dict(zip(names, values), replica=replica))
+    return instances
+
+
+def submit_sweep(conn, template, group='default', prepared=None):
+    """
+    Register all instances of a template in a single statement (see expand_sweep in create_db.py)
+    Relative dependencies of a stage refer to stages of the same instance
+    :param conn:
+    :param template: A dictionary with "stages" (a list of jobs as in a config file) and optionally "replicas" and
+                     "sweep"
+    :param group: Group of all stages without a "group" key
+    :param prepared: Names of the statements prepared on conn (see utils.queries.execute_query)
+    :return: The sim_ids ordered by instance and stage
+    """
+    stages = []
+    for i, stage in enumerate(template['stages']):
+        dependency = stage.get('dependency')
+        dependency = [] if dependency is None else (dependency if isinstance(dependency, list) else [dependency])
+        dependency = [dep for dep in dependency if dep]
+        if any([i + dep < 0 for dep in dependency]):
+            raise ValueError(f'Dependency for stage {i} could not be met: {stage.get("dependency")}')
+        stage = {'cmd': stage['cmd'],
+                 'args': stage['args'],
+                 'base': resolve_base(stage.get('base')),
+                 'fout': stage.get('fout'),
+                 'executor': stage.get('executor'),
+                 'group': stage.get('group', group),
+                 'dependency': dependency}
+        # Missing keys are NULL in the database, a json null would not be
+        stages.append({key: value for key, value in stage.items() if value is not None})
+    instances = sweep_instances(template.get('replicas', 1), template.get('sweep'))
+    out = execute_query(conn, 'sweep_expand', (json_param(stages), json_param(instances), group), commit=True,
+                        fetch=True, prepared=prepared)
+    return [sim_id for sim_id, in out]
+
+
+def wait(sim_ids, conn, interval=2, prepared=None):
     """
     Wait till all simulation have either completed or failed
     :param sim_ids:
     :param conn:
     :param interval:
+    :param prepared: Names of the statements prepared on conn (see utils.queries.execute_query)
     :return:
     """
     running = [True, ]*len(sim_ids)
     while any(running):
         for i, sid in enumerate(sim_ids):
             if running[i]:
-                cmd = f'SELECT stat_id FROM sim WHERE id={sid};'
-                with conn.cursor() as cursor:
-                    cursor.execute(cmd)
-                    stat_id = cursor.fetchone()[0]
+                stat_id = execute_query(conn, 'sim_stat_id', (sid, ), commit=True, prepared=prepared)[0][0]
                 if stat_id in (0, 3, 5):  # Stat codes for failed, complete & depend_failed
                     running[i] = False
         time.sleep(interval)
@@ -153,37 +301,48 @@ def main(args):
         password = args.password
 
     # Load config, if applicable add commandline options last
+    # A config with a dictionary instead of a list of jobs is a template (see submit_sweep)
     cfg = []
+    template = None
     if args.cfg is not None:
         with open(args.cfg, 'rb') as fh:
             cfg = json.load(fh)
+        if isinstance(cfg, dict):
+            template, cfg = cfg, []
 
     if all([args.cmd is not None, args.args is not None]):
         cfg.append({'cmd': args.cmd,
                     'args': args.args,
                     'base': args.base,
-                    'dependency': args.dependency
+                    'dependency': args.dependency,
+                    'executor': args.executor
                     })
 
     # Connect to database
     conn = connect(args.dbname, args.user, password, args.host, args.port)
     atexit.register(close, conn)
 
+    # All statements are prepared once on this connection
+    prepared = set()
+    if args.stdin:
+        submit_stream(conn, sys.stdin, batch_size=args.batch, window=args.window, group=args.group,
+                      prepared=prepared)
+        return
+
     sim_ids = []
+    if template is not None:
+        sim_ids = submit_sweep(conn, template, group=args.group, prepared=prepared)
     for i, stage in enumerate(cfg):
-        dependency = stage.get('dependency')
-        if dependency is not None and dependency < 0:
-            try:
-                dependency = sim_ids[dependency]
-            except ValueError:
-                print(f'Dependency for stage {i} could not be met: {dependency}')
-        elif dependency is None:
-            dependency = 0
+        try:
+            dependency = resolve_dependency(stage.get('dependency'), sim_ids)
+        except IndexError:
+            raise ValueError(f'Dependency for stage {i} could not be met: {stage.get("dependency")}')
         _id = register(conn, stage['cmd'], stage['args'], fout=stage.get('fout'), depend=dependency,
-                       base=stage.get('base'))
+                       base=stage.get('base'), executor=stage.get('executor'), group=stage.get('group', args.group),
+                       prepared=prepared)
         sim_ids.append(_id)
     if args.wait:
-        wait(sim_ids, conn)
+        wait(sim_ids, conn, prepared=prepared)
         for sid in sim_ids:
             print(sid)
 
@@ -191,7 +350,9 @@ def main(args):
 if __name__ == '__main__':
     args = parse_args()
 
-    if args.cfg is None and any([args.cmd is None, args.args is None]):
-        raise ValueError('Must provide either a config file or a set of commandline instructions')
+    if not args.stdin and args.cfg is None and any([args.cmd is None, args.args is None]):
+        raise ValueError('Must provide either a config file, a set of commandline instructions or --stdin')
+    if args.stdin and args.wait:
+        raise ValueError('--wait can not be combined with --stdin')
 
     main(args)
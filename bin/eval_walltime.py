@@ -0,0 +1,122 @@
+import math
+import argparse
+import statistics
+
+from utils.db import connect, execute_cmd, add_db_args, get_password
+from utils.predict import predict_hours, walltime_args
+from utils.gmx import gsubmit_walltime
+
+
+def parse_args():
+    description = """Evaluate walltime prediction (gmxdb --predict_walltime) on the recorded g_submit stages"""
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--quantile',
+                        type=float,
+                        default=0.95,
+                        help='Quantile of the runtimes of similar stages used for a prediction')
+    parser.add_argument('--margin',
+                        type=float,
+                        default=1.2,
+                        help='Safety factor applied to the predicted walltime')
+    parser.add_argument('--samples',
+                        type=int,
+                        default=50,
+                        help='Maximum number of recent similar stages used for a prediction')
+    parser.add_argument('--min_samples',
+                        type=int,
+                        default=5,
+                        help='Minimum number of similar stages required for a prediction')
+
+    # Database specific arguments
+    add_db_args(parser)
+
+    return parser.parse_args()
+
+
+# All stages with a recorded runtime in order of submission, with the walltime they requested and their queue time
+HISTORY = 'SELECT w.signature, COALESCE(w.predicted, w.requested), w.requested, w.runtime, ' \
+          'EXTRACT(EPOCH FROM started.t - submitted.t) / 3600 FROM walltime w ' \
+          'LEFT JOIN LATERAL (SELECT MAX(t) AS t FROM sim_transition ' \
+          'WHERE sim_id = w.sim_id AND new_stat = 2) submitted ON true ' \
+          'LEFT JOIN LATERAL (SELECT MIN(job_state.started) AS t FROM job_info JOIN job_state ' \
+          'ON job_state.job_id = CASE WHEN job_info.task_id < 0 THEN job_info.job_id::text ' \
+          'ELSE job_info.job_id || \'_\' || job_info.task_id END WHERE job_info.sim_id = w.sim_id) started ON true ' \
+          'WHERE w.runtime IS NOT NULL ORDER BY w.sim_id;'
+
+
+def queue_model(rows):
+    """
+    Median queue time (hours) per requested walltime, rounded up to full hours
+    :param rows:
+    :return:
+    """
+    queue_times = {}
+    for _, submitted, _, _, queue_time in rows:
+        if submitted and queue_time is not None:
+            queue_times.setdefault(math.ceil(submitted), []).append(queue_time)
+    return {hours: statistics.median(times) for hours, times in queue_times.items()}
+
+
+def expected_queue_time(model, hours):
+    """
+    Median queue time of the closest requested walltime with recorded queue times
+    :param model: See queue_model
+    :param hours:
+    :return:
+    """
+    if len(model) == 0:
+        return
+    return model[min(model.keys(), key=lambda h: abs(h - math.ceil(hours)))]
+
+
+def main(args):
+    conn = connect(args.dbname, args.user, get_password(args), args.host, args.port)
+    try:
+        rows = execute_cmd(conn, HISTORY, fetch=True, commit=True)
+    finally:
+        conn.close()
+
+    model = queue_model(rows)
+    history = {}
+    errors, reductions, savings = [], [], []
+    npredicted, ntimeout = 0, 0
+    for signature, _, requested, runtime, _ in rows:
+        runtimes = history.setdefault(signature, [])
+        hours = predict_hours(runtimes[-args.samples:], quantile=args.quantile, margin=args.margin,
+                              min_samples=args.min_samples)
+        runtimes.append(runtime)
+        if hours is None:
+            continue
+        npredicted += 1
+        errors.append(hours - runtime)
+        # gmxdb only shortens explicit walltime requests
+        if not requested or hours >= requested:
+            continue
+        predicted = gsubmit_walltime(walltime_args({}, hours))
+        reductions.append(requested - predicted)
+        if runtime > predicted:
+            ntimeout += 1
+        before, after = expected_queue_time(model, requested), expected_queue_time(model, predicted)
+        if before is not None and after is not None:
+            savings.append(before - after)
+
+    print(f'stages with a recorded runtime:        {len(rows)}')
+    print(f'stages with a prediction:              {npredicted}')
+    if npredicted:
+        print(f'median error (predicted - runtime):    {statistics.median(errors):.2f} h')
+        print(f'median absolute error:                 {statistics.median([abs(e) for e in errors]):.2f} h')
+    print(f'stages with a shorter walltime:        {len(reductions)}')
+    if len(reductions):
+        print(f'stages exceeding the shorter walltime: {ntimeout} ({100 * ntimeout / len(reductions):.1f}%)')
+        print(f'mean walltime reduction:               {statistics.mean(reductions):.2f} h')
+    if len(savings):
+        print(f'estimated queue time saved:            {sum(savings):.1f} h '
+              f'({statistics.mean(savings):.2f} h per stage)')
+    else:
+        print('estimated queue time saved:            n/a (no queue times recorded)')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
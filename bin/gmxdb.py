@@ -1,13 +1,19 @@
 import os
-import getpass
+import sys
+import json
 import argparse
 import logging
 import time
 import signal
-from logging.handlers import QueueListener
+from logging.handlers import QueueListener, RotatingFileHandler
 from multiprocessing import Queue, Event
 
 from db_worker import DatabaseWorkerMain
+from utils.db import connect, close, add_db_args, get_password
+from utils.search import find_sims
+from utils.report import status_summary, transition_stats, runtime_stats, PERCENTILES
+from utils.log import JsonFormatter, set_rate_limit
+
 
 def parse_args():
     description = """Run database daemon"""
@@ -24,37 +30,133 @@ def parse_args():
                         action='store_true',
                         help='If true, remove jobscripts and logs when jobs finish, this is recommended when running '
                              'many of simulations')
+    parser.add_argument('--state_age',
+                        type=int,
+                        default=30,
+                        help='Time in seconds a scheduler state cached in the database is considered fresh. '
+                             'Other daemons will not query the scheduler for a job while its state is fresh')
+    parser.add_argument('--query_rate',
+                        type=float,
+                        default=5.,
+                        help='Scheduler queries per second allowed across all daemons')
+    parser.add_argument('--query_burst',
+                        type=int,
+                        default=50,
+                        help='Maximum number of scheduler queries in a burst')
+    parser.add_argument('--local_walltime',
+                        type=float,
+                        default=0.,
+                        help='Run g_submit stages requesting at most this walltime (hours) directly on this host '
+                             'if enough cores are idle. Stages without -days/-hours are always submitted. '
+                             '0 only runs stages locally if requested in the config')
+    parser.add_argument('--local_threads',
+                        type=int,
+                        default=None,
+                        help='Number of threads used by a stage run on this host, by default a quarter of the cores. '
+                             'A stage only runs locally if its threads are idle next to the load of this host and '
+                             'the local stages already running')
+    parser.add_argument('--pack',
+                        type=int,
+                        default=0,
+                        help='Pack at least this many ready g_submit stages with identical resources into a single '
+                             'Slurm/SGE job array. Only stages requesting a walltime (-days/-hours) and their cores '
+                             '(-cpus, -ntasks or -nt) are packed, g_submit determines the resources of all other '
+                             'stages. 0 submits every stage individually')
+    parser.add_argument('--array_directives',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='Additional scheduler options for job arrays, e.g. --array_directives="--partition=short"')
+    parser.add_argument('--chain',
+                        default=False,
+                        action='store_true',
+                        help='Submit g_submit stages as soon as their g_submit parent is running. The scheduler holds '
+                             'them until the parent completes (Slurm: --dependency=afterok, SGE: -hold_jid)')
+    parser.add_argument('--interval',
+                        type=float,
+                        default=5.,
+                        help='Time in seconds between database scans, the daemon renews its lease once per interval')
+    parser.add_argument('--lease',
+                        type=float,
+                        default=30.,
+                        help='Time in seconds after which the simulations of an unresponsive daemon are taken over '
+                             'by other daemons')
+    parser.add_argument('--weight',
+                        type=int,
+                        default=1,
+                        help='Relative share of new simulations taken by this daemon, e.g. 2 for a host that can '
+                             'handle twice as many simulations as the others')
+    parser.add_argument('--max_workers',
+                        type=int,
+                        default=1000,
+                        help='Maximum number of simulations handled by this daemon at the same time')
+    parser.add_argument('--group',
+                        type=str,
+                        default='default',
+                        help='Only run simulations submitted to this group, all daemons of a group must share a '
+                             'filesystem')
+    parser.add_argument('--predict_walltime',
+                        default=False,
+                        action='store_true',
+                        help='Request the walltime predicted from the runtimes of similar g_submit stages if it is '
+                             'shorter than -days/-hours')
+    parser.add_argument('--predict_margin',
+                        type=float,
+                        default=1.2,
+                        help='Safety factor applied to the predicted walltime')
+    parser.add_argument('--max_resubmit',
+                        type=int,
+                        default=3,
+                        help='Resubmit g_submit stages that exceeded their walltime (Slurm TIMEOUT) at most this many '
+                             'times, continuing from their last checkpoint')
+    parser.add_argument('--grompp_cache',
+                        type=int,
+                        default=10000,
+                        help='Reuse the outputs of earlier grompp stages with identical arguments and input files, '
+                             'the cache keeps at most this many stages. 0 always runs grompp')
+    parser.add_argument('--flush_interval',
+                        type=float,
+                        default=0.2,
+                        help='Status changes and output records of workers are buffered and written in batches at '
+                             'least every flush_interval seconds. 0 lets every worker write its own records')
+    parser.add_argument('--flush_records',
+                        type=int,
+                        default=500,
+                        help='Write the buffered records once this many are pending')
     parser.add_argument('--log_dir',
                         type=str,
                         default=os.getcwd(),
                         help='Logfile directory, default=pwd')
-
-    # Database specific arguments
-    parser.add_argument('-d',
-                        '--dbname',
+    parser.add_argument('--log_format',
                         type=str,
-                        default='gmx',
-                        help='database name to connect to'
-                        )
-    parser.add_argument('-U',
-                        '--user',
-                        type=str,
-                        default=getpass.getuser(),
-                        help='database user name')
-    parser.add_argument('-W',
-                        '--password',
-                        type=str,
-                        default=None,
-                        help='database password, will open password prompt if left blank')
-    parser.add_argument('--host',
-                        type=str,
-                        default='localhost',
-                        help='database server host or socket directory')
-    parser.add_argument('-p',
-                        '--port',
+                        default='json',
+                        choices=('json', 'text'),
+                        help='Write the logfile as JSON lines or plain text')
+    parser.add_argument('--log_max_bytes',
+                        type=int,
+                        default=100*1024**2,
+                        help='Rotate the logfile once it reaches this size')
+    parser.add_argument('--log_backups',
                         type=int,
-                        default=9987,
-                        help='database server port')
+                        default=5,
+                        help='Number of rotated logfiles kept')
+    parser.add_argument('--log_queue_size',
+                        type=int,
+                        default=10000,
+                        help='Maximum number of log records waiting to be written, the oldest records are dropped '
+                             'if workers log faster')
+    parser.add_argument('--log_rate',
+                        type=float,
+                        default=10.,
+                        help='Maximum number of messages per second logged from the same line of code for the same '
+                             'simulation, errors are always logged')
+    parser.add_argument('--log_sample',
+                        type=float,
+                        default=1.,
+                        help='Fraction of debug messages logged')
+
+    # Database specific arguments
+    add_db_args(parser)
 
     # Logging specific arguments
     parser.add_argument('-v',
@@ -65,6 +167,180 @@ def parse_args():
     return parser.parse_args()
 
 
+def parse_query_args(argv):
+    description = """Search simulations, all filters have to match"""
+    parser = argparse.ArgumentParser(prog='gmxdb query', description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--status',
+                        type=str,
+                        nargs='*',
+                        default=None,
+                        help='Status names, e.g. running failed')
+    parser.add_argument('--cmd',
+                        type=str,
+                        nargs='*',
+                        default=None,
+                        help='Commands, e.g. g_submit')
+    parser.add_argument('--arg',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='Argument value as key=value, e.g. --arg deffnm=axel_rep1. '
+                             'The leading dash of the key is optional')
+    parser.add_argument('--output',
+                        type=str,
+                        nargs='*',
+                        default=None,
+                        help='Output files, finds the simulations that produced any of them')
+    parser.add_argument('--base',
+                        type=str,
+                        default=None,
+                        help='Base directory, finds all simulations in or below the directory')
+    parser.add_argument('--group',
+                        type=str,
+                        default=None,
+                        help='Only show simulations of this group')
+    parser.add_argument('--limit',
+                        type=int,
+                        default=100,
+                        help='Maximum number of simulations shown, most recent first')
+    add_db_args(parser)
+    args = parser.parse_args(argv)
+
+    kwargs = {}
+    for arg in args.arg:
+        if '=' not in arg:
+            parser.error(f'--arg expects key=value, got {arg}')
+        kw, value = arg.split('=', 1)
+        if not kw.startswith('-'):
+            kw = f'-{kw}'
+        kwargs[kw] = value
+    args.arg = kwargs
+    return args
+
+
+def parse_status_args(argv):
+    description = """Show the number of simulations per status, command and base directory, and the scheduler query
+    budgets with the number of times they were exhausted"""
+    parser = argparse.ArgumentParser(prog='gmxdb status', description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--watch',
+                        type=float,
+                        default=0.,
+                        help='Refresh the summary every WATCH seconds, 0 shows it once')
+    parser.add_argument('--top',
+                        type=int,
+                        default=20,
+                        help='Number of base directories shown, the directories with most simulations are shown')
+    add_db_args(parser)
+    return parser.parse_args(argv)
+
+
+def parse_stats_args(argv):
+    description = """Show percentiles of the time simulations spent in each status, queue time and run time"""
+    parser = argparse.ArgumentParser(prog='gmxdb stats', description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--by',
+                        type=str,
+                        default='cmd',
+                        choices=('cmd', 'base'),
+                        help='Group statistics by command or base directory')
+    parser.add_argument('--days',
+                        type=float,
+                        default=7.,
+                        help='Only use status changes of the last days')
+    add_db_args(parser)
+    return parser.parse_args(argv)
+
+
+def query(args):
+    conn = connect(args.dbname, args.user, get_password(args), args.host, args.port)
+    try:
+        rows = find_sims(conn, status=args.status, cmd=args.cmd, args=args.arg, outputs=args.output,
+                         base=args.base, group=args.group, limit=args.limit)
+    finally:
+        close(conn)
+
+    print('\t'.join(('id', 'status', 'cmd', 'base', 'args')))
+    for sim_id, stat_name, cmd, path, kwargs in rows:
+        print('\t'.join((str(sim_id), stat_name, cmd, str(path), json.dumps(kwargs))))
+
+
+def format_summary(summary, top=20):
+    lines = ['status']
+    lines += [f'  {k:<16} {n:>10}' for k, n in summary['status'].items()]
+    lines += ['cmd']
+    lines += [f'  {k:<16} {n:>10}' for k, n in summary['cmd'].items()]
+    bases = sorted(summary['base'].items(), key=lambda x: x[1], reverse=True)
+    lines += [f'base ({min(top, len(bases))} of {len(bases)})']
+    lines += [f'  {n:>10} {k}' for k, n in bases[:top]]
+    if summary['oldest_waiting'] is None:
+        lines += ['oldest waiting: -']
+    else:
+        sim_id, stat_id, created = summary['oldest_waiting']
+        lines += [f'oldest waiting: {sim_id} (status {stat_id}) since {created:%Y-%m-%d %H:%M:%S}']
+    # Scheduler query budgets, exhausted counts how often a daemon used a cached status for lack of tokens
+    lines += ['scheduler budget']
+    lines += [f'  {k:<16} {tokens:>6.1f}/{capacity:<6g} exhausted {n:>10}'
+              for k, (tokens, capacity, n) in summary['budget'].items()]
+    return '\n'.join(lines)
+
+
+def status(args):
+    conn = connect(args.dbname, args.user, get_password(args), args.host, args.port)
+    prepared = set()
+    try:
+        while True:
+            summary = status_summary(conn, prepared=prepared)
+            if args.watch > 0:
+                # Clear the terminal before every refresh
+                print('\033[H\033[J', end='')
+            print(format_summary(summary, top=args.top), flush=True)
+            if args.watch <= 0:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close(conn)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return f'{seconds / size:.1f}{unit}'
+    return f'{seconds:.0f}s'
+
+
+def stats(args):
+    conn = connect(args.dbname, args.user, get_password(args), args.host, args.port)
+    try:
+        transitions = transition_stats(conn, by=args.by, days=args.days)
+        runtimes = runtime_stats(conn, by=args.by, days=args.days)
+    finally:
+        close(conn)
+
+    pct = [f'p{int(p * 100)}' for p in PERCENTILES]
+    print(f'Time in status (last {args.days:g} days)')
+    print('\t'.join([args.by, 'status', 'n'] + pct))
+    for key, stat_name, n, values in transitions:
+        print('\t'.join([str(key), stat_name, str(n)] + [format_duration(v) for v in values]))
+    print()
+    print(f'Running simulations (last {args.days:g} days)')
+    print('\t'.join([args.by, 'n'] + [f'{name}_{p}' for name in ('queue', 'run', 'total') for p in pct]))
+    for key, n, *values in runtimes:
+        durations = [format_duration(v) for vs in values for v in (vs if vs is not None else [None] * len(pct))]
+        print('\t'.join([str(key), str(n)] + durations))
+
+
+# Subcommands, gmxdb without a subcommand runs the daemon
+COMMANDS = {'query': (parse_query_args, query),
+            'status': (parse_status_args, status),
+            'stats': (parse_stats_args, stats)}
+
+
 def configure_logger(level):
     root = logging.getLogger()
     root.addHandler(logging.StreamHandler())
@@ -78,13 +354,7 @@ def handler(signalname):
 
 
 def main(args):
-    if args.password is None:
-        password = getpass.getpass()
-    elif os.path.isfile(args.password):
-        with open(args.password, 'r') as fh:
-            password = fh.readline().rstrip('\n')
-    else:
-        password = args.password
+    password = get_password(args)
 
     if args.verbose:
         level = logging.DEBUG
@@ -94,17 +364,31 @@ def main(args):
     configure_logger(level)
 
     # Set up "basic" logger
-    handler = logging.FileHandler(os.path.join(args.log_dir, 'gmxdb.log'))
-    formatter = logging.Formatter('{asctime} - {process} - {levelname} - {message}', style='{')
+    # Workers rate limit their records and never block on logging, the listener thread writes all records
+    handler = RotatingFileHandler(os.path.join(args.log_dir, 'gmxdb.log'), maxBytes=args.log_max_bytes,
+                                  backupCount=args.log_backups)
+    if args.log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('{asctime} - {process} - {levelname} - {message}', style='{')
     handler.setFormatter(formatter)
     handler.setLevel(level)
-    q = Queue()
-    listener = QueueListener(q, handler)
+    set_rate_limit(rate=args.log_rate, sample=args.log_sample)
+    q = Queue(maxsize=args.log_queue_size)
+    listener = QueueListener(q, handler, respect_handler_level=True)
     listener.start()
 
     stop_event = Event()
     dbw = DatabaseWorkerMain(args.dbname, args.user, password, args.host, args.port, stop_event=stop_event, log_queue=q,
-                             clean=args.clean)
+                             clean=args.clean, state_age=args.state_age, query_rate=args.query_rate,
+                             query_burst=args.query_burst, local_walltime=args.local_walltime,
+                             local_threads=args.local_threads, pack=args.pack,
+                             array_directives=args.array_directives, chain=args.chain, interval=args.interval,
+                             lease=args.lease, weight=args.weight, max_workers=args.max_workers,
+                             group=args.group, predict=args.predict_walltime,
+                             predict_margin=args.predict_margin, max_resubmit=args.max_resubmit,
+                             grompp_cache=args.grompp_cache, flush_interval=args.flush_interval,
+                             flush_records=args.flush_records)
 
     dbw.start()
 
@@ -128,6 +412,11 @@ def main(args):
 
 if __name__ == '__main__':
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        parse, command = COMMANDS[sys.argv[1]]
+        command(parse(sys.argv[2:]))
+        sys.exit(0)
+
     # Before configuring the MainWorker we set the handler for SIGINT and SIGTERM
     # NOTE:  The signal handler will only be inherited by the worker if it is forked (not spawned)
     # NOTE: Right now (Python 3.8) this is the default behavior but might change in the future
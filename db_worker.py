@@ -1,21 +1,49 @@
-import json
+import math
 import time
+import socket
+import functools
 import logging
 import multiprocessing
-from logging.handlers import QueueHandler
-
-from utils.db import connect, execute_cmd
-from utils.hpcc import JobStatus
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.db import connect, execute_cmd, is_connection_error, DatabaseUnavailable
+from utils.queries import QUERIES, execute_query, json_param
+from utils.hpcc import JobStatus, get_scheduler, cancel_jobs, probe_scheduler
+from utils.shared import SchedulerStateCache, QueryBudget
+from utils.retry import RetryPolicy, CircuitOpen, DB_BREAKER, SCHEDULER_BREAKER
+from utils.log import DropOldestQueueHandler, RateLimitFilter, RATE_LIMIT
+from utils.predict import stage_signature, predict_hours, walltime_args
+from utils.memo import GromppCache, grompp_key, copy_outfile
+from utils.writes import WriteBuffer, batch_statements
 from utils.gmx import *
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Lock
+
+# Held by a GMXSubmit worker from deciding to run a stage on this host until the job is recorded in job_info,
+# so that stages started at the same time do not count the same idle cores. Created on import and shared by all
+# workers forked from a daemon
+LOCAL_LOCK = Lock()
 
 
 class DatabaseWorker(Process):
     """
     The Base class for database workers
     """
-    def __init__(self, dbname, user, password, host, port, log_queue=None):
+    def __init__(self, dbname, user, password, host, port, log_queue=None, persistent=False, write_queue=None):
+        """
+
+        :param dbname:
+        :param user:
+        :param password:
+        :param host:
+        :param port:
+        :param log_queue:
+        :param persistent: Keep a single connection open for the lifetime of the worker, this should only be used
+                           by workers that query the database continuously (e.g. DatabaseWorkerMain)
+        :param write_queue: If given, status changes and output records are put on this queue and written by
+                            DatabaseWorkerMain (see db_write)
+        """
         super().__init__()
         self.dbname = dbname
         self.user = user
@@ -23,59 +51,161 @@ class DatabaseWorker(Process):
         self.host = host
         self.port = port
 
+        self.persistent = persistent
+        self.write_queue = write_queue
+        self._conn = None
+        self._conn_pid = None
+        # Names of the statements prepared on the persistent connection
+        self._prepared = set()
+
         # Set up the logger
         if log_queue is not None:
             self.configure_logger(log_queue)
             self.name = multiprocessing.current_process().name
             self.logger = logging.getLogger(self.name)
 
-    def db_exec(self, cmd, max_attempt=10, interval=2, fetch=True, commit=False):
+    def get_connection(self):
+        """
+        Get a connection to the database
+        Persistent connections are opened once per process, in autocommit mode so that they are never left idle in
+        a transaction
+        :return:
+        """
+        if not self.persistent:
+            return connect(self.dbname, self.user, self.password, self.host, self.port)
+        if self._conn is None or self._conn.closed or self._conn_pid != os.getpid():
+            self._conn = connect(self.dbname, self.user, self.password, self.host, self.port)
+            self._conn.autocommit = True
+            self._conn_pid = os.getpid()
+            self._prepared = set()
+        return self._conn
+
+    def close_connection(self):
+        """
+        Close the persistent connection, it is reopened on the next query
+        :return:
+        """
+        if self._conn is not None and self._conn_pid == os.getpid():
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def db_exec(self, cmd, params=(), max_attempt=10, interval=2, fetch=True, commit=False):
         """
         Perform a database query
         Because there is a maximum to the number of simultaneous connections  we:
-        A) Only open connections when needed
-        B) Repeat failed connection attempt
-        :param cmd: A postgresql query
+        A) Only open connections when needed (unless the worker is persistent)
+        B) Repeat failed connection attempt with exponential backoff and jitter
+        C) Do not connect at all while the database circuit breaker is open (see utils.retry)
+        :param cmd: A postgresql query or the name of a statement in utils.queries.QUERIES
+        :param params: The parameters of a named statement
         :param max_attempt: how often to try to connect to db
-        :param interval: how long to wait between attempts
+        :param interval: upper bound of the first wait between attempts, doubled with every attempt
         :param fetch
         :param commit
         :return:
         """
-
-        for _ in range(max_attempt):
+        policy = RetryPolicy(base=interval)
+        for attempt in range(max_attempt):
+            if attempt > 0:
+                policy.sleep(attempt - 1)
+            if not DB_BREAKER.allow():
+                continue
             try:
-                conn = connect(self.dbname, self.user, self.password, self.host, self.port)
+                conn = self.get_connection()
                 try:
-                    if fetch:
-                        out = execute_cmd(conn, cmd, fetch=fetch, commit=commit)
-                        return out
+                    if cmd in QUERIES:
+                        prepared = self._prepared if self.persistent else None
+                        out = execute_query(conn, cmd, params, fetch=fetch, commit=commit, prepared=prepared)
                     else:
-                        execute_cmd(conn, cmd, fetch=fetch, commit=commit)
-                        return
+                        out = execute_cmd(conn, cmd, fetch=fetch, commit=commit)
                 finally:
-                    conn.close()
+                    if not self.persistent:
+                        conn.close()
             except Exception as e:
                 print(f'Failed to connect to database with {e}')
-                time.sleep(interval)
+                # A failed persistent connection might be broken, open a new one
+                self.close_connection()
+                # Only connection errors count towards the breaker, a failed query means the database is reachable
+                if is_connection_error(e):
+                    DB_BREAKER.failure()
+                else:
+                    DB_BREAKER.success()
                 continue
+            DB_BREAKER.success()
+            return out
+
+    def db_fetch(self, cmd, params=()):
+        """
+        Run a query whose result is required to continue
+        :param cmd: The name of a statement in utils.queries.QUERIES
+        :param params:
+        :return: A list of rows
+        :raises DatabaseUnavailable: If the query failed (see db_exec)
+        """
+        out = self.db_exec(cmd, params, fetch=True, commit=False)
+        if out is None:
+            raise DatabaseUnavailable(f'Could not run {cmd} with {params}, the database is not available')
+        return out
+
+    def db_value(self, cmd, params=()):
+        """
+        Run a query for a single value whose result is required to continue, e.g. a column of a sim
+        :param cmd: The name of a statement in utils.queries.QUERIES
+        :param params:
+        :return: The first column of the first row or None if there is no row
+        :raises DatabaseUnavailable: If the query failed (see db_exec)
+        """
+        out = self.db_fetch(cmd, params)
+        return out[0][0] if len(out) else None
+
+    def db_write(self, cmd, params):
+        """
+        Write a status change or output record (one of utils.writes.BUFFERED)
+        With a write queue the record is flushed by DatabaseWorkerMain together with the records of other workers,
+        it is visible to other workers once DatabaseWorkerMain flushed it
+        :param cmd: The name of a statement in utils.queries.QUERIES
+        :param params:
+        :return:
+        """
+        if self.write_queue is None:
+            self.db_exec(cmd, params, fetch=False, commit=True)
+        else:
+            self.write_queue.put(('write', cmd, params))
 
     def configure_logger(self, queue):
         """
-        Set up logging
+        Set up logging, repetitive records are suppressed and the rest is put on the queue without blocking
+        (see utils.log)
         :param queue:
         :return:
         """
-        handler = QueueHandler(queue)
+        handler = DropOldestQueueHandler(queue)
+        handler.addFilter(RateLimitFilter(**RATE_LIMIT))
         root = logging.getLogger()
         root.handlers = []
         root.addHandler(handler)
         root.setLevel(logging.DEBUG)
 
+    def set_log_context(self, **context):
+        """
+        Add context (e.g. sim_id) to all records logged by this worker
+        :param context:
+        :return:
+        """
+        if hasattr(self, 'logger'):
+            self.logger = logging.LoggerAdapter(logging.getLogger(self.name), context)
+
 
 class DatabaseWorkerMain(DatabaseWorker):
 
-    def __init__(self, dbname, user, password, host, port, stop_event, interval=10, timeout=-1, log_queue=None, clean=False):
+    def __init__(self, dbname, user, password, host, port, stop_event, interval=5, timeout=-1, log_queue=None, clean=False,
+                 state_age=30, query_rate=5., query_burst=50, local_walltime=0., local_threads=None, pack=0,
+                 array_directives=(), chain=False, lease=30., claim_batch=500, weight=1, max_workers=1000,
+                 group='default', predict=False, predict_margin=1.2, max_resubmit=3, grompp_cache=10000,
+                 flush_interval=0.2, flush_records=500):
         """
         Monitor jobs on a database and assign Monitor Workers to running jobs
 
@@ -84,103 +214,490 @@ class DatabaseWorkerMain(DatabaseWorker):
         :param password:
         :param host:
         :param port:
-        :param interval: How much time between queries
+        :param interval: How much time between queries, the lease is renewed once per interval
         :param timeout: timeout in seconds, negative values will run until terminated
         :param log_queue: A queue used for logging
-        :param clean: If true, try to delete jobscripts and log files when a job completes
+        :param clean: If true, delete jobscripts and log files of completed jobs in the background (see Cleanup)
+        :param state_age: Time in seconds a scheduler state cached in the database is considered fresh
+        :param query_rate: Scheduler queries per second allowed across all daemons
+        :param query_burst: Maximum number of scheduler queries in a burst
+        :param local_walltime: g_submit stages requesting at most this walltime (hours) are run on this host if enough
+                               cores are idle, 0 disables running stages locally unless requested explicitly
+        :param local_threads: Number of threads used by a stage run on this host,
+                              defaults to a quarter of the cores (see utils.gmx.default_local_threads)
+        :param pack: Pack at least this many ready g_submit stages with identical resources into a job array,
+                     0 submits every stage individually
+        :param array_directives: Additional scheduler options for job arrays
+        :param chain: Submit g_submit stages as soon as their g_submit parent is running,
+                      using a scheduler dependency (Slurm: afterok, SGE: hold_jid)
+        :param lease: Time in seconds the sims owned by this daemon stay reserved without a heartbeat,
+                      should be several times the interval
+        :param claim_batch: Maximum number of sims claimed per interval
+        :param weight: Relative share of unowned sims claimed by this daemon, e.g. 2 for a host twice as fast
+        :param max_workers: Maximum number of sims owned by this daemon, the free capacity is published to other daemons
+        :param group: Only handle sims of this group, all daemons of a group must share a filesystem
+        :param predict: Request the walltime predicted from similar stages for g_submit stages (see utils.predict)
+        :param predict_margin: Safety factor applied to the predicted walltime
+        :param max_resubmit: Resubmit g_submit stages that exceeded their walltime from their last checkpoint
+                             at most this many times
+        :param grompp_cache: Maximum number of grompp stages whose outputs are reused by identical stages
+                             (see utils.memo), 0 always runs grompp
+        :param flush_interval: Status changes and output records of workers are buffered and written at least every
+                               flush_interval seconds (see utils.writes), 0 lets every worker write its own records
+        :param flush_records: Flush the buffer once this many records are pending
         """
         self.log_queue = log_queue
         self.db_info = (dbname, user, password, host, port)
-        super().__init__(*self.db_info, log_queue=self.log_queue)
+        super().__init__(*self.db_info, log_queue=self.log_queue, persistent=True)
 
         self.stop_event = stop_event
         self.interval = interval
         self.timeout = timeout
         self.queue = Queue()
         self.clean = clean
+        self.state_age = state_age
+        self.query_rate = query_rate
+        self.query_burst = query_burst
+        self.local_walltime = local_walltime
+        self.local_threads = local_threads if local_threads is not None else default_local_threads()
+        self.hostname = socket.gethostname()
+        self.pack = pack
+        self.array_directives = array_directives
+        self.chain = chain
+        self.lease = lease
+        self.claim_batch = claim_batch
+        self.weight = weight
+        self.max_workers = max_workers
+        self.group = group
+        self.predict = predict
+        self.predict_margin = predict_margin
+        self.max_resubmit = max_resubmit
+        self.grompp_cache = grompp_cache
+        self.flush_interval = flush_interval
+        self.write_behind = flush_interval > 0
+        self.writes = WriteBuffer(max_records=flush_records, max_age=flush_interval)
+        # Number of sims owned at the last claim
+        self.n_owned = 0
+        # Sims whose workers were launched before the steady state and did not report ready yet (see loop)
+        self.starting = set()
+        # Set on registration in run (see register)
+        self.worker_id = None
 
     def is_valid(self, sim_id, stat_id):
         """
         Check if a job is valid
         If it's stat_id is 1 (Submitted) it must have a param entry
-        If it's stat_id is 4 (depend) is must have a param entry and a valid parent_id
+        If it's stat_id is 4 (depend) is must have a param entry and at least one parent, all parents must exist.
+        Simulations registered before parents were recorded in sim_edge have at most the single parent in
+        sim.parent_id
         :param sim_id:
         :param stat_id:
         :return:
+        :raises DatabaseUnavailable: If the job could not be checked
         """
 
         # Both stat_id 1 & 4 must have a param entry
-        cmd = f'SELECT * FROM param WHERE sim_id={sim_id}'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        if out is None or len(out) == 0:
+        if len(self.db_fetch('param_exists', (sim_id, ))) == 0:
             self.logger.error(f'Could not find simulation parameters for {sim_id}')
-            self.logger.error(f'Parameters contains: {out}')
             return False
-        else:
-            # stat_id 4 also requires a valid parent
-            if stat_id == 4:
-                cmd = f'SELECT parent_id FROM sim WHERE id={sim_id}'
-                out = self.db_exec(cmd, fetch=True, commit=False)
-                parent_id = out[0][0]
-                cmd = f'SELECT parent_id FROM sim WHERE id={parent_id}'
-                out = self.db_exec(cmd, fetch=True, commit=False)
-                if out is None or len(out) == 0:
-                    self.logger.error(f'Could not find parent simulation for {sim_id}')
+        if stat_id != 4:
+            return True
+
+        # stat_id 4 also requires valid parents
+        parents = [parent_id for parent_id, in self.db_fetch('sim_parents', (sim_id, ))]
+        if len(parents) == 0:
+            parent_id = self.db_value('sim_parent_id', (sim_id, ))
+            parents = [parent_id] if parent_id is not None else []
+        if len(parents) == 0:
+            self.logger.error(f'{sim_id} depends on other simulations, but has no parents')
+            return False
+        for parent_id in parents:
+            if self.db_value('sim_stat_id', (parent_id, )) is None:
+                self.logger.error(f'Could not find parent simulation {parent_id} of {sim_id}')
+                return False
+        return True
+
+    def register(self):
+        """
+        Register this daemon in the worker table
+        :return:
+        """
+        out = self.db_exec('worker_register', (self.hostname, os.getpid(), self.lease, self.weight, self.group),
+                           fetch=True, commit=True)
+        if out is None:
+            raise DatabaseUnavailable('Could not register this daemon, the database is not available')
+        self.worker_id = out[0][0]
+        self.set_log_context(worker_id=self.worker_id)
+        self.logger.info(f'Registered as worker {self.worker_id} on {self.hostname} in group {self.group}')
+
+    def deregister(self):
+        """
+        Release all owned sims and mark this daemon inactive, other daemons can claim the sims immediately
+        :return:
+        """
+        if self.worker_id is None:
+            return
+        self.db_exec('sim_release', (self.worker_id, ), fetch=False, commit=True, max_attempt=1)
+        self.db_exec('worker_deregister', (self.worker_id, ), fetch=False, commit=True, max_attempt=1)
+        self.logger.info(f'Deregistered worker {self.worker_id}')
+
+    def claim_limit(self, free):
+        """
+        Number of sims to claim, the claimable sims are shared between all live daemons in proportion to their
+        weight times free capacity. Every daemon publishes its free capacity before claiming.
+        :param free: Free capacity of this daemon
+        :return:
+        """
+        out = self.db_exec('worker_share', (self.hostname, self.group), fetch=True, commit=False)
+        if not out:
+            return 0
+        claimable, total = out[0]
+        own = self.weight * free
+        if claimable == 0 or own <= 0:
+            return 0
+        return min(free, self.claim_batch, math.ceil(claimable * own / max(total, own)))
+
+    def free_capacity(self):
+        """
+        Free capacity of this daemon: max_workers minus the owned sims, scaled by the share of cores not used by the
+        stages running on this host, a host busy running stages takes fewer new sims.
+        Stages that are being submitted or run on this host are owned, they are not subtracted a second time
+        :return:
+        """
+        out = self.db_exec('job_info_local_running', (self.hostname, ), fetch=True, commit=False)
+        n_local = out[0][0] if out else 0
+        free = max(0, self.max_workers - self.n_owned)
+        idle = max(0., 1. - n_local * self.local_threads / os.cpu_count())
+        return int(free * idle)
+
+    def claim(self):
+        """
+        Renew the lease of this daemon and publish its free capacity, claim unowned sims and sims of daemons with an
+        expired lease
+        :return: A list of (sim_id, stat_id) of all sims owned by this daemon
+        """
+        free = self.free_capacity()
+        self.db_exec('worker_heartbeat', (self.worker_id, self.lease, free), fetch=False, commit=True)
+        limit = self.claim_limit(free)
+        if limit > 0:
+            out = self.db_exec('sim_claim', (self.worker_id, self.hostname, limit, self.group), fetch=True,
+                               commit=True)
+            if out:
+                self.logger.debug(f'Claimed {len(out)} sims')
+        out = self.db_exec('sim_owned', (self.worker_id, ), fetch=True, commit=False)
+        if out is None:  # The database is not available
+            return
+        self.n_owned = len(out)
+        return out
+
+    def failing_service(self):
+        """
+        Check if dispatch should be paused because the database or the scheduler is failing (see utils.retry)
+        While a circuit breaker is open a single probe per reset timeout checks if the service is back
+        :return: The name of the failing service or None
+        """
+        if DB_BREAKER.is_open:
+            self.db_exec('SELECT 1;', max_attempt=1, fetch=True, commit=False)
+            if DB_BREAKER.is_open:
+                return DB_BREAKER.name
+        if SCHEDULER_BREAKER.is_open and not probe_scheduler():
+            return SCHEDULER_BREAKER.name
+        return
+
+    def pack_arrays(self, active):
+        """
+        Group ready g_submit stages with identical resources and submit each group as a job array
+        Groups smaller than self.pack and stages whose resources can not be requested by an array
+        (see utils.gmx.array_directives) are left to the individual GMXSubmit workers
+        :param active: Dictionary of active workers, packed stages are added to it
+        :return:
+        """
+        out = self.db_exec('param_ready_g_submit', (self.worker_id, ), fetch=True, commit=False)
+        if out is None:
+            return
+        scheduler = get_scheduler()
+        groups = {}
+        directives = {}
+        for sim_id, args in out:
+            if sim_id in active.keys():
+                continue
+            resources = array_resources(args)
+            if resources not in directives:
+                directives[resources] = array_directives(args, scheduler)
+            if directives[resources] is not None:
+                groups.setdefault(resources, []).append(sim_id)
+
+        for resources, sim_ids in groups.items():
+            if len(sim_ids) < self.pack:
+                continue
+            self.logger.debug(f'Launching GMXArraySubmit worker for {sim_ids}')
+            # Options given to the daemon are added to the resources requested by the stages
+            worker = GMXArraySubmit(*self.db_info, sim_ids=sim_ids, queue=self.queue, log_queue=self.log_queue,
+                                    directives=tuple(directives[resources]) + tuple(self.array_directives),
+                                    worker_id=self.worker_id, write_behind=self.write_behind)
+            worker.daemon = True
+            for sim_id in sim_ids:
+                active[sim_id] = worker
+            worker.start()
+
+    def flush(self):
+        """
+        Write all buffered records in a single transaction (see utils.writes)
+        Records are kept if the database is not reachable. If the database rejects the batch, the records are
+        written one by one and records that fail again are dropped.
+        :return: True if no records are pending
+        """
+        if len(self.writes) == 0:
+            return True
+        records = self.writes.take()
+        try:
+            DB_BREAKER.check()
+            conn = self.get_connection()
+            with conn.cursor() as cursor:
+                cursor.execute('BEGIN')
+            for cmd, params in batch_statements(records):
+                execute_query(conn, cmd, params, fetch=False, commit=False, prepared=self._prepared)
+            with conn.cursor() as cursor:
+                cursor.execute('COMMIT')
+        except Exception as e:
+            # The connection is left in a failed transaction
+            self.close_connection()
+            if isinstance(e, CircuitOpen) or is_connection_error(e):
+                if not isinstance(e, CircuitOpen):
+                    DB_BREAKER.failure()
+                self.writes.restore(records)
+                self.logger.warning(f'Could not flush {len(records)} records, the database is not available')
+                return False
+            self.logger.error(f'Failed to flush {len(records)} records, writing them one by one: {e}')
+            for i, (cmd, params) in enumerate(records):
+                try:
+                    execute_query(self.get_connection(), cmd, params, fetch=False, commit=False,
+                                  prepared=self._prepared)
+                except Exception as e:
+                    self.close_connection()
+                    if is_connection_error(e):
+                        DB_BREAKER.failure()
+                        self.writes.restore(records[i:])
+                        return False
+                    self.logger.error(f'Dropped record {cmd}{params}: {e}')
+            return len(self.writes) == 0
+        DB_BREAKER.success()
+        self.logger.debug(f'Flushed {len(records)} records')
+        return True
+
+    def receive(self, active, timeout=0.):
+        """
+        Receive records and exit signals from workers, buffered records are flushed when due
+        :param active: Dictionary of active workers, workers that exited are removed
+        :param timeout: Time in seconds to wait for messages, the queue is drained afterwards.
+                        Waiting ends early if the stop event is set
+        :return:
+        """
+        t_end = time.time() + timeout
+        # Workers that exited before the queue is drained, everything they put on the queue is received below
+        exited = [key for key, worker in active.items() if worker.exitcode is not None]
+        # Wake up in time to flush the buffer
+        poll = self.flush_interval if self.write_behind else 1.
+        while 1:
+            remaining = 0 if self.stop_event.is_set() else t_end - time.time()
+            try:
+                if remaining > 0:
+                    item = self.queue.get(timeout=min(remaining, poll))
                 else:
-                    return True
+                    item = self.queue.get_nowait()
+            except Empty:
+                item = None
+            if isinstance(item, tuple) and item[0] == 'ready':  # A worker finished its setup and first poll
+                self.starting.discard(item[1])
+            elif isinstance(item, tuple):  # A record (see DatabaseWorker.db_write)
+                self.writes.add(*item[1:])
+            elif item is not None:
+                self.logger.debug(f'Received exit code for: {item}')
+                self.starting.discard(item)
+                worker = active.pop(item, None)
+                if worker is not None:
+                    worker.join()  # Wait until the worker shuts down
+                self.logger.debug(f'Recycled worker for: {item}')
+            if self.writes.due():
+                self.flush()
+            if item is None and remaining <= 0:
+                break
+        self.reap(active, exited)
+
+    def reap(self, active, exited):
+        """
+        Remove workers that exited without signalling it (e.g. killed or crashed), their sims are dispatched again
+        :param active: Dictionary of active workers
+        :param exited: Keys of workers that had exited before the queue was drained
+        :return:
+        """
+        for key in exited:
+            worker = active.get(key)
+            if worker is None:  # The worker signalled its exit
+                continue
+            if worker.exitcode != 0:
+                self.logger.error(f'Worker for {key} died with exit code {worker.exitcode}')
             else:
-                return True
+                self.logger.warning(f'Worker for {key} exited without signalling it')
+            del(active[key])
+            self.starting.discard(key)
+
+    def stop_monitors(self, active, sim_ids):
+        """
+        Stop the Monitor workers of sims this daemon no longer owns
+        Monitors share the queue with all other workers, so they are asked to return and the queue is drained while
+        they do. Only workers that did not return within an interval are terminated, a worker terminated while writing
+        to the queue can corrupt it
+        :param active: Dictionary of active workers, the stopped workers are removed
+        :param sim_ids:
+        :return:
+        """
+        stopping = {}
+        for sim_id in sim_ids:
+            self.logger.warning(f'Lost lease on {sim_id}, stopping its Monitor worker')
+            stopping[sim_id] = active.pop(sim_id)
+            stopping[sim_id].stop()
+            self.starting.discard(sim_id)
+        t_end = time.time() + self.interval
+        while any([worker.is_alive() for worker in stopping.values()]) and time.time() < t_end:
+            self.receive(active, min(0.1, self.interval))
+        for sim_id, worker in stopping.items():
+            if worker.is_alive():
+                self.logger.error(f'Monitor worker for {sim_id} did not stop, terminating it')
+                worker.terminate()
+            worker.join()
 
     def run(self):
         self.logger.info(f'Started Main worker with name: {self.name}')
+        # The scheduler is determined once, all workers inherit the cached result
+        get_scheduler()
+        self.register()
+        try:
+            self.loop()
+        finally:
+            self.deregister()
+
+    def loop(self):
         # Keep track of all sim_ids with active workers
         active = {}
         t = time.time()
+        # Time until a scan finds a worker for every owned sim and all workers launched until then finished their setup
+        # and first poll, e.g. after restarting a daemon
+        t_steady = None
+        t_clean = 0
+        paused = None
         while 1:
             if self.stop_event.is_set():
+                # Write the records of workers that finished before stopping
+                self.receive(active)
+                self.flush()
                 break
             # First check if any workers
-            while not self.queue.empty():
-                sim_id = self.queue.get()
-                self.logger.debug(f'Received exit code for: {sim_id}')
-                active[sim_id].join()  # Wait until the worker shuts down
-                del(active[sim_id])
-                self.logger.debug(f'Recycled worker for: {sim_id}')
-            # Get all simulations flagged as either submitted, running or depend
-            query = 'SELECT id, stat_id FROM sim WHERE stat_id=1 OR stat_id=2 OR stat_id=4;'
-            out = self.db_exec(query, fetch=True, commit=False)
-            for (sim_id, stat_id) in out:
+            self.receive(active)
+            # Buffered status changes must be written before sims are dispatched based on their status
+            if not self.flush():
+                self.receive(active, self.interval)
+                continue
+            # Pause dispatch while the database or the scheduler is failing
+            failing = self.failing_service()
+            if failing != paused:
+                if failing is not None:
+                    self.logger.warning(f'The {failing} is not available, pausing dispatch')
+                else:
+                    self.logger.info('Resuming dispatch')
+                paused = failing
+            if paused is not None:
+                self.receive(active, self.interval)
+                continue
+            # Get all simulations flagged as either submitted, running or depend and owned by this daemon
+            owned = self.claim()
+            if owned is None:
+                self.receive(active, self.interval)
+                continue
+            # If the lease of this daemon expired (e.g. the host was suspended) another daemon might have claimed
+            # some of its sims. Monitors are stopped to not query the scheduler twice, submissions only record their
+            # jobs if the stage is still owned by this daemon (see GMXSubmit.begin_submit)
+            owned_ids = set(sim_id for sim_id, _ in owned)
+            lost = [sim_id for sim_id, worker in active.items()
+                    if isinstance(worker, Monitor) and sim_id not in owned_ids]
+            if lost:
+                self.stop_monitors(active, lost)
+            # Stages whose submission was interrupted (the worker died) are submitted again
+            if any([stat_id == 6 and sim_id not in active.keys() for sim_id, stat_id in owned]):
+                out = self.db_exec('sims_reset_submitting',
+                                   (self.worker_id, [k for k in active.keys() if isinstance(k, int)]),
+                                   fetch=True, commit=True)
+                if out:
+                    self.logger.warning(f'Submission of {[sim_id for sim_id, in out]} was interrupted, '
+                                        f'submitting again')
+            if self.pack > 0:
+                self.pack_arrays(active)
+            # Check the output files of finished jobs in one batch
+            if 'verify' not in active.keys():
+                out = self.db_exec('sim_has_stat_id', (7, self.group), fetch=True, commit=False)
+                if out:
+                    self.logger.debug('Launching Verify worker')
+                    active['verify'] = Verify(*self.db_info, queue=self.queue, log_queue=self.log_queue,
+                                              group=self.group)
+                    active['verify'].daemon = True
+                    active['verify'].start()
+            # Remove jobscripts and logs of completed jobs in the background, at most once per interval
+            if self.clean and 'cleanup' not in active.keys() and time.time() - t_clean > self.interval:
+                t_clean = time.time()
+                self.logger.debug('Launching Cleanup worker')
+                active['cleanup'] = Cleanup(*self.db_info, queue=self.queue, log_queue=self.log_queue,
+                                            group=self.group)
+                active['cleanup'].daemon = True
+                active['cleanup'].start()
+            launched = set(active.keys())
+            for (sim_id, stat_id) in owned:
                 # Skip all jobs that already  have a worker assigned
                 if sim_id in active.keys():
                     continue
                 # For submitted jobs and jobs with dependency check if they are valid
                 if stat_id in (1, 4):
                     self.logger.debug(f'No worker assigned to: {sim_id} with stat_id: {stat_id}')
-                    valid = self.is_valid(sim_id, stat_id)
+                    try:
+                        valid = self.is_valid(sim_id, stat_id)
+                    except DatabaseUnavailable:  # Checked again with the next scan
+                        continue
                     if not valid:
                         self.logger.error(f'sim_id: {sim_id} not a valid job, flagging as failed')
-                        cmd = f'UPDATE sim SET stat_id=0 WHERE id={sim_id};'
-                        self.db_exec(cmd, fetch=False, commit=True)
+                        self.db_exec('sim_set_stat_id', (sim_id, 0), fetch=False, commit=True)
                         continue
 
                 # Launch workers according to stat_id
                 if stat_id == 1:  # Submitted
                     self.logger.debug(f'Launching GMXSubmit worker for {sim_id}')
                     active[sim_id] = GMXSubmit(*self.db_info, sim_id=sim_id, queue=self.queue, log_queue=self.log_queue,
-                                               ntrials=3)
+                                               ntrials=3, local_walltime=self.local_walltime,
+                                               local_threads=self.local_threads, predict=self.predict,
+                                               predict_margin=self.predict_margin, grompp_cache=self.grompp_cache,
+                                               worker_id=self.worker_id, write_behind=self.write_behind)
                     active[sim_id].daemon = True
                     active[sim_id].start()
                 elif stat_id == 2:  # Running
                     self.logger.debug(f'Launching Monitor worker for {sim_id}')
                     active[sim_id] = Monitor(*self.db_info, sim_id=sim_id, queue=self.queue, log_queue=self.log_queue,
-                                             clean=self.clean)
+                                             state_age=self.state_age,
+                                             query_rate=self.query_rate, query_burst=self.query_burst,
+                                             max_resubmit=self.max_resubmit, worker_id=self.worker_id,
+                                             write_behind=self.write_behind)
                     active[sim_id].daemon = True
                     active[sim_id].start()
                 elif stat_id == 4:  # depend
                     self.logger.debug(f'Launching Depend worker for {sim_id}')
-                    active[sim_id] = Depend(*self.db_info, sim_id=sim_id, queue=self.queue)
+                    active[sim_id] = Depend(*self.db_info, sim_id=sim_id, queue=self.queue, log_queue=self.log_queue,
+                                            chain=self.chain, worker_id=self.worker_id, write_behind=self.write_behind)
                     active[sim_id].daemon = True
                     active[sim_id].start()
+            launched = set(active.keys()) - launched
+            if t_steady is None:
+                self.starting.update(launched)
+            if t_steady is None and len(launched) == 0 and len(self.starting) == 0:
+                t_steady = time.time() - t
+                self.logger.info(f'Reached steady state after {t_steady:.1f} s with {len(active)} active workers')
+            self.receive(active, self.interval)
 
 
 class Monitor(DatabaseWorker):
@@ -188,7 +705,7 @@ class Monitor(DatabaseWorker):
     Monitor a running job
     """
     def __init__(self, dbname, user, password, host, port, sim_id, queue, interval=5, timeout=-1, log_queue=None,
-                 clean=False):
+                 state_age=30, query_rate=5., query_burst=50, max_resubmit=3, worker_id=None, write_behind=False):
         """
 
         :param dbname:
@@ -200,79 +717,186 @@ class Monitor(DatabaseWorker):
         :param queue: Once the job is no longer running we inform DataBaseWorkerMain
         :param interval:
         :param timeout:
-        :param clean: If true, remove jobscripts and logfiles if job exits with status 3 (completed)
+        :param state_age: Time in seconds a scheduler state cached in the database is considered fresh
+        :param query_rate: Scheduler queries per second allowed across all daemons
+        :param query_burst: Maximum number of scheduler queries in a burst
+        :param max_resubmit: Resubmit g_submit stages that exceeded their walltime at most this many times
+        :param worker_id: The daemon owning the sim, only the owner resubmits it (see resubmit)
+        :param write_behind: Status changes are written by DatabaseWorkerMain (see DatabaseWorker.db_write)
         """
         # Init parent class
-        super().__init__(dbname, user, password, host, port, log_queue=log_queue)
+        super().__init__(dbname, user, password, host, port, log_queue=log_queue,
+                         write_queue=queue if write_behind else None)
         self.sim_id = sim_id
         self.queue = queue
+        self.set_log_context(sim_id=sim_id)
         self.interval = interval
         self.timeout = timeout
-        # Get a list of job ids associated with the sim_id
-        _ids = [q[0] for q in self.db_exec(f'SELECT job_id FROM job_info WHERE sim_id={sim_id};')]
-        self.js = JobStatus(_ids)
-        self.clean = clean
-
-    def cleanup(self):
+        self.state_age = state_age
+        self.query_rate = query_rate
+        self.query_burst = query_burst
+        self.max_resubmit = max_resubmit
+        self.worker_id = worker_id
+        # Set by DatabaseWorkerMain if the daemon lost the sim, see stop
+        self.stop_event = multiprocessing.Event()
+        # Set in setup
+        self.budget = None
+        self.js = None
+        self.parent_id = None
+        self.parent_complete = True
+
+    def setup(self):
         """
-        Delete JOSCRIPTS and JLOGS
+        Get the jobs of the simulation, this runs in the worker process so that launching workers does not block
+        DatabaseWorkerMain
         :return:
         """
-
-        cmd = f'SELECT files FROM fout WHERE sim_id={self.sim_id}'
-        file_dict = self.db_exec(cmd, fetch=True, commit=False)[0][0]
-
-        jscripts = file_dict.get('JSCRIPTS')
-        if jscripts is None:
-            self.logger.warning('Cleanup was called but could not find any JSCRIPTS')
-        else:
-            for fn in file_dict['JSCRIPTS']:
-                if not os.path.isfile(fn):
-                    self.logger.warning(f'Cleanup could not find: {fn} for sim_id: {self.sim_id}')
-                else:
-                    self.logger.debug(f'Removing {fn}')
-                    os.remove(fn)
-            del(file_dict['JSCRIPTS'])
-        jlogs = file_dict.get('JLOGS')
-        if jlogs is None:
-            self.logger.warning('Cleanup was called, but could not find any JLOGS')
+        # Get a list of job ids associated with the sim_id
+        out = self.db_fetch('job_info_jobs', (self.sim_id, ))
+        # Array tasks are identified by <job_id>_<task_id>
+        _ids = [q[0] if q[1] < 0 else f'{q[0]}_{q[1]}' for q in out]
+        self.budget = QueryBudget(self.db_exec, rate=self.query_rate, capacity=self.query_burst)
+        if any([q[2] == 'local' for q in out]):  # Jobs running on this host do not query the scheduler
+            self.js = JobStatus(_ids, scheduler='Local')
         else:
-            for fn in file_dict['JLOGS']:
-                if not os.path.isfile(fn):
-                    self.logger.warning(f'Cleanup could not find: {fn} for sim_id: {self.sim_id}')
-                else:
-                    self.logger.debug(f'Removing {fn}')
-                    os.remove(fn)
-            del(file_dict['JLOGS'])
+            # Scheduler states are shared with other daemons through the job_state table
+            self.js = JobStatus(_ids, cache=SchedulerStateCache(self.db_exec, max_age=self.state_age),
+                                budget=self.budget)
+        # Chained jobs (see Depend) are submitted before their parent completes
+        self.parent_id = self.db_value('sim_parent_id', (self.sim_id, ))
+        self.parent_complete = self.parent_id is None
+
+    def parent_failed(self):
+        """
+        Check if the parent of a chained job failed, the scheduler would hold such a job forever
+        :return: False if the status of the parent is not available, it is checked again with the next poll
+        """
+        if self.parent_complete:
+            return False
+        out = self.db_exec('sim_stat_id', (self.parent_id, ))
+        if not out:
+            return False
+        pstat_id = out[0][0]
+        if pstat_id == 3:
+            self.parent_complete = True
+        return pstat_id in (0, 5)
 
-        cmd = f'UPDATE fout SET files=\'{json.dumps(file_dict)}\' WHERE sim_id={self.sim_id};'
-        self.db_exec(cmd, fetch=False, commit=True)
-        return
+    def resubmit(self):
+        """
+        Resubmit a g_submit stage that exceeded its walltime, continuing from the checkpoint written by the stage (CPT)
+        Chained children are cancelled and wait for the new jobs (see Depend).
+        Only the owner resubmits a stage, a Monitor of a daemon that lost its lease leaves it alone
+        :return: True if the stage was resubmitted, None if it is no longer owned by this daemon
+        :raises DatabaseUnavailable: If the stage can not be resubmitted yet, the resubmission is tried again later
+        """
+        if self.db_value('param_cmd', (self.sim_id, )) != 'g_submit':
+            return False
+        resubmits = self.db_value('sim_resubmits', (self.sim_id, ))
+        if resubmits >= self.max_resubmit:
+            self.logger.error(f'{self.sim_id} exceeded its walltime, not resubmitted after {resubmits} resubmits')
+            return False
+        fout = self.db_value('fout_files', (self.sim_id, )) or {}
+        if 'CPT' not in fout:
+            self.logger.error(f'{self.sim_id} exceeded its walltime, but no checkpoint file is known')
+            return False
+        # The checkpoint is set, the jobs are forgotten and the status is reset in one statement
+        out = self.db_exec('sim_resubmit', (self.sim_id, self.worker_id, fout['CPT']), fetch=True, commit=True)
+        if out is None:
+            raise DatabaseUnavailable(f'Could not resubmit {self.sim_id}, the database is not available')
+        if len(out) == 0:
+            self.logger.warning(f'{self.sim_id} exceeded its walltime, but it is no longer owned by this daemon')
+            return
+        # Remaining jobs of the stage (e.g. jobs g_submit chained to the one that timed out) are replaced
+        cancel_jobs(self.js.job_ids)
+        for child_id, in self.db_exec('sim_reset_chained', (self.sim_id, ), fetch=True, commit=True) or []:
+            out = self.db_exec('job_info_jobs', (child_id, ))
+            if out:
+                cancel_jobs([job_id if task_id < 0 else f'{job_id}_{task_id}' for job_id, task_id, _ in out])
+            self.db_exec('job_info_delete', (child_id, ), fetch=False, commit=True)
+            self.logger.info(f'Cancelled chained child {child_id}, it waits for the resubmitted stage')
+        self.logger.warning(f'{self.sim_id} exceeded its walltime, resubmitted from {fout["CPT"]} '
+                            f'({resubmits + 1}/{self.max_resubmit})')
+        return True
+
+    def stop(self):
+        """
+        Ask the worker to return without changing the status of the sim, e.g. if another daemon claimed it.
+        Called by DatabaseWorkerMain, the worker returns at the latest after its current poll
+        :return:
+        """
+        self.stop_event.set()
 
-    #  TODO Should check for outfiles once the job completes
     def run(self):
+        try:
+            self.monitor()
+        except DatabaseUnavailable as e:
+            # The sim is monitored again by the next worker DatabaseWorkerMain launches
+            self.logger.warning(f'{e}, stopped monitoring {self.sim_id}')
+            if not self.stop_event.is_set():
+                self.queue.put(self.sim_id)
+
+    def monitor(self):
+        """
+        Poll the status of the jobs until they are no longer running
+        :return:
+        """
+        self.setup()
         self.logger.debug(f'Monitoring: {self.sim_id}')
         t = time.time()
+        polled = False
         while self.timeout*(time.time()-t) < self.timeout**2:
+            if self.stop_event.is_set():
+                self.logger.debug(f'Stopped monitoring {self.sim_id}')
+                return
+            if self.parent_failed():
+                self.logger.error(f'Parent of {self.sim_id} failed, cancelling jobs: {self.js.job_ids}')
+                cancel_jobs(self.js.job_ids)
+                self.db_write('sim_set_stat_id', (self.sim_id, 5))  # Set depend_failed
+                self.queue.put(self.sim_id)
+                return
+            exhausted = self.budget.exhausted
             status = self.js.status
+            if not polled:  # Report the end of the startup (see DatabaseWorkerMain.loop)
+                self.queue.put(('ready', self.sim_id))
+                polled = True
+            if self.stop_event.is_set():  # The status is left to the daemon that owns the sim now
+                continue
+            if self.budget.exhausted > exhausted:
+                self.logger.warning(f'Scheduler query budget exhausted, using cached status for: {self.sim_id}')
+            if status is None:  # No status available (yet), e.g. if the query budget is exhausted
+                self.stop_event.wait(self.interval)
+                continue
+            if status == 8:  # Timeout
+                try:
+                    resubmitted = self.resubmit()
+                except DatabaseUnavailable as e:
+                    self.logger.warning(f'{e}, trying to resubmit {self.sim_id} later')
+                    self.stop_event.wait(self.interval)
+                    continue
+                if resubmitted is False:  # The stage is left to its owner if it was lost (None)
+                    self.db_write('sims_set_stat_id', ([self.sim_id], 0, 2))
+                self.queue.put(self.sim_id)
+                return
             if status != 2:
                 if status == 0:
                     self.logger.error(f'{self.sim_id} no longer running; FAILED with Stat_id: {status}')
                 else:
                     self.logger.debug(f'{self.sim_id} no longer running. Stat_id: {status}')
-                if status == 3 and self.clean:
-                    self.cleanup()
+                if status == 3:  # Output files are checked by Verify before the job is flagged complete
+                    status = 7
 
-                cmd = f'UPDATE sim SET stat_id={status} WHERE id={self.sim_id}'
-                self.db_exec(cmd, fetch=False, commit=True)
+                # The sim is left alone if it was reset while monitored, e.g. a chained child of a resubmitted stage
+                self.db_write('sims_set_stat_id', ([self.sim_id], status, 2))
                 self.logger.debug(f'Changed job status to: {status}')
                 self.queue.put(self.sim_id)
                 return
-            time.sleep(self.interval)
+            self.stop_event.wait(self.interval)
 
 
 class GMXSubmit(DatabaseWorker):
-    def __init__(self, dbname, user, password, host, port, sim_id, queue, log_queue=None, ntrials=1):
+    def __init__(self, dbname, user, password, host, port, sim_id, queue, log_queue=None, ntrials=1,
+                 local_walltime=0., local_threads=None, after=None, predict=False, predict_margin=1.2,
+                 predict_samples=50, grompp_cache=0, worker_id=None, write_behind=False):
         """
         Submit a simulation with g_submit
         :param dbname:
@@ -283,55 +907,180 @@ class GMXSubmit(DatabaseWorker):
         :param sim_id:
         :param queue:
         :param ntrials: How often to try to run the job before returning failed
+        :param local_walltime: g_submit stages requesting at most this walltime (hours) are run on this host if enough
+                               cores are idle, 0 disables running stages locally unless requested explicitly
+        :param local_threads: Number of threads used by a stage run on this host,
+                              defaults to a quarter of the cores (see utils.gmx.default_local_threads)
+        :param after: Job ids of the parent, if given the job is submitted right away but only starts once the parent
+                      jobs complete successfully
+        :param predict: Request the walltime predicted from similar stages instead of -days/-hours
+                        if it is shorter (see utils.predict)
+        :param predict_margin: Safety factor applied to the predicted walltime
+        :param predict_samples: Maximum number of recent similar stages used for a prediction
+        :param grompp_cache: Maximum number of entries in the grompp cache, 0 always runs grompp (see utils.memo)
+        :param worker_id: The daemon owning the stage, the stage is only submitted by its owner (see begin_submit)
+        :param write_behind: Resolved outfiles of parents are written by DatabaseWorkerMain
+                             (see DatabaseWorker.db_write)
         """
         # Init parent class
-        super().__init__(dbname, user, password, host, port, log_queue)
+        super().__init__(dbname, user, password, host, port, log_queue,
+                         write_queue=queue if write_behind else None)
 
         self.sim_id = sim_id
+        self.worker_id = worker_id
         self.queue = queue
+        self.set_log_context(sim_id=sim_id)
+
+        # Job information, set in setup
+        self.app = None
+        self.base = None
+        # User defined outfiles, read before submitting so that recording a submission needs no further queries
+        self.fout = None
+        self.depend = None
+        self.depend_fout = None
+        # sim_ids of all parents (the first is depend) and their outfiles, see get_parent_fout
+        self.parents = []
+        self.parents_fout = {}
+
+        # Parse arguments resolving dependencies
+        self.args = None
+
+        self.ntrials = ntrials
 
-        # Get job information
+        self.local_walltime = local_walltime
+        self.local_threads = local_threads if local_threads is not None else default_local_threads()
+        # Set to True in run if the stage is run on this host rather than submitted to the cluster
+        self.local = False
+        self.after = after
+        self.predict = predict
+        self.predict_margin = predict_margin
+        self.predict_samples = predict_samples
+        self.grompp_cache = grompp_cache
+        # Cache key of a grompp stage, set in reuse_grompp
+        self.grompp_key = None
+
+    def setup(self):
+        """
+        Get the job information, this runs in the worker process so that launching workers does not block
+        DatabaseWorkerMain
+        :return:
+        """
         self.app = self.get_app()
+        self.base = self.get_base()
 
         # sim_id of the hypothetical dependency (Will be None if None
-        self.depend = self.get_dependency(sim_id=self.sim_id)
+        self.parents = self.get_parents(sim_id=self.sim_id)
+        self.depend = self.parents[0] if len(self.parents) else None
 
         if self.depend is not None:
-            self.depend_fout = self.get_fout(self.depend)
+            self.depend_fout = self.get_parent_fout(0)
         else:
             self.depend_fout = None
-
-        # Parse arguments resolving dependencies
-        self.args = None
-
-        self.ntrials = ntrials
+        self.fout = self.get_fout(self.sim_id)
 
     def get_app(self):
         """
         Get application
         :return:
         """
-        cmd = f'SELECT cmd FROM param WHERE sim_id={self.sim_id}'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        return out[0][0]
+        return self.db_value('param_cmd', (self.sim_id, ))
 
     def get_args(self):
         """
         Get the arguments passed to a job
         :return:
         """
-        cmd = f'SELECT args from param WHERE sim_id={self.sim_id}'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        return out[0][0]
+        return self.db_value('param_args', (self.sim_id, ))
 
     def get_base(self):
         """
         Get the arguments passed to a job
         :return:
         """
-        cmd = f'SELECT path from param WHERE sim_id={self.sim_id}'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        return out[0][0]
+        return self.db_value('param_path', (self.sim_id, ))
+
+    def get_executor(self):
+        """
+        Get the executor requested for the job (local, cluster or None if it should be determined automatically)
+        :return:
+        """
+        return self.db_value('param_executor', (self.sim_id, ))
+
+    def use_local(self):
+        """
+        Decide whether a g_submit stage should be run on this host instead of the cluster
+        Stages run locally if requested explicitly or, if no executor was requested,
+        if they request a walltime that is short enough and this host has enough idle cores.
+        The cores are busy with the stages already running on this host or the load of other processes,
+        whichever is higher. Must be called holding LOCAL_LOCK
+        :return:
+        """
+        if self.app != 'g_submit' or self.after:
+            return False
+        executor = self.get_executor()
+        if executor is not None:
+            return executor == 'local'
+        # Without -days/-hours g_submit requests its default walltime, which can be long
+        walltime = gsubmit_walltime(self.args)
+        if self.local_walltime <= 0 or walltime <= 0 or walltime > self.local_walltime:
+            return False
+        out = self.db_exec('job_info_local_running', (socket.gethostname(), ), fetch=True, commit=False)
+        if out is None:
+            return False
+        busy = max(out[0][0] * self.local_threads, os.getloadavg()[0])
+        return os.cpu_count() - busy >= self.local_threads
+
+    def predict_walltime(self):
+        """
+        Record the signature and requested walltime of a g_submit stage. If enabled, the requested walltime is
+        replaced by the walltime predicted from similar stages if that is shorter
+        :return:
+        """
+        mdp = self.depend_fout.get('MDP') if self.depend_fout else None
+        signature = stage_signature(self.args, mdp=mdp)
+        requested = gsubmit_walltime(self.args)
+        predicted = None
+        # Stages resubmitted after exceeding their walltime request the full walltime
+        resubmitted = self.db_value('sim_resubmits', (self.sim_id, )) > 0
+        if self.predict and requested > 0 and not resubmitted:
+            out = self.db_exec('walltime_history', (signature, self.predict_samples), fetch=True, commit=False)
+            hours = predict_hours([runtime for runtime, in out or []], margin=self.predict_margin)
+            if hours is not None and hours < requested:
+                self.args = walltime_args(self.args, hours)
+                predicted = gsubmit_walltime(self.args)
+                self.logger.info(f'Requesting a walltime of {predicted:g} h instead of {requested:g} h')
+        self.db_exec('walltime_insert', (self.sim_id, signature, requested, predicted), fetch=False, commit=True)
+
+    def reuse_grompp(self):
+        """
+        Copy the outputs of an earlier grompp stage with identical arguments and input files instead of running grompp
+        :return: True if all outputs were copied
+        """
+        if '-o' not in self.args:
+            return False
+        self.grompp_key = grompp_key(self.args)
+        if self.grompp_key is None:
+            return False
+        cached = GromppCache(self.db_exec, max_entries=self.grompp_cache).get(self.grompp_key)
+        if cached is None:
+            return False
+        outfiles = grompp_out(self.args, base=self.base, outfiles={})
+        if any([ft not in cached for ft in outfiles.keys()]):
+            return False
+        for ft, fn in outfiles.items():
+            copy_outfile(cached[ft], fn)
+        self.logger.info(f'Reused the grompp outputs {cached["TPR"]} for {self.sim_id}')
+        return True
+
+    def cache_grompp(self):
+        """
+        Add the outputs of a grompp stage to the cache
+        :return:
+        """
+        outfiles = grompp_out(self.args, base=self.base, outfiles={})
+        outfiles = {ft: fn for ft, fn in outfiles.items() if os.path.isfile(fn)}
+        if 'TPR' in outfiles:
+            GromppCache(self.db_exec, max_entries=self.grompp_cache).put(self.grompp_key, self.sim_id, outfiles)
 
     def get_dependency(self, sim_id):
         """
@@ -339,9 +1088,45 @@ class GMXSubmit(DatabaseWorker):
         :param sim_id: The simulation id
         :return:
         """
-        cmd = f'SELECT parent_id FROM sim WHERE id={sim_id};'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        return out[0][0]
+        return self.db_value('sim_parent_id', (sim_id, ))
+
+    def get_parents(self, sim_id):
+        """
+        Get the sim_ids of all parents in the order they were specified
+        Simulations registered before parents were recorded in sim_edge have at most the single parent in sim.parent_id
+        :param sim_id: The simulation id
+        :return: A list of sim_ids
+        """
+        out = self.db_fetch('sim_parents', (sim_id, ))
+        if len(out):
+            return [parent_id for parent_id, in out]
+        parent_id = self.get_dependency(sim_id=sim_id)
+        return [parent_id] if parent_id is not None else []
+
+    def get_parent_fout(self, k):
+        """
+        Get the output files of the k-th parent of this simulation
+        :param k:
+        :return: The outfile dictionary or None if there is no k-th parent
+        """
+        if k >= len(self.parents):
+            return
+        if k not in self.parents_fout:
+            self.parents_fout[k] = self.get_fout(self.parents[k])
+        return self.parents_fout[k]
+
+    @staticmethod
+    def split_inherited(ref):
+        """
+        Split a reference to an inherited file (without the depend key) into the parent index and the file type
+        "TPR" refers to the first parent, "1:TPR" to the second
+        :param ref:
+        :return: (parent index, file type)
+        """
+        k, sep, ft = ref.partition(':')
+        if sep and k.isdigit():
+            return int(k), ft
+        return 0, ref
 
     def get_fout(self, sim_id, depend_key='%'):
         """
@@ -351,25 +1136,24 @@ class GMXSubmit(DatabaseWorker):
         :param depend_key: Character indicating that the file is inherited from parent
         :return:
         """
-        cmd = f'SELECT files FROM fout WHERE sim_id={sim_id};'
-        out = self.db_exec(cmd, fetch=True, commit=False)
+        out = self.db_fetch('fout_files', (sim_id, ))
         if len(out) == 0:
             return {}
         else:
-            update = False
+            resolved = {}
             fout = out[0][0]
             for ft, fn in fout.items():
                 if fn[0] == depend_key:
                     # Get the sim_id of the parent
-                    parent_id = self.get_dependency(sim_id=sim_id)
-                    parent_fout = self.get_fout(sim_id=parent_id)
-                    fn = parent_fout.get(fn[1:])
+                    k, parent_ft = self.split_inherited(fn[1:])
+                    parents = self.get_parents(sim_id=sim_id)
+                    parent_fout = self.get_fout(sim_id=parents[k]) if k < len(parents) else {}
+                    fn = parent_fout.get(parent_ft)
                     fout[ft] = fn
-                    update = True
+                    resolved[ft] = fn
             # If we encounter a dependency update the database to prevent recursion madness
-            if update:
-                cmd = f'INSERT INTO fout(files) VALUES(\'{json.dumps(fout)}\') WHERE sim_id={sim_id};'
-                self.db_exec(cmd, fetch=False, commit=True)
+            if resolved:
+                self.db_write('fout_insert', (sim_id, json_param(resolved)))
             return fout
 
     def parse_args(self, raw_args, depend_key='%', base='./'):
@@ -380,25 +1164,26 @@ class GMXSubmit(DatabaseWorker):
         :param base:
         :return:
         """
-        file_args = {'g_submit': ('-s', '-cpi', '-ei', '-table', '-tabletf',
-                                  '-tablep', '-tableb', '-o', '-eo', '-deffnm'),
+        file_args = {'g_submit': GSUBMIT_FILE_ARGS,
                      'grompp': ('-f', '-c', '-r', '-rb', '-n', '-p', '-t', '-e',
                                 '-ref', '-po', '-pp', '-o', '-imd'),
                      'shell': ()}
         args = {}
         for kw, arg in raw_args.items():
             if isinstance(arg, str) and len(arg) > 0 and arg[0] == depend_key:
-                if self.depend_fout is not None:
+                k, ft = self.split_inherited(arg[1:])
+                parent_fout = self.get_parent_fout(k)
+                if parent_fout is not None:
 
-                    if arg[1:] not in self.depend_fout:
+                    if ft not in parent_fout:
                         self.logger.error(f'Simulation depends on output files: {kw}, but file type not found in '
-                                          f'outfiles: {self.depend_fout}')
+                                          f'outfiles of parent {k}: {parent_fout}')
                         return
                     else:
-                        args[kw] = self.depend_fout[arg[1:]]
+                        args[kw] = parent_fout[ft]
                 else:
-                    self.logger.error(f'Simulation depends on output files: {kw}, but no dependency outfiles found in '
-                                      f'database')
+                    self.logger.error(f'Simulation depends on output files: {kw}, but no outfiles of parent {k} found '
+                                      f'in database')
                     return
             else:
                 if kw in file_args[self.app]:
@@ -408,64 +1193,157 @@ class GMXSubmit(DatabaseWorker):
 
         return args
 
-    def set_fout(self, out):
+    def set_fout(self, out, auxfiles=None):
         """
         Get a dictionary containing all (potential) outfiles
         :param out: The stdout produced by the job, required to set JSCRIPTS & JLOGS
+        :param auxfiles: JSCRIPTS & JLOGS if they can not be determined from out (e.g. for array tasks)
         :return:
         """
         # Get user defined outfiles
-        outfiles = self.get_fout(self.sim_id)
+        outfiles = dict(self.fout)
 
         update_func = {'g_submit': gsubmit_out, 'grompp': grompp_out, 'shell': shell_out}[self.app]
 
-        outfiles = update_func(self.args, base=self.get_base(), outfiles=outfiles)
+        outfiles = update_func(self.args, base=self.base, outfiles=outfiles)
 
         # For g_submit we also need to get the jobscripts and joblogs (JSCRIPTS, JLOGS)
-        if self.app == 'g_submit':
+        if auxfiles is not None:
+            outfiles.update(auxfiles)
+        elif self.local:
+            outfiles.update(local_auxfiles(out))
+        elif self.app == 'g_submit':
             outfiles.update(gsubmit_auxfiles(out))
 
-        cmd = f'INSERT INTO fout(sim_id, files) VALUES({self.sim_id}, \'{json.dumps(outfiles)}\');'
-        self.db_exec(cmd, fetch=False, commit=True)
+        # Written right away, the outfiles must be known once the status is set (see set_status)
+        self.db_exec('fout_insert', (self.sim_id, json_param(outfiles)), fetch=False, commit=True)
         return
 
-    def set_status(self, stat_id):
+    def begin_submit(self, stat_id=1):
         """
-        Set simulation status
+        Flag the stage as being submitted (stat_id: 6, updating) if this daemon still owns it.
+        A daemon that lost its lease (e.g. the host was suspended) must not submit a stage another daemon claimed.
+        The claim of another daemon resets a stage that is being submitted by a daemon with an expired lease
+        (see sim_claim), set_status then refuses to record the jobs of this daemon
+        :param stat_id: Status the stage is submitted from, 1 (submitted) or 4 (depend) for chained stages
+        :return: True if this worker may submit the stage
+        """
+        out = self.db_exec('sim_begin_submit', (self.sim_id, self.worker_id, stat_id), fetch=True, commit=True)
+        if out is None:
+            self.logger.warning(f'Could not flag {self.sim_id} as being submitted, the database is not available')
+            return False
+        if len(out) == 0:
+            self.logger.warning(f'{self.sim_id} is not owned by this daemon in status {stat_id}, not submitting it')
+            return False
+        return True
+
+    def set_status(self, stat_id, jobs=(), executor='cluster'):
+        """
+        Set the status of the stage after it was submitted and record its jobs, unless this daemon lost the stage in
+        the meantime (see begin_submit). Written right away, the jobs of a stage must not be lost once submitted
         :param stat_id:
-        :return:
+        :param jobs: (job_id, task_id) of the jobs submitted for the stage, task_id is -1 for jobs that are not array
+                     tasks
+        :param executor: cluster or local
+        :return: True if the status was set
         """
-        cmd = f'UPDATE sim SET stat_id = {stat_id} WHERE id = {self.sim_id};'
-        self.db_exec(cmd, fetch=False, commit=True)
-        if int(stat_id) in (2, 3):  # Status: Complete/Running
+        host = socket.gethostname() if executor == 'local' else ''
+        job_ids, task_ids = [list(column) for column in zip(*jobs)] if len(jobs) else ([], [])
+        out = self.db_exec('sim_end_submit', (self.sim_id, stat_id, self.worker_id, job_ids, task_ids, executor, host),
+                           fetch=True, commit=True)
+        if not out:
+            self.logger.error(f'Could not set the stat_id of {self.sim_id} to {stat_id}, the stage is no longer owned '
+                              f'by this daemon or the database is not available')
+            return False
+        if int(stat_id) in (2, 3, 7):  # Status: Complete/Running/Verifying
             self.logger.debug(f'Updated stat_id for {self.sim_id} to: {stat_id}')
         else:
             self.logger.error(f'Updated stat_id for {self.sim_id} to: {stat_id}')
+        return True
+
+    def submit(self, submit_func):
+        """
+        Run or submit the stage, failed attempts are retried up to ntrials times
+        :param submit_func: One of the <app>_run functions (see utils.gmx)
+        :return: returncode, stdout of the last attempt
+        """
+        trials = 0
+        return_code, out = 0, ''
+        policy = RetryPolicy(base=5.)
+        while trials < self.ntrials:
+            # Do not submit to the cluster while the scheduler is failing, this does not count as a trial
+            if self.app == 'g_submit' and not self.local and SCHEDULER_BREAKER.is_open:
+                time.sleep(policy.delay(trials) + 1.)
+                continue
+            return_code, out = submit_func(self.args)
+            if return_code:
+                self.logger.warning(f'Failed to run {self.app} for sim_id: {self.sim_id}. Trial:: {trials + 1}/{self.ntrials}')
+                policy.sleep(trials)
+                trials += 1
+                continue
+            else:
+                break
+        return return_code, out
 
     def run(self):
+        try:
+            self.run_stage()
+        except DatabaseUnavailable as e:
+            # The stage is submitted again, DatabaseWorkerMain resets it once this worker exited
+            # (see sims_reset_submitting). All queries run before the stage is submitted
+            self.logger.warning(f'{e}, not submitting {self.sim_id}')
+            self.queue.put(self.sim_id)
+
+    def run_stage(self):
+        """
+        Run or submit the stage and record the result
+        :return:
+        """
+        # Chained stages are submitted while they wait for their parent (see Depend)
+        if not self.begin_submit(4 if self.after else 1):
+            self.queue.put(self.sim_id)
+            return
+        self.setup()
         self.logger.debug(f'Running {self.app} on {self.sim_id}')
 
         # Get arguments
         raw_args = self.get_args()
-        self.args = self.parse_args(raw_args, base=self.get_base())
+        self.args = self.parse_args(raw_args, base=self.base)
 
         if self.args is None:  # This can happen if a file dependency is not met
             self.set_status(0)
+            self.queue.put(self.sim_id)
+            return
+        if self.app == 'g_submit':
+            self.predict_walltime()
+        if self.app == 'grompp' and self.grompp_cache > 0 and self.reuse_grompp():
+            self.set_fout('')
+            self.set_status(7)  # Set status Verifying
+            self.queue.put(self.sim_id)
             return
         # What function to use for submitting the job
         submit_func = {'g_submit': gsubmit_run, 'grompp': grompp_run, 'shell': shell_run}[self.app]
-
-        trials = 0
-        return_code = 0  # Defined to turn of warning in pycharm
-        while trials < self.ntrials:
-            return_code, out = submit_func(self.args)
-            if return_code:
-                trials += 1
-                self.logger.warning(f'Failed to run {self.app} for sim_id: {self.sim_id}. Trial:: {trials}/{self.ntrials}')
-                time.sleep(5)
-                continue
-            else:
-                break
+        self.local = False
+        if self.after:
+            self.logger.debug(f'Submitting {self.sim_id} to wait for parent jobs: {self.after}')
+            return_code, out = self.submit(functools.partial(gsubmit_run, after=self.after))
+        elif self.app == 'g_submit':
+            with LOCAL_LOCK:
+                self.local = self.use_local()
+                if self.local:
+                    self.logger.debug(f'Running {self.sim_id} on this host')
+                    return_code, out = self.submit(functools.partial(local_run, nthreads=self.local_threads,
+                                                                     base=self.base))
+                    # Jobs run on this host are tracked like cluster jobs, but can only be monitored from this host.
+                    # They are recorded before the lock is released, so that the next stage counts them
+                    if not return_code:
+                        for job_id in local_job_ids(out):
+                            self.db_exec('job_info_insert', (self.sim_id, job_id, -1, 'local', socket.gethostname()),
+                                         fetch=False, commit=True)
+            if not self.local:
+                return_code, out = self.submit(submit_func)
+        else:
+            return_code, out = self.submit(submit_func)
 
         if return_code:
             self.logger.error(f'{self.app} returned error code {return_code}\n{out}')
@@ -474,35 +1352,301 @@ class GMXSubmit(DatabaseWorker):
             # Commit (preliminary) outfiles to database
             self.set_fout(out)
 
+            if self.local:
+                # Set status to Running, a job another daemon submits again must not run twice
+                if not self.set_status(2, executor='local'):
+                    job_ids = local_job_ids(out)
+                    self.logger.error(f'Killing local jobs {job_ids} of {self.sim_id}')
+                    cancel_jobs(job_ids, scheduler='Local')
+                    for job_id in job_ids:
+                        self.db_exec('job_info_delete_local', (self.sim_id, job_id, socket.gethostname()),
+                                     fetch=False, commit=True)
             # If jobs were submitted to the cluster add them to job_info
-            if self.app == 'g_submit':
+            elif self.app == 'g_submit':
                 # Get job ids
                 batch_ids = gsubmit_batch_ids(out)
-                for job_id in batch_ids:
-                    cmd = f'INSERT INTO job_info(sim_id, job_id) VALUES ({self.sim_id}, {job_id});'
-                    self.db_exec(cmd, fetch=False, commit=True)
-                self.set_status(2)  # Set status to Running
+                # Set status to Running, jobs that can not be recorded would be submitted a second time
+                if not self.set_status(2, jobs=[(job_id, -1) for job_id in batch_ids]):
+                    self.logger.error(f'Cancelling jobs {batch_ids} of {self.sim_id}')
+                    cancel_jobs(batch_ids)
             elif self.app in ('grompp', 'shell'):
-                self.set_status(3)  # Set status Complete
+                if self.grompp_key is not None:
+                    self.cache_grompp()
+                self.set_status(7)  # Set status Verifying
         # Send signal to head worker to garbage collect
         self.queue.put(self.sim_id)
         return
 
 
+class GMXArraySubmit(DatabaseWorker):
+    """
+    Submit several g_submit stages with identical resources as a single job array
+
+    Each stage becomes one array task running the equivalent gmx mdrun command.
+    The task ids are stored in job_info, so every stage is monitored individually
+    """
+    def __init__(self, dbname, user, password, host, port, sim_ids, queue, log_queue=None, directives=(),
+                 worker_id=None, write_behind=False):
+        """
+
+        :param dbname:
+        :param user:
+        :param password:
+        :param host:
+        :param port:
+        :param sim_ids: The stages to pack into one array, they must request identical resources
+        :param queue:
+        :param log_queue:
+        :param directives: Scheduler options for the jobscript, the resources requested by the stages
+                           (see utils.gmx.array_directives) and the options given to the daemon
+        :param worker_id: The daemon owning the stages, only stages still owned are submitted
+                          (see GMXSubmit.begin_submit)
+        :param write_behind: Resolved outfiles of parents are written by DatabaseWorkerMain
+                             (see DatabaseWorker.db_write)
+        """
+        super().__init__(dbname, user, password, host, port, log_queue, persistent=True,
+                         write_queue=queue if write_behind else None)
+        self.write_behind = write_behind
+        self.db_info = (dbname, user, password, host, port)
+        self.log_queue = log_queue
+        self.sim_ids = sim_ids
+        self.queue = queue
+        self.directives = directives
+        self.worker_id = worker_id
+
+    def run(self):
+        try:
+            self.submit_array()
+        except DatabaseUnavailable as e:
+            # Stages flagged as being submitted are reset by DatabaseWorkerMain once this worker exited
+            self.logger.warning(f'{e}, not submitting the job array for {self.sim_ids}')
+            for sim_id in self.sim_ids:
+                self.queue.put(sim_id)
+
+    def submit_array(self):
+        """
+        Submit the stages that are still owned by this daemon as one job array and record the array tasks
+        :return:
+        """
+        self.logger.debug(f'Packing {len(self.sim_ids)} stages into a job array')
+
+        # Resolve the arguments of each stage like GMXSubmit would
+        stages = []
+        for sim_id in self.sim_ids:
+            stage = GMXSubmit(*self.db_info, sim_id=sim_id, queue=self.queue, log_queue=self.log_queue,
+                              worker_id=self.worker_id, write_behind=self.write_behind)
+            if not stage.begin_submit():
+                self.queue.put(sim_id)
+                continue
+            stage.setup()
+            stage.args = stage.parse_args(stage.get_args(), base=stage.base)
+            if stage.args is None:  # This can happen if a file dependency is not met
+                stage.set_status(0)
+                self.queue.put(sim_id)
+            else:
+                # Runtimes of array tasks are recorded like those of individual stages (see utils.predict),
+                # all tasks of an array request the same walltime so no prediction is applied
+                stage.predict_walltime()
+                stages.append(stage)
+        if len(stages) == 0:
+            return
+
+        walltime = gsubmit_walltime(stages[0].args)
+        return_code, out = array_run([(stage.base, stage.args) for stage in stages], walltime,
+                                     directives=self.directives)
+        job_id = array_job_id(out)
+        if return_code or job_id is None:
+            self.logger.error(f'Failed to submit job array for {self.sim_ids}\n{out}')
+            for stage in stages:
+                stage.set_status(0)  # Set status: Failed
+        else:
+            self.logger.debug(f'Submitted job array {job_id} for {[stage.sim_id for stage in stages]}')
+            for task_id, stage in zip(array_task_ids(len(stages)), stages):
+                stage.set_fout(out, auxfiles=array_auxfiles(out, task_id))
+                # Set status to Running, tasks that can not be recorded would be submitted a second time
+                if not stage.set_status(2, jobs=[(job_id, task_id)]):
+                    self.logger.error(f'Cancelling array task {job_id}_{task_id} of {stage.sim_id}')
+                    cancel_jobs([f'{job_id}_{task_id}'])
+        # Send signal to head worker to garbage collect
+        for stage in stages:
+            self.queue.put(stage.sim_id)
+        return
+
+
+class Verify(DatabaseWorker):
+    """
+    Check the output files of all finished stages (stat_id: 7, verifying) in one batch
+
+    Every directory is listed once, no matter how many stages wrote to it,
+    and listings and stat calls run in a thread pool to hide the latency of slow (network) filesystems.
+    Stages with all output files are flagged complete, all others failed, before dependents are promoted
+    """
+    def __init__(self, dbname, user, password, host, port, queue, log_queue=None, nthreads=16, batch_size=1000,
+                 group='default'):
+        """
+
+        :param dbname:
+        :param user:
+        :param password:
+        :param host:
+        :param port:
+        :param queue:
+        :param log_queue:
+        :param nthreads: Number of threads used for filesystem calls
+        :param batch_size: Maximum number of stages checked at once
+        :param group: Only check stages of this group
+        """
+        super().__init__(dbname, user, password, host, port, log_queue=log_queue, persistent=True)
+        self.queue = queue
+        self.group = group
+        self.nthreads = nthreads
+        self.batch_size = batch_size
+
+    @staticmethod
+    def listdir(path):
+        """
+        List a directory, returns an empty set if the directory does not exist
+        :param path:
+        :return:
+        """
+        try:
+            return set(os.listdir(path))
+        except OSError:
+            return set()
+
+    @staticmethod
+    def is_empty(path):
+        """
+        Check if a file is empty
+        :param path:
+        :return:
+        """
+        try:
+            return os.stat(path).st_size == 0
+        except OSError:
+            return True
+
+    def run(self):
+        out = self.db_exec('fout_verifying', (self.batch_size, self.group), fetch=True, commit=False)
+        if out is None:
+            self.queue.put('verify')
+            return
+
+        expected = {}
+        for sim_id, app, files in out:
+            expected.setdefault(sim_id, []).extend(expected_outfiles(app, files if files is not None else {}))
+        dirs = list(set([os.path.dirname(fn) for files in expected.values() for fn in files]))
+
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            listings = dict(zip(dirs, pool.map(self.listdir, dirs)))
+            found = [fn for files in expected.values() for fn in files
+                     if os.path.basename(fn) in listings[os.path.dirname(fn)]]
+            empty = dict(zip(found, pool.map(self.is_empty, found)))
+
+        complete, failed = [], []
+        for sim_id, files in expected.items():
+            missing = [fn for fn in files if empty.get(fn, True)]
+            if len(missing):
+                self.logger.error(f'{sim_id} is missing output files: {missing}')
+                failed.append(sim_id)
+            else:
+                complete.append(sim_id)
+
+        for stat_id, sim_ids in ((3, complete), (0, failed)):
+            if len(sim_ids):
+                self.db_exec('sims_set_stat_id', (sim_ids, stat_id, 7), fetch=False, commit=True)
+        # Runtimes of completed g_submit stages are used to predict the walltime of similar stages
+        if len(complete):
+            self.db_exec('walltime_record', (complete, ), fetch=False, commit=True)
+            # Children waiting for these stages are submitted once all their parents completed
+            self.db_exec('sims_promote_ready', (complete, ), fetch=False, commit=True)
+        self.logger.debug(f'Verified output files; complete: {len(complete)} failed: {len(failed)}')
+        self.queue.put('verify')
+        return
+
+
+class Cleanup(DatabaseWorker):
+    """
+    Delete the jobscripts and logs (JSCRIPTS, JLOGS) of completed stages in one batch
+
+    Files are deleted in parallel with a bounded number of threads
+    and the outfiles of all stages are updated in a single statement
+    """
+    def __init__(self, dbname, user, password, host, port, queue, log_queue=None, nthreads=8, batch_size=1000,
+                 group='default'):
+        """
+
+        :param dbname:
+        :param user:
+        :param password:
+        :param host:
+        :param port:
+        :param queue:
+        :param log_queue:
+        :param nthreads: Maximum number of files deleted concurrently
+        :param batch_size: Maximum number of stages cleaned at once
+        :param group: Only clean stages of this group
+        """
+        super().__init__(dbname, user, password, host, port, log_queue=log_queue, persistent=True)
+        self.queue = queue
+        self.group = group
+        self.nthreads = nthreads
+        self.batch_size = batch_size
+
+    @staticmethod
+    def remove(path):
+        """
+        Remove a file
+        :param path:
+        :return: True if the file was removed
+        """
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def run(self):
+        out = self.db_exec('outfile_auxfiles', (self.batch_size, self.group), fetch=True, commit=False)
+        if not out:
+            self.queue.put('cleanup')
+            return
+
+        # Jobscripts can be shared, e.g. by the tasks of a job array
+        files = list(set([fn for _, fn in out]))
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            removed = list(pool.map(self.remove, files))
+        for fn, success in zip(files, removed):
+            if not success:
+                self.logger.warning(f'Cleanup could not remove: {fn}')
+
+        sim_ids = list(set([sim_id for sim_id, _ in out]))
+        self.db_exec('outfile_drop_auxfiles', (sim_ids, ), fetch=False, commit=True)
+        self.logger.debug(f'Removed {sum(removed)} jobscripts and logs')
+        self.queue.put('cleanup')
+        return
+
+
 class Depend(DatabaseWorker):
     """
     Similar to Monitor Running, but monitors a dependency.
 
     This worker is triggered by simulations with stat_id: 4 (depend)
-    The worrker will periodically query the database for the dependency.
+    The worrker will periodically query the database for the dependencies.
 
-    When the stat_id of the dependency changes to 3 (completed)
+    When the stat_id of all parents changed to 3 (completed)
     the worker will change the stat_id of the child simulation to 1 (submitted)
 
-    If the stat_id of the parent changes to 0 or 5 (failed, dependency failed)
+    If the stat_id of any parent changes to 0 or 5 (failed, dependency failed)
     the worker will change the stat_id of the child to 5 (dependency failed)
+
+    Verify promotes children whose parents all completed in one statement, the worker picks up the remaining cases.
+
+    If chain is set, a g_submit child of a single running g_submit parent is submitted right away.
+    The scheduler holds the child until the parent jobs complete successfully (see GMXSubmit)
     """
-    def __init__(self, dbname, user, password, host, port, sim_id, queue, interval=5, timeout=-1):
+    def __init__(self, dbname, user, password, host, port, sim_id, queue, interval=5, timeout=-1, log_queue=None,
+                 chain=False, worker_id=None, write_behind=False):
         """
 
         :param dbname:
@@ -514,19 +1658,28 @@ class Depend(DatabaseWorker):
         :param queue:
         :param interval:
         :param timeout:
+        :param log_queue:
+        :param chain: Submit g_submit children of running g_submit parents with a scheduler dependency
+        :param worker_id: The daemon owning the child, chained children are only submitted by their owner
+        :param write_behind: Status changes are written by DatabaseWorkerMain (see DatabaseWorker.db_write)
         """
-        super().__init__(dbname, user, password, host, port)
+        super().__init__(dbname, user, password, host, port, log_queue=log_queue,
+                         write_queue=queue if write_behind else None)
+        self.write_behind = write_behind
+        self.db_info = (dbname, user, password, host, port)
+        self.log_queue = log_queue
         self.sim_id = sim_id
         self.queue = queue
+        self.set_log_context(sim_id=sim_id)
         self.interval = interval
         self.timeout = timeout
-        # Get parent id
-        self.parent_id = self.get_parent_id()
+        self.chain = chain
+        self.worker_id = worker_id
+        # Set in run
+        self.parent_id = None
 
     def get_parent_id(self):
-        cmd = f'SELECT parent_id FROM sim WHERE id = {self.sim_id};'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        return out[0][0]
+        return self.db_value('sim_parent_id', (self.sim_id, ))
 
     def get_parent_stat_id(self, pid):
         """
@@ -534,30 +1687,83 @@ class Depend(DatabaseWorker):
         :param pid:
         :return:
         """
-        cmd = f'SELECT stat_id FROM sim WHERE id = {pid};'
-        out = self.db_exec(cmd, fetch=True, commit=False)
-        return out[0][0]
+        return self.db_value('sim_stat_id', (pid, ))
+
+    def get_parent_stats(self):
+        """
+        Get the number of parents, of failed parents and of parents that did not complete yet
+        :return:
+        """
+        nparents, nfailed, nwaiting = self.db_fetch('sim_parent_stats', (self.sim_id, ))[0]
+        if nparents == 0:
+            # Registered before parents were recorded in sim_edge
+            pstat_id = self.get_parent_stat_id(self.parent_id)
+            return 1, int(pstat_id in (0, 5)), int(pstat_id != 3)
+        return nparents, nfailed, nwaiting
+
+    def get_chain_jobs(self):
+        """
+        Get the job ids the child can be chained to with a scheduler dependency
+        Only g_submit stages submitted to the cluster can be chained (array tasks only on Slurm)
+        :return: A list of job ids or None if the child can not be chained
+        """
+        out = self.db_exec('param_cmd_executor', ([self.sim_id, self.parent_id], ), fetch=True, commit=False)
+        if out is None or len(out) != 2 or any([app != 'g_submit' or executor == 'local' for app, executor in out]):
+            return
+        out = self.db_exec('job_info_jobs', (self.parent_id, ), fetch=True, commit=False)
+        if out is None or len(out) == 0 or any([executor != 'cluster' for _, _, executor in out]):
+            return
+        if any([task_id >= 0 for _, task_id, _ in out]):
+            if get_scheduler() != 'Slurm':
+                return
+        return [job_id if task_id < 0 else f'{job_id}_{task_id}' for job_id, task_id, _ in out]
 
     def set_stat_id(self, stat_id):
         """
-        Set the stat_id of the child process
+        Set the stat_id of the child process, unless it is not waiting anymore (e.g. promoted by Verify)
         :param stat_id:
         :return:
         """
-        cmd = f'UPDATE sim SET stat_id={stat_id} WHERE id={self.sim_id}'
-        self.db_exec(cmd, fetch=False, commit=True)
+        self.db_write('sims_set_stat_id', ([self.sim_id], stat_id, 4))
 
     def run(self):
+        try:
+            self.wait_for_parents()
+        except DatabaseUnavailable as e:
+            # The sim is handled again by the next worker DatabaseWorkerMain launches
+            self.logger.warning(f'{e}, stopped waiting for the parents of {self.sim_id}')
+            self.queue.put(self.sim_id)
+
+    def wait_for_parents(self):
+        """
+        Poll the status of the parents until the child can be submitted or their failure is known
+        :return:
+        """
+        # Get parent id
+        self.parent_id = self.get_parent_id()
 
         t = time.time()
+        polled = False
         while self.timeout*(time.time()-t) < self.timeout**2:
-            pstat_id = self.get_parent_stat_id(self.parent_id)
-            if pstat_id in (0, 5):
+            nparents, nfailed, nwaiting = self.get_parent_stats()
+            if not polled:  # Report the end of the startup (see DatabaseWorkerMain.loop)
+                self.queue.put(('ready', self.sim_id))
+                polled = True
+            if nfailed > 0:
                 self.set_stat_id(5)  # Set depend_failed
                 break
-            if pstat_id == 3:  # Parent Completed
+            if nwaiting == 0:  # Parents Completed
                 self.set_stat_id(1)  # Set submitted
                 break
+            if nparents == 1 and self.chain and self.get_parent_stat_id(self.parent_id) == 2:  # Parent Running
+                after = self.get_chain_jobs()
+                if after is not None:
+                    # GMXSubmit sets the status and signals the Head Worker
+                    stage = GMXSubmit(*self.db_info, sim_id=self.sim_id, queue=self.queue, log_queue=self.log_queue,
+                                      ntrials=3, after=after, worker_id=self.worker_id,
+                                      write_behind=self.write_behind)
+                    stage.run()
+                    return
             time.sleep(self.interval)
         # Send signal to Head Worker to garbage collect and exit
         self.queue.put(self.sim_id)
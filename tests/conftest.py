@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Modules are imported relative to the repository root, the wrappers in bin add it to PYTHONPATH.
+# The scripts in bin are imported like python imports them when they are run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
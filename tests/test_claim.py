@@ -0,0 +1,45 @@
+import multiprocessing
+
+import pytest
+
+import db_worker
+
+
+@pytest.fixture
+def main(monkeypatch):
+    """
+    A DatabaseWorkerMain on a host with 16 cores running 4 threads per local stage
+    """
+    worker = db_worker.DatabaseWorkerMain('gmx', 'user', '', 'localhost', 9987, stop_event=multiprocessing.Event(),
+                                          max_workers=100, local_threads=4)
+    monkeypatch.setattr(db_worker.os, 'cpu_count', lambda: 16)
+    return worker
+
+
+def running_locally(main, monkeypatch, n_local):
+    def db_exec(cmd, params=(), fetch=True, commit=False, **kwargs):
+        assert cmd == 'job_info_local_running'
+        return [(n_local, )]
+    monkeypatch.setattr(main, 'db_exec', db_exec)
+
+
+def test_free_capacity_subtracts_owned_sims_once(main, monkeypatch):
+    # Owned sims include those being submitted, active GMXSubmit workers are not subtracted again
+    running_locally(main, monkeypatch, 0)
+    main.n_owned = 30
+    assert main.free_capacity() == 70
+
+
+def test_free_capacity_is_scaled_by_idle_cores(main, monkeypatch):
+    # Two local stages (also owned) use 8 of 16 cores
+    running_locally(main, monkeypatch, 2)
+    main.n_owned = 30
+    assert main.free_capacity() == 35
+
+
+def test_free_capacity_is_never_negative(main, monkeypatch):
+    running_locally(main, monkeypatch, 5)
+    main.n_owned = 120
+    assert main.free_capacity() == 0
+    main.n_owned = 0
+    assert main.free_capacity() == 0
@@ -0,0 +1,117 @@
+import os
+import time
+
+import utils.gmx
+from utils.gmx import local_run, local_job_ids, array_directives, array_jobscript
+
+# Writes the default outputs of mdrun, and the file passed with -c, to the working directory
+FAKE_GMX = """#!/bin/sh
+touch confout.gro md.log ener.edr
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-c" ]; then
+        touch "$2"
+    fi
+    shift
+done
+"""
+
+
+def wait_for(path, timeout=30.):
+    start = time.time()
+    while not os.path.isfile(path):
+        assert time.time() - start < timeout, f'{path} was not written'
+        time.sleep(0.05)
+
+
+def test_local_run_writes_outputs_to_base(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    gmx = bin_dir / 'gmx'
+    gmx.write_text(FAKE_GMX)
+    gmx.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    job_dir = tmp_path / 'jobs'
+    monkeypatch.setattr(utils.gmx, 'LOCAL_JOB_DIR', str(job_dir))
+    base = tmp_path / 'stage 1'
+    base.mkdir()
+    cwd = tmp_path / 'daemon'
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+
+    return_code, out = local_run({'-s': str(base / 'topol.tpr'), '-c': 'npt.gro', '-hours': 1}, nthreads=1,
+                                 base=str(base))
+    assert return_code == 0
+    job_id, = local_job_ids(out)
+    wait_for(str(job_dir / f'{job_id}.exit'))
+    assert (job_dir / f'{job_id}.exit').read_text().strip() == '0'
+    assert sorted(os.listdir(base)) == ['confout.gro', 'ener.edr', 'md.log', 'npt.gro']
+    assert os.listdir(cwd) == []
+
+
+def test_array_directives_request_the_resources_of_the_stage():
+    args = {'-s': '%TPR', '-hours': 2, '-cpus': 8, '-gpus': 1, '-partition': 'short', '-nomail': '', '-v': ''}
+    assert array_directives(args, 'Slurm') == ['--cpus-per-task=8', '--gpus=1', '--partition=short']
+    assert array_directives(args, 'SGE') == ['-pe smp 8', '-l gpu=1', '-q short']
+
+
+def test_array_directives_use_the_threads_of_mdrun():
+    assert array_directives({'-s': 'topol.tpr', '-days': 1, '-nt': 4}, 'Slurm') == ['--cpus-per-task=4']
+
+
+def test_stages_without_walltime_or_cores_are_not_packed():
+    assert array_directives({'-s': 'topol.tpr', '-cpus': 8}, 'Slurm') is None
+    assert array_directives({'-s': 'topol.tpr', '-hours': 2}, 'Slurm') is None
+    # Resources that can not be translated are determined by g_submit
+    assert array_directives({'-s': 'topol.tpr', '-hours': 2, '-cpus': 8, '-ntasks': 2}, 'SGE') is None
+    assert array_directives({'-s': 'topol.tpr', '-hours': 2, '-cpus': 8, '-unknown': 1}, 'Slurm') is None
+    assert array_directives({'-hours': 2, '-cpus': 8, '-partition': 'short\n#SBATCH --x'}, 'Slurm') is None
+
+
+def test_array_jobscript_header(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tasks = [('/a', {'-s': '/a/topol.tpr', '-hours': 1.5, '-cpus': 8}), ('/b', {'-s': '/b/topol.tpr', '-hours': 1.5})]
+    jobscript = array_jobscript(tasks, 'Slurm', 1.5, directives=array_directives(tasks[0][1], 'Slurm'))
+    with open(jobscript, 'r') as fh:
+        lines = fh.read().split('\n')
+    assert '#SBATCH --array=0-1' in lines
+    assert '#SBATCH --time=01:30:00' in lines
+    assert '#SBATCH --cpus-per-task=8' in lines
+
+
+def sge(tmp_path, monkeypatch, gsubmit):
+    """
+    Fake qsub (recording its arguments) and g_submit on SGE
+    :param gsubmit: Body of the g_submit script, $QSUB is the path of the fake qsub
+    :return: The file the arguments of qsub are written to
+    """
+    bin_dir = tmp_path / 'sge'
+    bin_dir.mkdir()
+    qsub_args = tmp_path / 'qsub_args'
+    qsub = bin_dir / 'qsub'
+    qsub.write_text(f'#!/bin/sh\necho "$@" > {qsub_args}\necho \'Your job 123 ("md") has been submitted\'\n')
+    qsub.chmod(0o755)
+    g_submit = tmp_path / 'g_submit'
+    g_submit.write_text(f'#!/bin/sh\nQSUB={qsub}\n{gsubmit}\n')
+    g_submit.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setattr(utils.gmx, 'GSUBMIT_BIN', str(g_submit))
+    monkeypatch.setattr(utils.gmx, 'get_scheduler', lambda: 'SGE')
+    return qsub_args
+
+
+def test_chained_sge_jobs_are_submitted_on_hold(tmp_path, monkeypatch):
+    qsub_args = sge(tmp_path, monkeypatch, 'qsub job.sh')
+    return_code, out = utils.gmx.gsubmit_run({'-s': 'topol.tpr'}, after=[7, 8])
+    assert return_code == 0
+    assert utils.gmx.gsubmit_batch_ids(out) == [123]
+    assert qsub_args.read_text().split() == ['-hold_jid', '7,8', 'job.sh']
+
+
+def test_chained_sge_jobs_are_cancelled_if_the_hold_was_bypassed(tmp_path, monkeypatch):
+    qsub_args = sge(tmp_path, monkeypatch, '$QSUB job.sh')
+    cancelled = []
+    monkeypatch.setattr(utils.gmx, 'cancel_jobs', lambda job_ids, scheduler=None: cancelled.extend(job_ids))
+    return_code, out = utils.gmx.gsubmit_run({'-s': 'topol.tpr'}, after=[7])
+    assert return_code != 0
+    assert qsub_args.read_text().split() == ['job.sh']
+    assert cancelled == [123]
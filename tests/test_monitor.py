@@ -0,0 +1,48 @@
+import types
+import logging
+import multiprocessing
+
+import pytest
+
+import db_worker
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    """
+    A Monitor of a timed out g_submit stage with a checkpoint, owned by daemon 1 unless the test changes the owner
+    """
+    worker = db_worker.Monitor('gmx', 'user', '', 'localhost', 9987, sim_id=5, queue=multiprocessing.Queue(),
+                               worker_id=1)
+    worker.logger = logging.getLogger('test_monitor')
+    worker.js = types.SimpleNamespace(job_ids=[11])
+    worker.owner = 1
+    worker.calls = []
+    cancelled = []
+
+    def db_exec(cmd, params=(), fetch=True, commit=False, **kwargs):
+        worker.calls.append(cmd)
+        if cmd == 'sim_resubmit':
+            return [(5, )] if params[1] == worker.owner else []
+        return {'param_cmd': [('g_submit', )],
+                'sim_resubmits': [(0, )],
+                'fout_files': [({'CPT': '/a/state.cpt'}, )],
+                'sim_reset_chained': []}[cmd]
+    monkeypatch.setattr(worker, 'db_exec', db_exec)
+    monkeypatch.setattr(db_worker, 'cancel_jobs', lambda job_ids, scheduler=None: cancelled.extend(job_ids))
+    worker.cancelled = cancelled
+    return worker
+
+
+def test_owner_resubmits_the_stage(monitor):
+    assert monitor.resubmit() is True
+    assert monitor.cancelled == [11]
+    assert 'sim_reset_chained' in monitor.calls
+
+
+def test_stage_of_another_daemon_is_not_resubmitted(monitor):
+    monitor.owner = 2
+    assert monitor.resubmit() is None
+    # Neither the jobs nor the chained children of the stage are touched
+    assert monitor.cancelled == []
+    assert 'sim_reset_chained' not in monitor.calls
@@ -0,0 +1,19 @@
+import datetime
+
+import gmxdb
+import utils.report
+from utils.report import status_summary
+
+ROWS = {'counts_status': [('running', 3), ('complete', 5)],
+        'counts_cmd': [('g_submit', 8)],
+        'counts_base': [('/a', 8)],
+        'sim_oldest_waiting': [(4, 1, datetime.datetime(2024, 1, 2, 3, 4, 5))],
+        'budget_status': [('scheduler', 12.5, 50., 7)]}
+
+
+def test_status_summary_reports_exhausted_budgets(monkeypatch):
+    monkeypatch.setattr(utils.report, 'execute_query', lambda conn, name, *args, **kwargs: ROWS[name])
+    summary = status_summary(None)
+    assert summary['budget'] == {'scheduler': (12.5, 50., 7)}
+    lines = gmxdb.format_summary(summary).split('\n')
+    assert lines[-2:] == ['scheduler budget', '  scheduler          12.5/50     exhausted          7']
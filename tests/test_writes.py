@@ -0,0 +1,349 @@
+import os
+import json
+import signal
+import logging
+import multiprocessing
+
+import psycopg2
+import pytest
+
+import db_worker
+from utils.queries import json_param
+from utils.retry import CircuitBreaker
+from utils.writes import WriteBuffer, batch_statements
+
+
+def connection_error():
+    # execute_query wraps the error of the driver (see utils.db.is_connection_error)
+    return RuntimeError('Failed to run query\n', psycopg2.OperationalError('server closed the connection'))
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, cmd, params=None):
+        self.conn.execute(cmd)
+
+
+class FakeConnection(object):
+    """
+    Records the statements of a transaction, they are applied to committed once COMMIT is executed.
+    Statements outside of a transaction are applied right away (autocommit, like the connection of
+    DatabaseWorkerMain)
+    """
+    def __init__(self):
+        self.committed = []
+        self.pending = None
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def execute(self, cmd):
+        if cmd == 'BEGIN':
+            self.pending = []
+        elif cmd == 'COMMIT':
+            self.committed.extend(self.pending)
+            self.pending = None
+
+    def statement(self, name, params):
+        if self.pending is None:
+            self.committed.append((name, params))
+        else:
+            self.pending.append((name, params))
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def main(monkeypatch):
+    """
+    A DatabaseWorkerMain that flushes to a FakeConnection, execute_query can be replaced by the test
+    """
+    breaker = CircuitBreaker('database', threshold=1)
+    monkeypatch.setattr(db_worker, 'DB_BREAKER', breaker)
+    worker = db_worker.DatabaseWorkerMain('gmx', 'user', '', 'localhost', 9987, stop_event=multiprocessing.Event(),
+                                          flush_interval=0.2, flush_records=500)
+    worker.logger = logging.getLogger('test_writes')
+    worker.conn = FakeConnection()
+
+    def close_connection():
+        # The open transaction is discarded with the connection
+        worker.conn.pending = None
+    monkeypatch.setattr(worker, 'get_connection', lambda: worker.conn)
+    monkeypatch.setattr(worker, 'close_connection', close_connection)
+
+    def execute_query(conn, name, params=(), fetch=True, commit=False, prepared=None):
+        conn.statement(name, params)
+    monkeypatch.setattr(db_worker, 'execute_query', execute_query)
+    return worker
+
+
+def fail_on(monkeypatch, errors):
+    """
+    Replace execute_query by a function that raises errors[name] for statements in errors
+    :param monkeypatch:
+    :param errors: {statement name: exception}
+    :return: A list of all statements passed to execute_query
+    """
+    calls = []
+
+    def execute_query(conn, name, params=(), fetch=True, commit=False, prepared=None):
+        calls.append((name, params))
+        if name in errors:
+            raise errors[name]
+        conn.statement(name, params)
+    monkeypatch.setattr(db_worker, 'execute_query', execute_query)
+    return calls
+
+
+RECORDS = [('sim_set_stat_id', (1, 2)),
+           ('fout_insert', (1, json_param({'TPR': '/a/topol.tpr'}))),
+           ('job_info_insert', (1, 11, -1, 'cluster', '')),
+           ('sims_set_stat_id', ([2], 7, 2))]
+
+
+# batch_statements
+
+def test_status_changes_of_a_sim_are_applied_in_order():
+    records = [('sim_set_stat_id', (1, 2)),
+               ('sims_set_stat_id', ([1, 2], 7, 2)),
+               ('sim_set_stat_id', (1, 3))]
+    statements = batch_statements(records)
+    assert statements == [('sims_set_stat_ids', ([1, 2], [2, 7], [None, 2])),
+                          ('sims_set_stat_ids', ([1], [7], [2])),
+                          ('sims_set_stat_ids', ([1], [3], [None]))]
+
+
+def test_status_changes_keep_the_expected_status():
+    statements = batch_statements([('sims_set_stat_id', ([5, 6], 0, 2)), ('sim_set_stat_id', (7, 1))])
+    assert statements == [('sims_set_stat_ids', ([5, 6, 7], [0, 0, 1], [2, 2, None]))]
+
+
+def test_outfiles_of_a_sim_are_merged():
+    records = [('fout_insert', (1, json_param({'TPR': '/a/topol.tpr', 'LOG': '/a/md.log'}))),
+               ('fout_insert', (2, json_param({'TPR': '/b/topol.tpr'}))),
+               ('fout_insert', (1, json_param({'LOG': '/a/md2.log', 'CPT': '/a/state.cpt'})))]
+    (name, (sim_ids, files)), = batch_statements(records)
+    assert name == 'fout_insert_many'
+    assert sim_ids == [1, 2]
+    assert [f.adapted for f in files] == [{'TPR': '/a/topol.tpr', 'LOG': '/a/md2.log', 'CPT': '/a/state.cpt'},
+                                          {'TPR': '/b/topol.tpr'}]
+
+
+def test_jobs_and_outfiles_are_written_before_status_changes():
+    statements = batch_statements(RECORDS)
+    assert [name for name, _ in statements] == ['job_info_insert_many', 'fout_insert_many', 'sims_set_stat_ids']
+    assert statements[0][1] == ([1], [11], [-1], ['cluster'], [''])
+
+
+# WriteBuffer
+
+def test_buffer_is_due_after_max_records():
+    buffer = WriteBuffer(max_records=2, max_age=60.)
+    assert not buffer.due()
+    buffer.add('sim_set_stat_id', (1, 2))
+    assert not buffer.due()
+    buffer.add('sim_set_stat_id', (2, 2))
+    assert buffer.due()
+
+
+def test_buffer_is_due_after_max_age(monkeypatch):
+    buffer = WriteBuffer(max_records=100, max_age=0.2)
+    monkeypatch.setattr('utils.writes.time.time', lambda: 100.)
+    buffer.add('sim_set_stat_id', (1, 2))
+    assert not buffer.due()
+    monkeypatch.setattr('utils.writes.time.time', lambda: 100.2)
+    assert buffer.due()
+
+
+def test_buffer_rejects_other_statements():
+    with pytest.raises(ValueError):
+        WriteBuffer().add('sim_claim', (1, 'host', 10, 'default'))
+
+
+def test_take_and_restore_keep_the_order():
+    buffer = WriteBuffer()
+    buffer.add('sim_set_stat_id', (1, 2))
+    buffer.add('sim_set_stat_id', (2, 2))
+    records = buffer.take()
+    assert len(buffer) == 0 and not buffer.due()
+    buffer.add('sim_set_stat_id', (3, 2))
+    buffer.restore(records)
+    assert buffer.records == [('sim_set_stat_id', (1, 2)), ('sim_set_stat_id', (2, 2)), ('sim_set_stat_id', (3, 2))]
+
+
+# DatabaseWorkerMain.flush
+
+def test_flush_writes_one_transaction(main):
+    for name, params in RECORDS:
+        main.writes.add(name, params)
+    assert main.flush()
+    assert len(main.writes) == 0
+    assert [name for name, _ in main.conn.committed] == [name for name, _ in batch_statements(RECORDS)]
+
+
+def test_flush_keeps_records_while_the_circuit_is_open(main, monkeypatch):
+    calls = fail_on(monkeypatch, {})
+    db_worker.DB_BREAKER.failure()
+    for name, params in RECORDS:
+        main.writes.add(name, params)
+    assert not main.flush()
+    assert calls == []
+    assert main.writes.records == RECORDS
+
+
+def test_flush_keeps_records_on_connection_errors(main, monkeypatch):
+    fail_on(monkeypatch, {'fout_insert_many': connection_error()})
+    for name, params in RECORDS:
+        main.writes.add(name, params)
+    main.writes.add('sim_set_stat_id', (3, 0))
+    assert not main.flush()
+    assert main.writes.records[:len(RECORDS)] == RECORDS
+    assert main.conn.committed == []
+    assert db_worker.DB_BREAKER.is_open
+
+
+def test_rejected_batch_is_written_one_by_one(main, monkeypatch):
+    rejected = RuntimeError('Failed to run query\n', psycopg2.IntegrityError('violates foreign key constraint'))
+    calls = fail_on(monkeypatch, {'job_info_insert_many': rejected, 'job_info_insert': rejected})
+    for name, params in RECORDS:
+        main.writes.add(name, params)
+    assert main.flush()
+    assert len(main.writes) == 0
+    # The records are written in the order they were received, the rejected job is dropped
+    assert calls[1:] == RECORDS
+    assert main.conn.committed == [record for record in RECORDS if record[0] != 'job_info_insert']
+    assert not db_worker.DB_BREAKER.is_open
+
+
+def test_partial_failure_keeps_the_remaining_records(main, monkeypatch):
+    rejected = RuntimeError('Failed to run query\n', psycopg2.IntegrityError('violates foreign key constraint'))
+    fail_on(monkeypatch, {'job_info_insert_many': rejected, 'job_info_insert': connection_error()})
+    for name, params in RECORDS:
+        main.writes.add(name, params)
+    assert not main.flush()
+    # Records before the failed one were written, the failed one and all later ones are kept
+    assert main.conn.committed == RECORDS[:2]
+    assert main.writes.records == RECORDS[2:]
+
+
+class RecordingConnection(FakeConnection):
+    """
+    A FakeConnection that writes the state of the fake database to path after every change, so that it survives the
+    process
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.dump()
+
+    def dump(self):
+        with open(self.path, 'w') as fh:
+            json.dump({'committed': self.committed, 'pending': self.pending}, fh)
+
+    def execute(self, cmd):
+        super().execute(cmd)
+        self.dump()
+
+    def statement(self, name, params):
+        super().statement(name, params)
+        self.dump()
+
+
+def crashing_main(conn, **kwargs):
+    worker = db_worker.DatabaseWorkerMain('gmx', 'user', '', 'localhost', 9987, stop_event=multiprocessing.Event(),
+                                          **kwargs)
+    worker.logger = logging.getLogger('test_writes')
+    worker.get_connection = lambda: conn
+    db_worker.DB_BREAKER = CircuitBreaker('database')
+    db_worker.execute_query = lambda c, name, params=(), **kw: c.statement(name, params)
+    return worker
+
+
+def crash_on_commit(path):
+    """
+    Flush two records and kill the process once the transaction is about to be committed
+    The state of the fake database is written to path on every change
+    :param path:
+    :return:
+    """
+    class Connection(RecordingConnection):
+        def execute(self, cmd):
+            if cmd == 'COMMIT':
+                os.kill(os.getpid(), signal.SIGKILL)
+            super().execute(cmd)
+
+    worker = crashing_main(Connection(path))
+    worker.writes.add('sim_set_stat_id', (1, 3))
+    worker.writes.add('sim_set_stat_id', (2, 3))
+    worker.flush()
+
+
+def test_crash_before_commit_loses_the_buffered_records(tmp_path):
+    """
+    utils.writes: if the daemon crashes, the buffered records are lost and the sims keep their previous status
+    """
+    path = str(tmp_path / 'db.json')
+    process = multiprocessing.get_context('fork').Process(target=crash_on_commit, args=(path, ))
+    process.start()
+    process.join(30)
+    assert process.exitcode == -signal.SIGKILL
+    with open(path, 'r') as fh:
+        state = json.load(fh)
+    # The statement was sent within the transaction, nothing was committed
+    assert [name for name, _ in state['pending']] == ['sims_set_stat_ids']
+    assert state['committed'] == []
+
+
+def put_records(queue, records):
+    for name, params in records:
+        queue.put(('write', name, params))
+
+
+def crash_before_drain(path):
+    """
+    Receive records of one worker into the buffer, let a second worker put records on the queue, and kill the process
+    before the buffer is flushed or the queue is drained. The number of buffered records is written to <path>.buffered
+    :param path:
+    :return:
+    """
+    worker = crashing_main(RecordingConnection(path), flush_interval=60., flush_records=500)
+    context = multiprocessing.get_context('fork')
+    writer = context.Process(target=put_records, args=(worker.queue, RECORDS[:2]))
+    writer.start()
+    writer.join()
+    while len(worker.writes) < 2:
+        worker.receive({}, timeout=0.1)
+    # The records of the second worker are in the queue, but not received
+    writer = context.Process(target=put_records, args=(worker.queue, RECORDS[2:]))
+    writer.start()
+    writer.join()
+    with open(f'{path}.buffered', 'w') as fh:
+        fh.write(str(len(worker.writes)))
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_crash_before_drain_loses_buffered_and_queued_records(tmp_path):
+    """
+    utils.writes: records received into the buffer and records still in the queue are both lost with the daemon
+    """
+    path = str(tmp_path / 'db.json')
+    process = multiprocessing.get_context('fork').Process(target=crash_before_drain, args=(path, ))
+    process.start()
+    process.join(30)
+    assert process.exitcode == -signal.SIGKILL
+    with open(f'{path}.buffered', 'r') as fh:
+        assert int(fh.read()) == 2
+    with open(path, 'r') as fh:
+        state = json.load(fh)
+    # Neither the buffered nor the queued records reached the database
+    assert state == {'committed': [], 'pending': None}
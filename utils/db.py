@@ -1,6 +1,16 @@
+import os
+import getpass
+
 import psycopg2
 
 
+class DatabaseUnavailable(RuntimeError):
+    """
+    Raised by workers if a query failed after all retries or was not run because the circuit breaker is open
+    """
+    pass
+
+
 def connect(dbname, user, password, host='localhost', port=5487):
     """
     Connect to postgresql database
@@ -22,6 +32,67 @@ def connect(dbname, user, password, host='localhost', port=5487):
         raise RuntimeError(f'Failed to connect to database {dbname}\n', e)
 
 
+def add_db_args(parser):
+    """
+    Add the arguments of a database connection (see get_password) to an argument parser
+    :param parser:
+    :return:
+    """
+    parser.add_argument('-d',
+                        '--dbname',
+                        type=str,
+                        default='gmx',
+                        help='database name to connect to'
+                        )
+    parser.add_argument('-U',
+                        '--user',
+                        type=str,
+                        default=getpass.getuser(),
+                        help='database user name')
+    parser.add_argument('-W',
+                        '--password',
+                        type=str,
+                        default=None,
+                        help='database password, will open password prompt if left blank')
+    parser.add_argument('--host',
+                        type=str,
+                        default='localhost',
+                        help='database server host or socket directory')
+    parser.add_argument('-p',
+                        '--port',
+                        type=int,
+                        default=9987,
+                        help='database server port')
+
+
+def get_password(args):
+    """
+    Get the database password from the arguments, a file containing it or a prompt
+    :param args: Parsed arguments, see add_db_args
+    :return:
+    """
+    if args.password is None:
+        password = getpass.getpass()
+    elif os.path.isfile(args.password):
+        with open(args.password, 'r') as fh:
+            password = fh.readline().rstrip('\n')
+    else:
+        password = args.password
+    return password
+
+
+def is_connection_error(e):
+    """
+    Check if an exception (or the exception it wraps, see connect and execute_cmd) was caused by the connection to
+    the database rather than by the query
+    :param e:
+    :return:
+    """
+    errors = [e] + [arg for arg in e.args if isinstance(arg, Exception)]
+    return any([isinstance(err, (psycopg2.OperationalError, psycopg2.InterfaceError)) and
+                not isinstance(err, psycopg2.extensions.TransactionRollbackError) for err in errors])
+
+
 def close(conn):
     """
     Close connection intended to be used as an atexit function
@@ -31,19 +102,20 @@ def close(conn):
     conn.close()
 
 
-def execute_cmd(conn, cmd, fetch=True, commit=False):
+def execute_cmd(conn, cmd, fetch=True, commit=False, params=None):
     """
     Execute a postgresql command and return output
     :param conn:
     :param cmd:
     :param fetch: Fetch results (default yes)
     :param commit: Commit after executing command
+    :param params: Parameters bound to %s placeholders in cmd
     :return:
     """
 
     with conn.cursor() as cursor:
         try:
-            cursor.execute(cmd)
+            cursor.execute(cmd, params)
         except Exception as e:
             raise RuntimeError(f'Failed to run cmd: {cmd}\n', e)
         if commit:
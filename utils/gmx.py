@@ -1,14 +1,51 @@
 import os
 import re
+import shlex
+import shutil
+import socket
+import tempfile
 import subprocess
 
-from subprocess import PIPE
+from subprocess import PIPE, DEVNULL
 
-from utils.hpcc import get_scheduler
+from utils.hpcc import get_scheduler, cancel_jobs, LOCAL_JOB_DIR
 
 # TODO This should at some point be moved to a separate settings file
 GSUBMIT_BIN = '/usr/local/bin/g_submit'
 
+# gmx mdrun options, all other g_submit arguments only concern the queueing system and are dropped when a stage is
+# run as mdrun (locally or as an array task)
+MDRUN_ARGS = ('-s', '-cpi', '-table', '-tabletf', '-tablep', '-tableb', '-rerun', '-ei', '-multidir', '-awh', '-membed',
+              '-mp', '-mn', '-o', '-x', '-cpo', '-c', '-e', '-g', '-dhdl', '-field', '-tpi', '-tpid', '-eo', '-px', '-pf',
+              '-ro', '-ra', '-rs', '-rt', '-mtx', '-if', '-swap', '-deffnm', '-xvg', '-dd', '-ddorder', '-npme', '-nt',
+              '-ntmpi', '-ntomp', '-ntomp_pme', '-pin', '-pinoffset', '-pinstride', '-gpu_id', '-gputasks', '-rdd',
+              '-rcon', '-dlb', '-dds', '-nb', '-nstlist', '-pme', '-pmefft', '-bonded', '-update', '-pforce', '-cpt',
+              '-nsteps', '-maxh', '-replex', '-nex', '-reseed', '-resetstep')
+# Boolean mdrun options, they can also be negated with -no<option>
+MDRUN_FLAGS = ('-v', '-ddcheck', '-tunepme', '-reprod', '-cpnum', '-append', '-resethway', '-confout')
+
+# Output files that must exist once a stage completed, None requires all user defined outfiles
+REQUIRED_OUTFILES = {'g_submit': ('GRO', 'LOG', 'EDR'),
+                     'grompp': ('TPR', 'MDP', 'TOP', 'GRO'),
+                     'shell': None}
+
+# g_submit arguments that are files, all other arguments determine the resources of a job
+GSUBMIT_FILE_ARGS = ('-s', '-cpi', '-ei', '-table', '-tabletf', '-tablep', '-tableb', '-o', '-eo', '-deffnm')
+# g_submit arguments that neither are mdrun options nor change the resources of a job
+GSUBMIT_NOTIFY_ARGS = ('-nomail', )
+
+# g_submit resource options and the equivalent directives of a job array (see array_directives)
+ARRAY_RESOURCES = {'Slurm': {'-nodes': '--nodes={}',
+                             '-ntasks': '--ntasks={}',
+                             '-cpus': '--cpus-per-task={}',
+                             '-gpus': '--gpus={}',
+                             '-partition': '--partition={}',
+                             '-mem': '--mem={}'},
+                   'SGE': {'-cpus': '-pe smp {}',
+                           '-gpus': '-l gpu={}',
+                           '-partition': '-q {}',
+                           '-mem': '-l h_vmem={}'}}
+
 _description = """
 Funcions dealing with gromacs/g_submit jobs.
 
@@ -20,6 +57,13 @@ The <app>_out functions return a dictionary of expected outfiles
 
 gsubnmit_batchids will return all jobids associated with a specific g_submit run
 gsubmit_auxfiles will return all jobscripts and logs associated with a specific g_submit run
+
+local_run runs the mdrun equivalent of a g_submit stage on the current host,
+local_job_ids and local_auxfiles are the local counterparts of gsubmit_batch_ids and gsubmit_auxfiles
+
+array_run submits the mdrun equivalent of several g_submit stages with identical resources as a single job array,
+array_directives translates the resources of a stage into the directives of the array,
+array_job_id, array_task_ids and array_auxfiles are the array counterparts of gsubmit_batch_ids and gsubmit_auxfiles
 """
 
 
@@ -107,21 +151,66 @@ def gsubmit_batch_ids(out):
         return batch_ids
 
 
-def gsubmit_run(args):
+def _sge_hold_shim(path, after):
+    """
+    Write a qsub that submits jobs on hold until the jobs in after completed, g_submit finds it first on PATH
+    qsub has no environment variable like SBATCH_DEPENDENCY, a hold applied after submission (qalter) could come too
+    late. The shim creates <path>/used, so that a g_submit that bypassed it can be detected
+    :param path: An empty directory
+    :param after: Job ids
+    :return: False if there is no qsub to wrap
+    """
+    qsub = shutil.which('qsub')
+    if qsub is None:
+        return False
+    hold = ','.join([str(jid) for jid in after])
+    shim = os.path.join(path, 'qsub')
+    with open(shim, 'w') as fh:
+        fh.write(f'#!/bin/sh\ntouch {shlex.quote(os.path.join(path, "used"))}\n'
+                 f'exec {shlex.quote(qsub)} -hold_jid {hold} "$@"\n')
+    os.chmod(shim, 0o755)
+    return True
+
+
+def gsubmit_run(args, after=None):
     """
     submit simulation
     :param args:
+    :param after: Job ids the submitted job(s) should wait for, the job only starts if all of them complete successfully
     :return:
     """
     bin = GSUBMIT_BIN
     arg_str = ' '.join([f'{k} {i}' for k, i in args.items()])
-    out = subprocess.run(f'{bin} {arg_str}', shell=True, stdout=PIPE, stderr=PIPE)
+    env = os.environ.copy()
+    scheduler = None
+    shim_dir = None
+    if after:
+        # sbatch reads its options from the environment, so the dependency reaches the jobs submitted by g_submit
+        scheduler = get_scheduler()
+        if scheduler == 'Slurm':
+            env['SBATCH_DEPENDENCY'] = 'afterok:' + ':'.join([str(jid) for jid in after])
+        elif scheduler == 'SGE':
+            shim_dir = tempfile.mkdtemp(prefix='gmxdb_qsub_')
+            if not _sge_hold_shim(shim_dir, after):
+                shutil.rmtree(shim_dir, ignore_errors=True)
+                return 1, 'qsub not found, can not submit jobs on hold'
+            env['PATH'] = f'{shim_dir}{os.pathsep}{env.get("PATH", "")}'
+    try:
+        out = subprocess.run(f'{bin} {arg_str}', shell=True, stdout=PIPE, stderr=PIPE, env=env)
+        bypassed = shim_dir is not None and not os.path.isfile(os.path.join(shim_dir, 'used'))
+    finally:
+        if shim_dir is not None:
+            shutil.rmtree(shim_dir, ignore_errors=True)
 
     if out.returncode:
         return out.returncode, out.stderr.decode('UTF-8')
     # Get the batch job ids
     else:
-        return out.returncode, out.stdout.decode('UTF-8')
+        stdout = out.stdout.decode('UTF-8')
+        if bypassed:  # Do not leave jobs behind that could start before their parent finished
+            cancel_jobs(gsubmit_batch_ids(stdout), scheduler=scheduler)
+            return 1, f'{bin} did not submit with the qsub on PATH, the jobs were not put on hold and cancelled'
+        return out.returncode, stdout
 
 
 def gsubmit_auxfiles(out):
@@ -194,6 +283,242 @@ def gsubmit_out(kwargs, base='./', outfiles=None):
     return outfiles
 
 
+def gsubmit_walltime(args):
+    """
+    Get the walltime in hours requested by a g_submit stage
+    :param args:
+    :return:
+    """
+    days = float(args.get('-days', 0) or 0)
+    hours = float(args.get('-hours', 0) or 0)
+    return 24*days + hours
+
+
+def default_local_threads():
+    """
+    Number of threads used by a stage run on the daemon host if not set explicitly,
+    a quarter of the cores so that a shared host is not taken over by a single stage
+    :return:
+    """
+    return max(1, os.cpu_count() // 4)
+
+
+def local_run(args, nthreads=None, base='./'):
+    """
+    Run the mdrun equivalent of a g_submit stage in the background on the current host
+    The job is wrapped in a shell which writes stdout/stderr to <pid>.out and the exit code to <pid>.exit in
+    LOCAL_JOB_DIR, where <pid> is the process id of the wrapping shell
+    :param args: Arguments passed to g_submit
+    :param nthreads: Number of threads passed to mdrun with -nt
+    :param base: Directory of the stage, mdrun runs in it like the jobs submitted by g_submit
+    :return:
+    """
+    os.makedirs(LOCAL_JOB_DIR, exist_ok=True)
+    # Remove the exit code of an earlier job that had the same pid before running the job
+    prefix = os.path.join(LOCAL_JOB_DIR, '$$')
+    cmd = f'rm -f {prefix}.exit; {mdrun_cmd(args, nthreads=nthreads)} > {prefix}.out 2>&1; echo $? > {prefix}.exit'
+    try:
+        proc = subprocess.Popen(['sh', '-c', cmd], cwd=base, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+    except OSError as e:
+        return 1, f'Failed to start local job: {e}'
+    return 0, f'Started local job {proc.pid} on {socket.gethostname()}'
+
+
+def local_job_ids(out):
+    """
+    Parse the output of local_run and return the job ids
+    :param out:
+    :return:
+    """
+    regexp = r'(?<=Started local job )(\d+)'
+    return [int(match) for match in re.findall(regexp, out)]
+
+
+def local_auxfiles(out):
+    """
+    Compile all auxfiles generated by a local job, there are no jobscripts
+    :param out:
+    :return:
+    """
+    joblogs = []
+    for job_id in local_job_ids(out):
+        joblogs.append(os.path.join(LOCAL_JOB_DIR, f'{job_id}.out'))
+        joblogs.append(os.path.join(LOCAL_JOB_DIR, f'{job_id}.exit'))
+    return {'JSCRIPTS': [], 'JLOGS': joblogs}
+
+
+def mdrun_cmd(args, nthreads=None):
+    """
+    Translate the arguments of a g_submit stage into the equivalent gmx mdrun command
+    Only mdrun options are kept (MDRUN_ARGS, MDRUN_FLAGS), values are quoted for the shell
+    :param args: Arguments passed to g_submit
+    :param nthreads: Number of threads passed to mdrun with -nt, replaces a -nt given in args
+    :return:
+    """
+    flags = MDRUN_FLAGS + tuple([f'-no{flag[1:]}' for flag in MDRUN_FLAGS])
+    arg_str = ' '.join([k if k in flags and str(i) == '' else f'{k} {shlex.quote(str(i))}'
+                        for k, i in args.items() if (k in MDRUN_ARGS or k in flags)
+                        and not (k == '-nt' and nthreads is not None)])
+    if nthreads is not None:
+        arg_str = f'{arg_str} -nt {nthreads}'
+    return f'gmx mdrun {arg_str}'
+
+
+def array_resources(args):
+    """
+    Get the resources requested by a g_submit stage, stages with identical resources can be packed into a job array
+    :param args: Arguments passed to g_submit
+    :return:
+    """
+    return tuple(sorted([(k, str(i)) for k, i in args.items() if k not in GSUBMIT_FILE_ARGS]))
+
+
+def array_directives(args, scheduler):
+    """
+    Translate the resources requested by a g_submit stage into directives of a job array (see ARRAY_RESOURCES)
+    g_submit determines the resources of a stage that does not request them, such a stage can not be packed.
+    A stage is only packed if it requests a walltime and its number of cores (-cpus, -ntasks or the mdrun option -nt),
+    and all its other options are mdrun options, files or translated resources
+    :param args: Arguments passed to g_submit
+    :param scheduler: Slurm or SGE
+    :return: A list of directives, the walltime is set by array_jobscript. None if the stage can not be packed
+    """
+    resources = ARRAY_RESOURCES.get(scheduler)
+    if resources is None or gsubmit_walltime(args) <= 0:
+        return
+    flags = MDRUN_FLAGS + tuple([f'-no{flag[1:]}' for flag in MDRUN_FLAGS])
+    directives = []
+    for k, i in sorted(args.items()):
+        if k in resources:
+            # Directives are not evaluated by a shell, but a line break would start a new directive
+            if len(str(i)) == 0 or re.search(r'\s', str(i)):
+                return
+            directives.append(resources[k].format(i))
+        elif k not in GSUBMIT_FILE_ARGS + GSUBMIT_NOTIFY_ARGS + MDRUN_ARGS + flags + ('-days', '-hours'):
+            return
+    if '-cpus' not in args and '-ntasks' not in args:
+        if not str(args.get('-nt', '')).isdigit() or '-cpus' not in resources:
+            return
+        directives.append(resources['-cpus'].format(args['-nt']))
+    return directives
+
+
+def array_jobscript(tasks, scheduler, walltime, directives=()):
+    """
+    Write a jobscript running one stage per array task
+    :param tasks: A list of (base, args) tuples, one for each stage
+    :param scheduler: Slurm or SGE
+    :param walltime: Walltime of a single task in hours
+    :param directives: Additional scheduler options, e.g. ('--partition=short', )
+    :return: The path to the jobscript
+    """
+    cwd = os.getcwd()
+    seconds = int(walltime * 3600)
+    walltime = f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+    if scheduler == 'Slurm':
+        header = ['#SBATCH --job-name=gmxdb_array',
+                  f'#SBATCH --array=0-{len(tasks) - 1}',
+                  f'#SBATCH --time={walltime}',
+                  f'#SBATCH --output={cwd}/slurm-%A_%a.out']
+        header += [f'#SBATCH {d}' for d in directives]
+        task = '${CMDS[$SLURM_ARRAY_TASK_ID]}'
+    elif scheduler == 'SGE':
+        header = ['#$ -N gmxdb_array',
+                  f'#$ -t 1-{len(tasks)}',
+                  f'#$ -l h_rt={walltime}',
+                  '#$ -cwd']
+        header += [f'#$ {d}' for d in directives]
+        task = '${CMDS[$((SGE_TASK_ID-1))]}'
+    else:
+        raise NotImplementedError(f'Not implemented for {scheduler}')
+
+    # Every task is a single quoted element of a bash array that is evaluated by the task
+    cmds = [shlex.quote(f'cd {shlex.quote(base)} && {mdrun_cmd(args)}') for base, args in tasks]
+    fd, jobscript = tempfile.mkstemp(prefix='gmxdb_array_', suffix='.sh', dir=cwd)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write('\n'.join(['#!/bin/bash'] + header + ['', 'CMDS=('] + cmds + [')', f'eval "{task}"', '']))
+    return jobscript
+
+
+def array_run(tasks, walltime, directives=()):
+    """
+    Submit several g_submit stages as a single job array
+    :param tasks: A list of (base, args) tuples, one for each stage
+    :param walltime: Walltime of a single task in hours
+    :param directives: Additional scheduler options
+    :return:
+    """
+    scheduler = get_scheduler()
+    jobscript = array_jobscript(tasks, scheduler, walltime, directives=directives)
+    submit = {'Slurm': 'sbatch', 'SGE': 'qsub'}[scheduler]
+    out = subprocess.run(f'{submit} {jobscript}', shell=True, stdout=PIPE, stderr=PIPE)
+
+    if out.returncode:
+        return out.returncode, out.stderr.decode('UTF-8')
+    else:
+        return out.returncode, f'FILENAME {jobscript}\n{out.stdout.decode("UTF-8")}'
+
+
+def array_job_id(out):
+    """
+    Parse the output of array_run and return the job id of the array
+    :param out:
+    :return:
+    """
+    match = re.search(r'(?<=Submitted batch job )(\d+)|(?<=Your job-array )(\d+)', out)
+    if match is not None:
+        return int(match.group(0))
+
+
+def array_task_ids(ntasks):
+    """
+    Get the task ids of an array with ntasks tasks, Slurm counts from 0 and SGE from 1
+    :param ntasks:
+    :return:
+    """
+    first = {'Slurm': 0, 'SGE': 1}[get_scheduler()]
+    return list(range(first, first + ntasks))
+
+
+def array_auxfiles(out, task_id):
+    """
+    Compile the jobscript and the scheduler log file(s) of a single array task
+    :param out: Output of array_run
+    :param task_id:
+    :return:
+    """
+    scheduler = get_scheduler()
+    cwd = os.getcwd()
+    jobscripts = _gsubmit_jobscripts(out, scheduler=scheduler)
+    job_id = array_job_id(out)
+    if scheduler == 'Slurm':
+        joblogs = [os.path.join(cwd, f'slurm-{job_id}_{task_id}.out')]
+    else:
+        joblogs = [os.path.join(cwd, f'gmxdb_array.o{job_id}.{task_id}'),
+                   os.path.join(cwd, f'gmxdb_array.e{job_id}.{task_id}')]
+    return {'JSCRIPTS': jobscripts, 'JLOGS': joblogs}
+
+
+def expected_outfiles(app, outfiles):
+    """
+    Get the paths of all output files a completed stage must have produced
+    Optional outputs (e.g. trajectories and checkpoints of g_submit) and auxfiles are not included
+    :param app: g_submit, grompp or shell
+    :param outfiles: A outfile dictionary (see <app>_out)
+    :return:
+    """
+    required = REQUIRED_OUTFILES[app]
+    if required is None:
+        required = [ft for ft in outfiles.keys() if ft not in ('JSCRIPTS', 'JLOGS')]
+    expected = []
+    for ft in required:
+        fn = outfiles.get(ft)
+        # Inherited files were produced by the parent
+        if isinstance(fn, str) and len(fn) > 0 and fn[0] != '%':
+            expected.append(fn)
+    return expected
+
+
 def grompp_run(args):
     """
     Run grompp
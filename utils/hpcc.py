@@ -1,27 +1,54 @@
-import time
+import os
+import signal
+import functools
 import subprocess
 from subprocess import PIPE
 
+from utils.retry import RetryPolicy, CircuitOpen, SCHEDULER_BREAKER
+
 # Mapping scheduler specific status codes to db status codes (stat_id, combination_rule, codes)
 # The database stat_ids code correspond to: 0: failed, 2: running 3: complete
+# 8: timeout is not stored, the Monitor resubmits jobs that exceeded their walltime from their last checkpoint
 # The combination rule is applied to aggregate jobs (multiple jobIDs)
 # Thus if one job in the array failed the set will be flagged as failed independent of the other jobs
 # The Status_codes are sorted by priority
 # i.e. if one job failed and 3 are pending the aggregate job will be flagged failed
 
-STATUS_CODES = {'Slurm': [(0, any, ('FAILED', 'PREEMPTED', 'SUSPENDED', 'STOPPED')),
+STATUS_CODES = {'Slurm': [(0, any, ('FAILED', 'PREEMPTED', 'SUSPENDED', 'STOPPED', 'CANCELLED', 'NODE_FAIL',
+                                   'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE')),
+                          (8, any, ('TIMEOUT', )),
                           (2, any, ('RUNNING', 'COMPLETING', 'PENDING')),
                           (3, all, ('COMPLETED', ))],
                 'SGE': [(0, any, ('f', )),
                         (2, any, ('r', )),
-                        (3, all, ('c', ))]}
+                        (3, all, ('c', ))],
+                'Local': [(0, any, ('FAILED', )),
+                          (2, any, ('RUNNING', )),
+                          (3, all, ('COMPLETED', ))]}
+
+# Jobs run directly on the daemon host write their output and exit code to this directory
+LOCAL_JOB_DIR = os.path.expanduser('~/.gmxdb/jobs')
+
+
+class BudgetExhausted(RuntimeError):
+    """
+    Raised if no scheduler query could be taken from the query budget
+    """
+    pass
 
 
 class JobStatus(object):
     """
     A simple JobMonitor
     """
-    def __init__(self, job_ids, scheduler=None):
+    def __init__(self, job_ids, scheduler=None, cache=None, budget=None):
+        """
+
+        :param job_ids:
+        :param scheduler:
+        :param cache: Optional cache of scheduler states shared with other daemons (see utils.shared)
+        :param budget: Optional budget limiting the number of scheduler queries (see utils.shared)
+        """
 
         # If a single job_id is passed
         if isinstance(job_ids, int):
@@ -36,17 +63,19 @@ class JobStatus(object):
 
         if scheduler in ('LSF', ):
             raise NotImplementedError('gmx_db only supports Slurm & SGE Scheduler currently')
-        elif scheduler not in ('Slurm', 'SGE'):
+        elif scheduler not in ('Slurm', 'SGE', 'Local'):
             raise ValueError(f'unknown scheduler: {scheduler}')
         else:  # Get the appropriate query function
             self.query = {'Slurm': slurm_job_status,
-                          'SGE': sge_job_status}[scheduler]
+                          'SGE': sge_job_status,
+                          'Local': local_job_status}[scheduler]
 
         # Get the status codes for the corresponding scheduler
         self.status_codes = STATUS_CODES[scheduler]
-        # Set initial _job_status
+        self.cache = cache
+        self.budget = budget
+        # Set initial _job_status, the scheduler is only queried once the status is requested
         self._job_status = None
-        self.status_query()
 
     @property
     def status(self):
@@ -65,7 +94,26 @@ class JobStatus(object):
         """
         job_status = []
         for jid in self.job_ids:
-            job_status.append(self.query(jid))
+            state = None
+            if self.cache is not None:
+                state = self.cache.get(jid)
+                # Another daemon is querying the scheduler for this job, keep the last known status
+                if state == self.cache.PENDING:
+                    return
+            # Only query the scheduler if there is no fresh cached state
+            if state is None:
+                try:
+                    state = self.query(jid, budget=self.budget)
+                except (BudgetExhausted, CircuitOpen):
+                    # Fall back to the cached state regardless of its age, or keep the last known status
+                    if self.cache is not None:
+                        state = self.cache.peek(jid)
+                    if state is None:
+                        return
+                else:
+                    if self.cache is not None:
+                        self.cache.put(jid, state)
+            job_status.append(state)
 
         for stat_id, combination_func, stat_codes in self.status_codes:
             if combination_func([s in stat_codes for s in job_status]):
@@ -86,9 +134,11 @@ def is_iterable(obj):
         return False
 
 
+@functools.lru_cache(maxsize=None)
 def get_scheduler():
     """
     Try to determine the scheduler
+    The result is cached, the scheduler does not change during the lifetime of a process
     :return:
     """
     queue_info = {'Slurm': 'sinfo',
@@ -104,49 +154,173 @@ def get_scheduler():
     return
 
 
-def slurm_job_status(job_id, retries=5, interval=10):
+def cancel_jobs(job_ids, scheduler=None):
     """
-    Get job status with slurm
+    Cancel jobs, e.g. jobs waiting for a parent job that failed
+    :param job_ids: Job ids or ids of array tasks (<job_id>_<task_id>)
+    :param scheduler: Slurm, SGE or Local for jobs run on this host
+    :return:
+    """
+    if scheduler is None:
+        scheduler = get_scheduler()
+    if scheduler == 'Local':
+        # The wrapping shell of a local job leads its process group (see utils.gmx.local_run)
+        for jid in job_ids:
+            try:
+                os.killpg(int(jid), signal.SIGKILL)
+            except ProcessLookupError:  # The job already finished
+                continue
+        return 0
+    elif scheduler == 'Slurm':
+        cmd = f'scancel {" ".join([str(jid) for jid in job_ids])}'
+    elif scheduler == 'SGE':
+        cmd = f'qdel {",".join([str(jid).replace("_", ".") for jid in job_ids])}'
+    else:
+        raise NotImplementedError(f'Not implemented for {scheduler}')
+    out = subprocess.run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    return out.returncode
+
+
+def split_job_id(job_id):
+    """
+    Split the id of an array task (<job_id>_<task_id>) into the job id and the task id
+    The task id is None for jobs that are not part of an array
     :param job_id:
+    :return:
+    """
+    job_id = str(job_id)
+    if '_' in job_id:
+        job_id, task_id = job_id.split('_')
+        return job_id, task_id
+    return job_id, None
+
+
+def _sge_task_in(task_id, spec):
+    """
+    Check if an array task is part of the ja-task-ID column reported by qstat (e.g. 3, 1-4:1 or 1,3)
+    :param task_id:
+    :param spec:
+    :return:
+    """
+    for part in spec.split(','):
+        try:
+            if '-' in part:
+                first, last = part.split('-')
+                step = 1
+                if ':' in last:
+                    last, step = last.split(':')
+                if int(task_id) in range(int(first), int(last) + 1, int(step)):
+                    return True
+            elif int(part) == int(task_id):
+                return True
+        except ValueError:  # Not a task specification
+            continue
+    return False
+
+
+def take_token(budget):
+    """
+    Take a token from a query budget, raise BudgetExhausted if none is available
+    :param budget: A query budget (see utils.shared) or None
+    :return:
+    """
+    if budget is not None and not budget.acquire():
+        raise BudgetExhausted(f'Scheduler query budget: {budget.name} exhausted')
+
+
+def probe_scheduler(scheduler=None):
+    """
+    Run a cheap scheduler command while the scheduler circuit breaker is open, a success closes the breaker
+    :param scheduler:
+    :return: True if the scheduler is available
+    """
+    if not SCHEDULER_BREAKER.is_open:
+        return True
+    if not SCHEDULER_BREAKER.allow():
+        return False
+    if scheduler is None:
+        scheduler = get_scheduler()
+    cmd = {'Slurm': 'sinfo', 'SGE': 'qstat'}.get(scheduler)
+    if cmd is not None and subprocess.run(cmd, shell=True, stdout=PIPE, stderr=PIPE).returncode:
+        SCHEDULER_BREAKER.failure()
+        return False
+    SCHEDULER_BREAKER.success()
+    return True
+
+
+def scheduler_run(cmd):
+    """
+    Run a scheduler command, unless the scheduler circuit breaker is open
+    Raises CircuitOpen if the breaker does not allow the call
+    :param cmd:
+    :return:
+    """
+    SCHEDULER_BREAKER.check()
+    out = subprocess.run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    if out.returncode:
+        SCHEDULER_BREAKER.failure()
+    else:
+        SCHEDULER_BREAKER.success()
+    return out
+
+
+def slurm_job_status(job_id, retries=5, interval=10, budget=None):
+    """
+    Get job status with slurm
+    :param job_id: A job id or the id of an array task (<job_id>_<task_id>)
     :param retries:
-    :param interval
+    :param interval: Upper bound of the first wait between retries, doubled with every retry
+    :param budget: Every call to the scheduler takes a token from the budget
     :return:
     """
     cmd = f'sacct -j {job_id} --delimiter=\',\' --parsable2 --format=JobID,State,ExitCode'
+    policy = RetryPolicy(base=interval)
     for i in range(retries):
-        out = subprocess.run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+        take_token(budget)
+        out = scheduler_run(cmd)
         if out.returncode:
-            raise RuntimeError(f'Non-zeros exitcode: {out.returncode}\n{out.stdout}\n{out.stderr}')
+            if i == retries - 1:
+                raise RuntimeError(f'Non-zeros exitcode: {out.returncode}\n{out.stdout}\n{out.stderr}')
+            policy.sleep(i)
+            continue
         else:
             lines = out.stdout.decode('UTF-8').split('\n')
+            # Array tasks that have not started yet are not listed individually
+            if split_job_id(job_id)[1] is not None and len(lines) > 1 and lines[1] == '':
+                return 'PENDING'
             try:
-                job_id, status, exitcode = lines[1].split(',')
-                return status
+                _, status, exitcode = lines[1].split(',')
+                # Some states carry additional information, e.g. CANCELLED by <uid>
+                return status.split()[0]
             except Exception as e:
                 print(f'Failed to get job status for {job_id}')
-                time.sleep(interval)
+                policy.sleep(i)
     raise ValueError(f'Unexpected output for job_id: {job_id}\n{lines}')
 
 
-def sge_job_status(job_id, retries=5, interval=10):
+def sge_job_status(job_id, retries=5, interval=10, budget=None):
     """
     Get job status with sge
     On SGE we need to call two separate commands for running and finished jobs
     qstat will return all jobs that are active
     qacct will also show jobs that have finished
-    :param job_id:
+    :param job_id: A job id or the id of an array task (<job_id>_<task_id>)
     :param retries:
-    :param interval:
+    :param interval: Upper bound of the first wait between retries, doubled with every retry
+    :param budget: Every call to the scheduler takes a token from the budget
     :return:
     """
     # List of "active states" https://gist.github.com/cmaureir/4fa2d34bc9a1bd194af1
     active_states = ('qw', 'hqw', 'hRwq', 'r', 't', 'Rr', 'Rt', 's', 'ts', 'S', 'tS')
-    for _ in range(retries):
+    job_id, task_id = split_job_id(job_id)
+    policy = RetryPolicy(base=interval)
+    for i in range(retries):
         is_active = False  # Not active until proofen otherwise
         # Get all active jobs
-        out = subprocess.run('qstat', shell=True, stdout=PIPE, stderr=PIPE)
+        take_token(budget)
+        out = scheduler_run('qstat')
         if out.returncode:  # Just wait a little bit and try again
-            time.sleep(interval)
+            policy.sleep(i)
             continue
 
         else:
@@ -159,16 +333,22 @@ def sge_job_status(job_id, retries=5, interval=10):
                         state = line_split[4]
                     else:
                         continue
-                    if jid == str(job_id) and state in active_states:
+                    # For array tasks the last column (ja-task-ID) lists the task(s)
+                    if task_id is not None and not _sge_task_in(task_id, line_split[-1]):
+                        continue
+                    if jid == job_id and state in active_states:
                         is_active = True
                         break
         if is_active:
             return 'r'
         else:
             cmd = f'qacct -j {job_id}'
-            out = subprocess.run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+            if task_id is not None:
+                cmd = f'{cmd} -t {task_id}'
+            take_token(budget)
+            out = scheduler_run(cmd)
             if out.returncode:  # Just wait a little bit and try again
-                time.sleep(interval)
+                policy.sleep(i)
                 continue
 
             else:
@@ -185,3 +365,31 @@ def sge_job_status(job_id, retries=5, interval=10):
                     else:
                         continue
         raise RuntimeError(f'Non-zeros exitcode: {out.returncode}\n{out.stdout}\n{out.stderr}')
+
+
+def local_job_status(job_id, budget=None):
+    """
+    Get the status of a job running on this host (see utils.gmx.local_run)
+    The job_id is the pid of the shell wrapping the job, which writes the exit code once the job finishes.
+    :param job_id:
+    :param budget: Unused, local jobs do not query the scheduler
+    :return:
+    """
+    # Make sure the pid was not reused by an unrelated process
+    try:
+        with open(f'/proc/{job_id}/cmdline', 'rb') as fh:
+            is_active = LOCAL_JOB_DIR.encode('UTF-8') in fh.read()
+    except OSError:
+        is_active = False
+    if is_active:
+        return 'RUNNING'
+
+    exit_file = os.path.join(LOCAL_JOB_DIR, f'{job_id}.exit')
+    if not os.path.isfile(exit_file):  # The job was killed before it could write an exit code
+        return 'FAILED'
+    with open(exit_file, 'r') as fh:
+        exitcode = fh.readline().strip()
+    if exitcode == '0':
+        return 'COMPLETED'
+    else:
+        return 'FAILED'
@@ -0,0 +1,135 @@
+import json
+import time
+import queue
+import random
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler
+
+_description = """
+Logging for gmxdb daemons.
+
+Workers rate limit repetitive messages before they are queued (see RateLimitFilter), so that a flood of messages
+never reaches the queue. They put the remaining records on a bounded queue without ever blocking, if the queue is full
+the oldest record is dropped. A single listener in the daemon process writes JSON lines to a rotating logfile.
+Records carry the context of the worker that created them (e.g. sim_id, see DatabaseWorker.set_log_context).
+"""
+
+# Record attributes added to a JSON line if present
+CONTEXT_KEYS = ('sim_id', 'worker_id', 'suppressed', 'dropped')
+
+# Settings of the RateLimitFilter of every worker, set by the daemon before workers are forked (see set_rate_limit)
+RATE_LIMIT = {'rate': 10., 'burst': 100, 'sample': 1.}
+
+
+def set_rate_limit(rate=10., burst=None, sample=1.):
+    """
+    Configure the rate limit of all workers forked afterwards
+    :param rate: Messages per second, call site and sim
+    :param burst: Maximum number of messages per call site and sim in a burst, defaults to 10 seconds worth of messages
+    :param sample: Fraction of debug messages kept
+    :return:
+    """
+    RATE_LIMIT.update(rate=rate, burst=burst if burst is not None else int(10 * rate), sample=sample)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as a single line of JSON
+    """
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'process': record.process,
+                 'name': record.name,
+                 'message': record.getMessage()}
+        for key in CONTEXT_KEYS:
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Rate limit messages per call site (file and line) and sim, added to the queue handler of every worker
+    Every call site and sim has a token bucket, messages without a token are suppressed and counted, so a message
+    repeated for one sim does not suppress the same message for other sims.
+    The next message passing from the same call site and sim reports the number of suppressed messages.
+    Errors are never suppressed, debug messages can additionally be sampled.
+    """
+    def __init__(self, rate=10., burst=100, sample=1., max_buckets=10000):
+        """
+
+        :param rate: Messages per second, call site and sim
+        :param burst: Maximum number of messages per call site and sim in a burst
+        :param sample: Fraction of debug messages kept
+        :param max_buckets: Buckets that are full again are removed once there are more buckets,
+                            if all of them are in use the rate limit starts over
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.max_buckets = max_buckets
+        # (pathname, lineno, sim_id): (tokens, last update, suppressed)
+        self.buckets = {}
+
+    def prune(self, t):
+        """
+        Remove the buckets that refilled completely and have no suppressed messages to report
+        :param t: The current time
+        :return:
+        """
+        self.buckets = {key: (tokens, updated, suppressed) for key, (tokens, updated, suppressed) in self.buckets.items()
+                        if suppressed or tokens + (t - updated) * self.rate < self.burst}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        if record.levelno <= logging.DEBUG and self.sample < 1. and random.random() >= self.sample:
+            return False
+        key = (record.pathname, record.lineno, getattr(record, 'sim_id', None))
+        t = time.time()
+        if key not in self.buckets and len(self.buckets) >= self.max_buckets:
+            self.prune(t)
+            if len(self.buckets) >= self.max_buckets:
+                self.buckets = {}
+        tokens, updated, suppressed = self.buckets.get(key, (self.burst, t, 0))
+        tokens = min(self.burst, tokens + (t - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, t, suppressed + 1)
+            return False
+        if suppressed:
+            record.suppressed = suppressed
+        self.buckets[key] = (tokens - 1, t, 0)
+        return True
+
+
+class DropOldestQueueHandler(QueueHandler):
+    """
+    A QueueHandler for bounded queues that never blocks, if the queue is full the oldest record is dropped
+    The number of records dropped by this process is reported with the next record that is queued
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        for _ in range(2):
+            if self.dropped:
+                record.dropped = self.dropped
+            try:
+                self.queue.put_nowait(record)
+                self.dropped = 0
+                return
+            except queue.Full:
+                # Make room by dropping the oldest record, the short timeout covers records that were queued but
+                # not yet flushed to the underlying pipe
+                try:
+                    self.queue.get(timeout=0.01)
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        self.dropped += 1
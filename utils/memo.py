@@ -0,0 +1,234 @@
+import os
+import re
+import shlex
+import shutil
+import hashlib
+
+from utils.queries import json_param
+
+_description = """
+Memoization of grompp stages.
+
+Stages with identical arguments and input files produce identical run inputs, unless grompp draws a random seed.
+Stages that generate velocities with gen_seed = -1 or use a stochastic integrator, thermostat or barostat with
+ld_seed = -1 are therefore never cached (see uses_random_seed).
+The key of a stage is a hash of its arguments, the content of its input files and the gmx binary. The input files
+include the #include files of the topology, found next to the including file or in the include directories of the
+mdp file (include = -I...). Files included from the force field library (GMXLIB) are not hashed, they belong to the
+gmx installation. Input files are identified by content, not by path.
+
+The database maps keys to the output files of the first stage that produced them (grompp_cache table).
+A stage with a known key copies these files instead of running grompp. Entries whose files were removed or modified
+(size or modification time changed) are dropped on lookup, the least recently used entries are evicted once the cache
+holds more than max_entries.
+"""
+
+GROMPP_INPUT_ARGS = ('-f', '-c', '-r', '-rb', '-n', '-p', '-t', '-e', '-ref')
+# Outputs do not change the result, they are copied on a cache hit (see utils.gmx.grompp_out)
+GROMPP_OUTPUT_ARGS = ('-po', '-pp', '-o', '-imd')
+
+INCLUDE = re.compile(r'^\s*#include\s+(["<])([^">]+)[">]')
+
+# Stochastic dynamics and coupling algorithms that draw from ld_seed (normalized, see parse_mdp)
+STOCHASTIC_INTEGRATORS = ('sd', 'bd')
+STOCHASTIC_TCOUPL = ('v_rescale', 'andersen', 'andersen_massive')
+STOCHASTIC_PCOUPL = ('c_rescale', )
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Hash the content of a file
+    :param path:
+    :param block_size:
+    :return: A hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_mdp(path):
+    """
+    Read the parameters of an mdp file, names and values are normalized like grompp does (lower case, - and _ are
+    equivalent)
+    :param path:
+    :return: A dictionary {name: value}
+    """
+    mdp = {}
+    with open(path, 'r', errors='replace') as fh:
+        for line in fh:
+            name, sep, value = line.split(';', 1)[0].partition('=')
+            if sep:
+                mdp[name.strip().lower().replace('-', '_')] = value.strip()
+    return mdp
+
+
+def uses_random_seed(mdp):
+    """
+    Check if grompp draws a random seed for a stage, the run input then differs between otherwise identical stages
+    :param mdp: See parse_mdp
+    :return:
+    """
+    def option(name, default):
+        return mdp.get(name, default).lower().replace('-', '_')
+
+    def seed(name):
+        try:
+            return int(mdp.get(name, -1))
+        except ValueError:
+            return -1
+
+    if option('gen_vel', 'no') == 'yes' and seed('gen_seed') == -1:
+        return True
+    stochastic = (option('integrator', 'md') in STOCHASTIC_INTEGRATORS or
+                  option('tcoupl', 'no') in STOCHASTIC_TCOUPL or
+                  option('pcoupl', 'no') in STOCHASTIC_PCOUPL)
+    return stochastic and seed('ld_seed') == -1
+
+
+def include_dirs(mdp):
+    """
+    Get the include directories of an mdp file (include = -I...), relative directories are relative to the working
+    directory of grompp (see utils.gmx.grompp_run)
+    :param mdp: See parse_mdp
+    :return: A list of absolute paths
+    """
+    dirs = []
+    for arg in shlex.split(mdp.get('include', '')):
+        if arg.startswith('-I') and len(arg) > 2:
+            dirs.append(os.path.abspath(arg[2:]))
+    return dirs
+
+
+def local_includes(path, dirs=(), seen=None):
+    """
+    Find the files included by a topology, recursively. Like the preprocessor of grompp, "file" is searched next to
+    the including file and then in the include directories, <file> only in the include directories.
+    Files included from the force field library (GMXLIB) are not resolved, they belong to the gmx installation
+    :param path:
+    :param dirs: Include directories (see include_dirs)
+    :param seen: Files already visited
+    :return: A list of (include as written, path)
+    """
+    if seen is None:
+        seen = {os.path.realpath(path)}
+    includes = []
+    with open(path, 'r', errors='replace') as fh:
+        for line in fh:
+            match = INCLUDE.match(line)
+            if match is None:
+                continue
+            quote, include = match.groups()
+            candidates = ([os.path.dirname(path)] if quote == '"' else []) + list(dirs)
+            fn = next((os.path.join(d, include) for d in candidates if os.path.isfile(os.path.join(d, include))),
+                      None)
+            if fn is None or os.path.realpath(fn) in seen:
+                continue
+            seen.add(os.path.realpath(fn))
+            includes.append((include, fn))
+            includes.extend(local_includes(fn, dirs=dirs, seen=seen))
+    return includes
+
+
+def grompp_key(args):
+    """
+    Get the cache key of a grompp stage
+    :param args: The parsed grompp arguments (files resolved to absolute paths)
+    :return: A hex digest or None if the stage can not be cached (an input file can not be read, no mdp file is
+             given or grompp draws a random seed)
+    """
+    gmx = shutil.which('gmx')
+    parts = [f'gmx={os.path.realpath(gmx) if gmx else ""}']
+    try:
+        if '-f' not in args:
+            return
+        mdp = parse_mdp(args['-f'])
+        if uses_random_seed(mdp):
+            return
+        for kw in sorted(args.keys()):
+            if kw in GROMPP_OUTPUT_ARGS:
+                continue
+            if kw in GROMPP_INPUT_ARGS:
+                parts.append(f'{kw}={file_hash(args[kw])}')
+            else:
+                parts.append(f'{kw}={args[kw]}')
+        if '-p' in args:
+            for include, fn in local_includes(args['-p'], dirs=include_dirs(mdp)):
+                parts.append(f'#include {include}={file_hash(fn)}')
+    except OSError:
+        return
+    return hashlib.sha256('\n'.join(parts).encode('UTF-8')).hexdigest()
+
+
+def file_stamp(path):
+    """
+    Get the size and modification time of a file
+    :param path:
+    :return: [size, mtime in ns] or None if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    return [st.st_size, st.st_mtime_ns]
+
+
+def copy_outfile(src, dst):
+    """
+    Link or copy a cached output file, an existing destination is replaced
+    :param src:
+    :param dst:
+    :return:
+    """
+    if os.path.realpath(src) == os.path.realpath(dst):
+        return
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:  # e.g. a different filesystem
+        shutil.copy2(src, dst)
+
+
+class GromppCache(object):
+    """
+    Index of grompp outputs in the grompp_cache table
+    """
+    def __init__(self, db_exec, max_entries=10000):
+        """
+
+        :param db_exec: A function executing a query on the database (see DatabaseWorker.db_exec)
+        :param max_entries: Maximum number of entries, the least recently used are evicted
+        """
+        self.db_exec = db_exec
+        self.max_entries = max_entries
+
+    def get(self, key):
+        """
+        Get the output files of a stage with the given key
+        :param key:
+        :return: The outfile dictionary {file type: path} or None if not cached or if a file does not exist anymore
+        """
+        out = self.db_exec('grompp_cache_get', (key, ), fetch=True, commit=True)
+        if not out:
+            return
+        files = out[0][0]
+        if not all([file_stamp(entry['path']) == entry['stamp'] for entry in files.values()]):
+            self.db_exec('grompp_cache_delete', (key, ), fetch=False, commit=True)
+            return
+        return {ft: entry['path'] for ft, entry in files.items()}
+
+    def put(self, key, sim_id, files):
+        """
+        Add the output files of a stage, existing entries are kept
+        :param key:
+        :param sim_id: The stage that produced the files
+        :param files: The outfile dictionary {file type: path}, all files must exist
+        :return:
+        """
+        files = {ft: {'path': fn, 'stamp': file_stamp(fn)} for ft, fn in files.items()}
+        self.db_exec('grompp_cache_put', (key, sim_id, json_param(files)), fetch=False, commit=True)
+        self.db_exec('grompp_cache_evict', (self.max_entries, ), fetch=False, commit=True)
@@ -0,0 +1,104 @@
+import os
+import re
+import math
+import hashlib
+
+_description = """
+Predict the walltime of g_submit stages from the runtimes of similar stages.
+
+Stages are similar if they share a signature made of
+    the parameters of the mdp file used to build the run input (comments, whitespace and random seeds removed)
+    the size of the run input file (-s) in buckets of about 20%
+    the -deffnm pattern, with all digits replaced (e.g. axel_rep1 and axel_rep2 share the pattern axel_rep#)
+
+The prediction is a high quantile of the recorded runtimes times a safety margin.
+Runtimes are recorded in the walltime table when a stage completes (see Verify).
+"""
+
+# Parameters that differ between otherwise identical stages
+IGNORED_MDP_PARAMS = ('gen_seed', 'gen-seed', 'ld_seed', 'ld-seed')
+
+
+def mdp_hash(path):
+    """
+    Hash the parameters of a mdp file
+    :param path:
+    :return: A hex digest or None if the file can not be read
+    """
+    params = []
+    try:
+        with open(path, 'r') as fh:
+            for line in fh:
+                line = line.split(';')[0].strip()
+                if '=' not in line:
+                    continue
+                kw, value = [s.strip() for s in line.split('=', 1)]
+                if kw in IGNORED_MDP_PARAMS:
+                    continue
+                params.append(f'{kw}={" ".join(value.split())}')
+    except OSError:
+        return
+    return hashlib.sha1('\n'.join(sorted(params)).encode('UTF-8')).hexdigest()
+
+
+def size_bucket(path):
+    """
+    Get the size bucket of a file, sizes within about 20% share a bucket
+    :param path:
+    :return: The bucket or None if the file does not exist
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    return round(4 * math.log2(size + 1))
+
+
+def deffnm_pattern(deffnm):
+    """
+    Replace all digits in the basename of -deffnm
+    :param deffnm:
+    :return:
+    """
+    return re.sub(r'\d+', '#', os.path.basename(str(deffnm))) if deffnm else ''
+
+
+def stage_signature(args, mdp=None):
+    """
+    Get the signature of a g_submit stage
+    :param args: The parsed g_submit arguments (files resolved to absolute paths)
+    :param mdp: The mdp file used to build the run input, e.g. the MDP output of the parent grompp stage
+    :return: A hex digest
+    """
+    parts = (mdp_hash(mdp) if mdp else None, size_bucket(args['-s']) if '-s' in args else None,
+             deffnm_pattern(args.get('-deffnm')))
+    return hashlib.sha1(repr(parts).encode('UTF-8')).hexdigest()
+
+
+def predict_hours(runtimes, quantile=0.95, margin=1.2, min_samples=5):
+    """
+    Predict the walltime from the runtimes of similar stages
+    :param runtimes: Runtimes in hours
+    :param quantile: Quantile of the runtimes used (nearest rank)
+    :param margin: Safety factor applied to the quantile
+    :param min_samples: Minimum number of runtimes required for a prediction
+    :return: The predicted walltime in hours or None
+    """
+    if len(runtimes) < min_samples:
+        return
+    runtimes = sorted(runtimes)
+    rank = min(len(runtimes) - 1, max(0, math.ceil(quantile * len(runtimes)) - 1))
+    return runtimes[rank] * margin
+
+
+def walltime_args(args, hours):
+    """
+    Set the walltime requested by a g_submit stage, rounded up to full hours
+    :param args:
+    :param hours:
+    :return: A copy of args
+    """
+    hours = max(1, math.ceil(hours))
+    args = dict(args)
+    args['-days'], args['-hours'] = divmod(hours, 24)
+    return args
@@ -0,0 +1,288 @@
+import re
+
+from psycopg2.extras import Json
+
+_description = """
+Named, parameterized statements for all queries that are run repeatedly.
+
+Statements use $1, $2, ... as placeholders, as in a postgresql PREPARE statement.
+On long lived connections a statement is prepared once and then executed by name, so the server
+parses and plans it only once per connection. On short lived connections the same statement is sent
+with client side parameter binding.
+Either way values are never formatted into the SQL text, JSON values are passed with Json (see json_param).
+"""
+
+# Status a stage returns to if the submission of its owner was interrupted (stat_id 6, see GMXSubmit.begin_submit)
+_UNSUBMIT = 'CASE WHEN sim.stat_id <> 6 THEN sim.stat_id WHEN sim.parent_id IS NULL THEN 1 ELSE 4 END'
+
+# name: (statement, parameter types)
+QUERIES = {
+    # sim
+    'sim_stat_id': ('SELECT stat_id FROM sim WHERE id = $1', ('INT', )),
+    'sim_parent_id': ('SELECT parent_id FROM sim WHERE id = $1', ('INT', )),
+    'sim_set_stat_id': ('UPDATE sim SET stat_id = $2 WHERE id = $1', ('INT', 'SMALLINT')),
+    'sims_set_stat_id': ('UPDATE sim SET stat_id = $2 WHERE stat_id = $3 AND id = ANY($1)',
+                         ('INT[]', 'SMALLINT', 'SMALLINT')),
+    # Multi-row status change, expected (or NULL) is the status a sim must have (see utils.writes)
+    'sims_set_stat_ids': ('UPDATE sim SET stat_id = v.stat_id FROM unnest($1::int[], $2::smallint[], $3::smallint[]) '
+                          'v(id, stat_id, expected) WHERE sim.id = v.id '
+                          'AND (v.expected IS NULL OR sim.stat_id = v.expected)', ('INT[]', 'SMALLINT[]', 'SMALLINT[]')),
+    'sim_resubmits': ('SELECT resubmits FROM sim WHERE id = $1', ('INT', )),
+    # Resubmit a running stage of owner $2 from the checkpoint $3, its jobs are forgotten (see Monitor.resubmit)
+    'sim_resubmit': ('WITH owned AS (UPDATE sim SET stat_id = 1, resubmits = resubmits + 1 WHERE id = $1 '
+                     'AND worker_id = $2 AND stat_id = 2 RETURNING id), cpi AS (UPDATE param '
+                     'SET args = jsonb_set(param.args, ARRAY[\'-cpi\'], to_jsonb($3::text)) FROM owned '
+                     'WHERE param.sim_id = owned.id), jobs AS (DELETE FROM job_info USING owned '
+                     'WHERE job_info.sim_id = owned.id) SELECT id FROM owned', ('INT', 'INT', 'TEXT')),
+    # Chained children (see Depend) wait for jobs of the parent that will never complete if it is resubmitted
+    'sim_reset_chained': ('UPDATE sim SET stat_id = 4 WHERE parent_id = $1 AND stat_id = 2 RETURNING id', ('INT', )),
+    # sim_edge
+    'sim_edge_insert': ('INSERT INTO sim_edge(child_id, parent_id, pos) '
+                        'SELECT $1, p.parent_id, p.pos - 1 FROM unnest($2::int[]) WITH ORDINALITY p(parent_id, pos)',
+                        ('INT', 'INT[]')),
+    'sim_parents': ('SELECT parent_id FROM sim_edge WHERE child_id = $1 ORDER BY pos', ('INT', )),
+    # Number of parents, failed parents and parents that did not complete yet
+    'sim_parent_stats': ('SELECT COUNT(*), COUNT(*) FILTER (WHERE p.stat_id IN (0, 5)), '
+                         'COUNT(*) FILTER (WHERE p.stat_id <> 3) FROM sim_edge e JOIN sim p ON p.id = e.parent_id '
+                         'WHERE e.child_id = $1', ('INT', )),
+    # Submit the waiting children of the parents in $1 whose parents all completed
+    'sims_promote_ready': ('UPDATE sim SET stat_id = 1 WHERE stat_id = 4 AND id IN '
+                           '(SELECT child_id FROM sim_edge WHERE parent_id = ANY($1)) AND NOT EXISTS '
+                           '(SELECT 1 FROM sim_edge e JOIN sim p ON p.id = e.parent_id '
+                           'WHERE e.child_id = sim.id AND p.stat_id <> 3)', ('INT[]', )),
+    # Register all instances of a template, see expand_sweep in create_db.py
+    'sweep_expand': ('SELECT * FROM expand_sweep($1::jsonb, $2::jsonb, $3)', ('JSONB', 'JSONB', 'VARCHAR')),
+    'sim_register': ('INSERT INTO sim(stat_id, parent_id, grp) VALUES (6, $1, $2) RETURNING id', ('INT', 'VARCHAR')),
+    # Claim active sims of group $4 that are not owned by a daemon with a valid lease
+    # (worker $1 on host $2, at most $3 sims)
+    # Jobs running locally on another host can only be monitored by that host.
+    # Stages a daemon was submitting (stat_id 6 with an owner) are submitted again
+    'sim_claim': (f'UPDATE sim SET worker_id = $1, stat_id = {_UNSUBMIT} FROM (SELECT sim.id FROM sim '
+                  'WHERE (sim.stat_id IN (1, 2, 4) OR sim.stat_id = 6 AND sim.worker_id IS NOT NULL) '
+                  'AND sim.worker_id IS DISTINCT FROM $1 AND NOT EXISTS (SELECT 1 FROM worker '
+                  'WHERE worker.id = sim.worker_id AND worker.active AND worker.lease_until > now()) '
+                  'AND NOT EXISTS (SELECT 1 FROM job_info WHERE job_info.sim_id = sim.id '
+                  'AND job_info.executor = \'local\' AND job_info.host <> $2) '
+                  'AND sim.grp = $4 ORDER BY sim.id LIMIT $3 FOR UPDATE OF sim SKIP LOCKED) claim '
+                  'WHERE sim.id = claim.id RETURNING sim.id', ('INT', 'VARCHAR', 'INT', 'VARCHAR')),
+    'sim_owned': ('SELECT id, stat_id FROM sim WHERE worker_id = $1 AND stat_id IN (1, 2, 4, 6)', ('INT', )),
+    'sim_release': (f'UPDATE sim SET worker_id = NULL, stat_id = {_UNSUBMIT} WHERE worker_id = $1', ('INT', )),
+    # Only the owner $2 of a stage submits it, the stage is flagged as being submitted (updating)
+    # while it is in status $3 (submitted or depend for chained stages)
+    'sim_begin_submit': ('UPDATE sim SET stat_id = 6 WHERE id = $1 AND worker_id = $2 AND stat_id = $3 RETURNING id',
+                         ('INT', 'INT', 'SMALLINT')),
+    # Set the status $2 of a stage once it was submitted and record its jobs ($4: job ids, $5: task ids, $6: executor,
+    # $7: host), if its owner $3 did not lose it in the meantime
+    'sim_end_submit': ('WITH owned AS (UPDATE sim SET stat_id = $2 WHERE id = $1 AND worker_id = $3 AND stat_id = 6 '
+                       'RETURNING id), jobs AS (INSERT INTO job_info(sim_id, job_id, task_id, executor, host) '
+                       'SELECT owned.id, j.job_id, j.task_id, $6, $7 FROM owned, unnest($4::int[], $5::int[]) '
+                       'AS j(job_id, task_id) ON CONFLICT DO NOTHING) SELECT id FROM owned',
+                       ('INT', 'SMALLINT', 'INT', 'INT[]', 'INT[]', 'VARCHAR', 'VARCHAR')),
+    # Reset the stages daemon $1 was submitting with workers that died, except those in $2 (active workers)
+    'sims_reset_submitting': (f'UPDATE sim SET stat_id = {_UNSUBMIT} WHERE worker_id = $1 AND stat_id = 6 '
+                              'AND NOT id = ANY($2) RETURNING id', ('INT', 'INT[]')),
+    'sim_has_stat_id': ('SELECT id FROM sim WHERE stat_id = $1 AND grp = $2 LIMIT 1', ('SMALLINT', 'VARCHAR')),
+    'sim_oldest_waiting': ('SELECT id, stat_id, created FROM sim WHERE stat_id IN (1, 4) ORDER BY id LIMIT 1', ()),
+    # param
+    'param_exists': ('SELECT 1 FROM param WHERE sim_id = $1', ('INT', )),
+    'param_cmd': ('SELECT cmd FROM param WHERE sim_id = $1', ('INT', )),
+    'param_args': ('SELECT args FROM param WHERE sim_id = $1', ('INT', )),
+    'param_path': ('SELECT path FROM param WHERE sim_id = $1', ('INT', )),
+    'param_executor': ('SELECT executor FROM param WHERE sim_id = $1', ('INT', )),
+    'param_cmd_executor': ('SELECT cmd, executor FROM param WHERE sim_id = ANY($1)', ('INT[]', )),
+    'param_insert': ('INSERT INTO param(sim_id, path, cmd, args, executor) VALUES ($1, $2, $3, $4, $5)',
+                     ('INT', 'VARCHAR', 'VARCHAR', 'JSONB', 'VARCHAR')),
+    'param_ready_g_submit': ('SELECT sim.id, param.args FROM sim JOIN param ON param.sim_id = sim.id '
+                             'WHERE sim.stat_id = 1 AND param.cmd = \'g_submit\' '
+                             'AND param.executor IS DISTINCT FROM \'local\' AND sim.worker_id = $1', ('INT', )),
+    # outfile, read through the fout view {"file_type": "/path/to/file"}
+    # The view is aggregated per sim, it must only be joined through a condition on sim_id (e.g. LATERAL)
+    'fout_files': ('SELECT files FROM fout WHERE sim_id = $1', ('INT', )),
+    # Set the file types in $2, other file types of the sim are kept. Lists are stored one row per element,
+    # elements beyond the new length and file types set to null are removed
+    'fout_insert': ('WITH new AS (SELECT e.key AS ftype, a.idx, a.path FROM jsonb_each($2::jsonb) e, LATERAL '
+                    '(SELECT -1 AS idx, e.value #>> \'{}\' AS path WHERE jsonb_typeof(e.value) <> \'array\' '
+                    'UNION ALL SELECT l.ord - 1, l.path FROM jsonb_array_elements_text(CASE jsonb_typeof(e.value) '
+                    'WHEN \'array\' THEN e.value ELSE \'[]\' END) WITH ORDINALITY l(path, ord)) a '
+                    'WHERE a.path IS NOT NULL), '
+                    'stale AS (DELETE FROM outfile o WHERE o.sim_id = $1 '
+                    'AND o.ftype IN (SELECT e.key FROM jsonb_each($2::jsonb) e) '
+                    'AND (o.ftype, o.idx) NOT IN (SELECT ftype, idx FROM new)) '
+                    'INSERT INTO outfile(sim_id, ftype, idx, path) SELECT $1, ftype, idx, path FROM new '
+                    'ON CONFLICT (sim_id, ftype, idx) DO UPDATE SET path = EXCLUDED.path', ('INT', 'JSONB')),
+    # fout_insert for several sims, each sim must only appear once
+    'fout_insert_many': ('WITH v AS (SELECT v.sim_id, e.key AS ftype, e.value '
+                         'FROM unnest($1::int[], $2::jsonb[]) v(sim_id, files), jsonb_each(v.files) e), '
+                         'new AS (SELECT v.sim_id, v.ftype, a.idx, a.path FROM v, LATERAL '
+                         '(SELECT -1 AS idx, v.value #>> \'{}\' AS path WHERE jsonb_typeof(v.value) <> \'array\' '
+                         'UNION ALL SELECT l.ord - 1, l.path FROM jsonb_array_elements_text(CASE jsonb_typeof(v.value) '
+                         'WHEN \'array\' THEN v.value ELSE \'[]\' END) WITH ORDINALITY l(path, ord)) a '
+                         'WHERE a.path IS NOT NULL), '
+                         'stale AS (DELETE FROM outfile o USING v WHERE o.sim_id = v.sim_id AND o.ftype = v.ftype '
+                         'AND (o.sim_id, o.ftype, o.idx) NOT IN (SELECT sim_id, ftype, idx FROM new)) '
+                         'INSERT INTO outfile(sim_id, ftype, idx, path) SELECT sim_id, ftype, idx, path FROM new '
+                         'ON CONFLICT (sim_id, ftype, idx) DO UPDATE SET path = EXCLUDED.path', ('INT[]', 'JSONB[]')),
+    'fout_verifying': ('SELECT sim.id, param.cmd, f.files FROM sim JOIN param ON param.sim_id = sim.id '
+                       'LEFT JOIN LATERAL (SELECT files FROM fout WHERE fout.sim_id = sim.id) f ON true '
+                       'WHERE sim.stat_id = 7 AND sim.grp = $2 LIMIT $1', ('INT', 'VARCHAR')),
+    # Jobscripts and logs of at most $1 completed sims
+    'outfile_auxfiles': ('SELECT o.sim_id, o.path FROM outfile o WHERE o.ftype IN (\'JSCRIPTS\', \'JLOGS\') '
+                         'AND o.sim_id IN (SELECT DISTINCT a.sim_id FROM outfile a JOIN sim ON sim.id = a.sim_id '
+                         'WHERE a.ftype IN (\'JSCRIPTS\', \'JLOGS\') AND sim.stat_id = 3 AND sim.grp = $2 LIMIT $1)',
+                         ('INT', 'VARCHAR')),
+    'outfile_drop_auxfiles': ('DELETE FROM outfile WHERE sim_id = ANY($1) AND ftype IN (\'JSCRIPTS\', \'JLOGS\')',
+                              ('INT[]', )),
+    # job_info
+    'job_info_jobs': ('SELECT job_id, task_id, executor FROM job_info WHERE sim_id = $1', ('INT', )),
+    # Number of running stages on host $1 that were run locally (see GMXSubmit.use_local)
+    'job_info_local_running': ('SELECT COUNT(DISTINCT job_info.sim_id) FROM job_info JOIN sim ON sim.id = job_info.sim_id '
+                               'WHERE job_info.executor = \'local\' AND job_info.host = $1 AND sim.stat_id IN (1, 2, 6)',
+                               ('VARCHAR', )),
+    'job_info_delete': ('DELETE FROM job_info WHERE sim_id = $1', ('INT', )),
+    'job_info_delete_local': ('DELETE FROM job_info WHERE sim_id = $1 AND job_id = $2 AND executor = \'local\' '
+                              'AND host = $3', ('INT', 'INT', 'VARCHAR')),
+    # Rows already present (e.g. a flush repeated after a lost commit) are skipped
+    'job_info_insert_many': ('INSERT INTO job_info(sim_id, job_id, task_id, executor, host) '
+                             'SELECT * FROM unnest($1::int[], $2::int[], $3::int[], $4::varchar[], $5::varchar[]) '
+                             'ON CONFLICT DO NOTHING', ('INT[]', 'INT[]', 'INT[]', 'VARCHAR[]', 'VARCHAR[]')),
+    'job_info_insert': ('INSERT INTO job_info(sim_id, job_id, task_id, executor, host) VALUES ($1, $2, $3, $4, $5)',
+                        ('INT', 'INT', 'INT', 'VARCHAR', 'VARCHAR')),
+    # job_state (see utils.shared.SchedulerStateCache)
+    'job_state_claim': ('INSERT INTO job_state(job_id, last_polled) VALUES ($1, now()) '
+                        'ON CONFLICT (job_id) DO UPDATE SET last_polled = now() '
+                        'WHERE job_state.last_polled < now() - $2 * interval \'1 second\' RETURNING job_id',
+                        ('VARCHAR', 'REAL')),
+    'job_state_get': ('SELECT state FROM job_state WHERE job_id = $1', ('VARCHAR', )),
+    # started is set the first time a job is found running. Only Slurm reports RUNNING, sge_job_status does not
+    # distinguish waiting from running jobs
+    'job_state_put': ('INSERT INTO job_state(job_id, state, last_polled, started) '
+                      'VALUES ($1, $2, now(), CASE WHEN $2 = \'RUNNING\' THEN now() END) '
+                      'ON CONFLICT (job_id) DO UPDATE SET state = EXCLUDED.state, last_polled = EXCLUDED.last_polled, '
+                      'started = COALESCE(job_state.started, EXCLUDED.started)',
+                      ('VARCHAR', 'VARCHAR')),
+    # walltime (see utils.predict)
+    'walltime_insert': ('INSERT INTO walltime(sim_id, signature, requested, predicted) VALUES ($1, $2, $3, $4) '
+                        'ON CONFLICT (sim_id) DO UPDATE SET signature = EXCLUDED.signature, '
+                        'requested = EXCLUDED.requested, predicted = EXCLUDED.predicted, runtime = NULL',
+                        ('INT', 'VARCHAR', 'REAL', 'REAL')),
+    'walltime_history': ('SELECT runtime FROM walltime WHERE signature = $1 AND runtime IS NOT NULL '
+                         'ORDER BY sim_id DESC LIMIT $2', ('VARCHAR', 'INT')),
+    # The runtime starts when the job was first found running and ends when the job was found finished.
+    # Stages whose start is unknown (always on SGE and for local jobs, see job_state_put) are skipped, the time
+    # since submission would include the queue time. Resubmitted stages are skipped as well, only their last run
+    # is known
+    'walltime_record': ('UPDATE walltime SET runtime = EXTRACT(EPOCH FROM fin.t_end - fin.t_start) / 3600 '
+                        'FROM (SELECT w.sim_id, '
+                        '(SELECT MAX(t) FROM sim_transition WHERE sim_id = w.sim_id AND old_stat = 2) AS t_end, '
+                        '(SELECT MIN(job_state.started) FROM job_info JOIN job_state ON job_state.job_id = '
+                        'CASE WHEN job_info.task_id < 0 THEN job_info.job_id::text '
+                        'ELSE job_info.job_id || \'_\' || job_info.task_id END '
+                        'WHERE job_info.sim_id = w.sim_id) AS t_start '
+                        'FROM walltime w JOIN sim ON sim.id = w.sim_id '
+                        'WHERE w.sim_id = ANY($1) AND sim.resubmits = 0) fin '
+                        'WHERE walltime.sim_id = fin.sim_id AND fin.t_end IS NOT NULL AND fin.t_start IS NOT NULL',
+                        ('INT[]', )),
+    # grompp_cache (see utils.memo.GromppCache)
+    'grompp_cache_get': ('UPDATE grompp_cache SET last_used = now() WHERE key = $1 RETURNING files', ('VARCHAR', )),
+    'grompp_cache_put': ('INSERT INTO grompp_cache(key, sim_id, files, created, last_used) '
+                         'VALUES ($1, $2, $3, now(), now()) ON CONFLICT (key) DO NOTHING', ('VARCHAR', 'INT', 'JSONB')),
+    'grompp_cache_delete': ('DELETE FROM grompp_cache WHERE key = $1', ('VARCHAR', )),
+    'grompp_cache_evict': ('DELETE FROM grompp_cache WHERE key IN '
+                           '(SELECT key FROM grompp_cache ORDER BY last_used DESC OFFSET $1)', ('INT', )),
+    # worker
+    'worker_register': ('INSERT INTO worker(host, pid, active, heartbeat, lease_until, weight, free, grp) '
+                        'VALUES ($1, $2, true, now(), now() + $3 * interval \'1 second\', $4, 0, $5) RETURNING id',
+                        ('VARCHAR', 'INT', 'REAL', 'SMALLINT', 'VARCHAR')),
+    'worker_heartbeat': ('UPDATE worker SET heartbeat = now(), lease_until = now() + $2 * interval \'1 second\', '
+                         'free = $3 WHERE id = $1', ('INT', 'REAL', 'INT')),
+    # Number of sims of group $2 claimable from host $1 and the total weighted free capacity of all live daemons
+    # of the group
+    'worker_share': ('SELECT (SELECT COUNT(*) FROM sim WHERE (sim.stat_id IN (1, 2, 4) OR sim.stat_id = 6 '
+                     'AND sim.worker_id IS NOT NULL) AND sim.grp = $2 AND NOT EXISTS '
+                     '(SELECT 1 FROM worker WHERE worker.id = sim.worker_id AND worker.active '
+                     'AND worker.lease_until > now()) AND NOT EXISTS (SELECT 1 FROM job_info '
+                     'WHERE job_info.sim_id = sim.id AND job_info.executor = \'local\' AND job_info.host <> $1)), '
+                     '(SELECT COALESCE(SUM(weight * free), 0) FROM worker WHERE active AND grp = $2 '
+                     'AND lease_until > now())', ('VARCHAR', 'VARCHAR')),
+    'worker_deregister': ('UPDATE worker SET active = false, lease_until = now() WHERE id = $1', ('INT', )),
+    # sim_counts (see utils.report)
+    'counts_status': ('SELECT lookup.stat_name, SUM(c.n) FROM sim_counts c '
+                      'JOIN sim_status_lookup lookup ON lookup.id = c.stat_id '
+                      'GROUP BY lookup.id, lookup.stat_name HAVING SUM(c.n) > 0 ORDER BY lookup.id', ()),
+    'counts_cmd': ('SELECT cmd, SUM(n) FROM sim_counts GROUP BY cmd HAVING SUM(n) > 0 ORDER BY cmd', ()),
+    'counts_base': ('SELECT path, SUM(n) FROM sim_counts GROUP BY path HAVING SUM(n) > 0 ORDER BY path', ()),
+    # sched_budget (see utils.shared.QueryBudget)
+    'budget_create': ('INSERT INTO sched_budget(name, rate, capacity, tokens, updated, exhausted) '
+                      'VALUES ($1, $2, $3, $3, now(), 0) ON CONFLICT (name) DO NOTHING',
+                      ('VARCHAR', 'REAL', 'REAL')),
+    # Returns (true, 0) if a token was taken, otherwise (false, seconds until the next token is available)
+    'budget_take': ('WITH take AS (UPDATE sched_budget '
+                    'SET tokens = LEAST(capacity, tokens + rate * EXTRACT(EPOCH FROM now() - updated)) - 1, '
+                    'updated = now() '
+                    'WHERE name = $1 AND LEAST(capacity, tokens + rate * EXTRACT(EPOCH FROM now() - updated)) >= 1 '
+                    'RETURNING tokens) '
+                    'SELECT true, 0::float8 FROM take UNION ALL '
+                    'SELECT false, ((1 - LEAST(capacity, tokens + rate * EXTRACT(EPOCH FROM now() - updated))) / rate)'
+                    '::float8 FROM sched_budget WHERE name = $1 AND NOT EXISTS (SELECT 1 FROM take)', ('VARCHAR', )),
+    'budget_exhaust': ('UPDATE sched_budget SET exhausted = exhausted + 1 WHERE name = $1', ('VARCHAR', )),
+    # Tokens available now, capacity and how often the budget was exhausted (see utils.report)
+    'budget_status': ('SELECT name, LEAST(capacity, tokens + rate * EXTRACT(EPOCH FROM now() - updated))::float8, '
+                      'capacity::float8, exhausted FROM sched_budget ORDER BY name', ()),
+}
+
+
+def json_param(obj):
+    """
+    Wrap a python object to be passed as a JSONB parameter
+    :param obj:
+    :return:
+    """
+    return Json(obj)
+
+
+def _client_statement(stmt):
+    """
+    Translate $<n> placeholders to the psycopg2 format
+    :param stmt:
+    :return:
+    """
+    return re.sub(r'\$(\d+)', r'%(p\1)s', stmt.replace('%', '%%'))
+
+
+def execute_query(conn, name, params=(), fetch=True, commit=False, prepared=None):
+    """
+    Execute a named statement from QUERIES and return output
+    :param conn:
+    :param name: The name of the statement
+    :param params: A tuple of parameters, one for each placeholder
+    :param fetch: Fetch results (default yes)
+    :param commit: Commit after executing command
+    :param prepared: A set with the names of all statements prepared on conn.
+                     If given, the statement is prepared (once) and executed by name
+    :return:
+    """
+    stmt, types = QUERIES[name]
+    if len(params) != len(types):
+        raise ValueError(f'{name} expects {len(types)} parameters but got {len(params)}')
+
+    with conn.cursor() as cursor:
+        try:
+            if prepared is not None:
+                if name not in prepared:
+                    type_str = f'({", ".join(types)})' if len(types) else ''
+                    cursor.execute(f'PREPARE {name}{type_str} AS {stmt}')
+                    prepared.add(name)
+                if len(params):
+                    cursor.execute(f'EXECUTE {name}({", ".join(["%s"] * len(params))})', params)
+                else:
+                    cursor.execute(f'EXECUTE {name}')
+            else:
+                cursor.execute(_client_statement(stmt), {f'p{i + 1}': p for i, p in enumerate(params)})
+        except Exception as e:
+            raise RuntimeError(f'Failed to run query: {name}\n', e)
+        if commit:
+            conn.commit()
+        if fetch:
+            return cursor.fetchall()
+        else:
+            return
@@ -0,0 +1,86 @@
+from utils.db import execute_cmd
+from utils.queries import execute_query
+
+_description = """
+Summary of all simulations in the database (gmxdb status) and timing statistics (gmxdb stats).
+
+Counts are read from the sim_counts table, which is maintained by triggers (see bin/create_db.py).
+The summary also shows the scheduler query budgets and how often daemons found them exhausted (see utils.shared).
+The cost of a summary depends on the number of distinct status, command and base directory combinations,
+not on the number of simulations, so it can be refreshed every second.
+
+Timing statistics are computed from the sim_transition history within a time window.
+The time spent in a status is the time until the next transition of the same simulation.
+"""
+
+
+def status_summary(conn, prepared=None):
+    """
+    Count simulations per status, command and base directory and find the oldest waiting simulation
+    :param conn:
+    :param prepared: A set with the names of all statements prepared on conn (see utils.queries.execute_query)
+    :return: A dictionary {"status": {name: n}, "cmd": {cmd: n}, "base": {path: n}, "oldest_waiting": row or None,
+             "budget": {name: (tokens, capacity, exhausted)}} the oldest waiting row is (sim_id, stat_id, created)
+    """
+    summary = {}
+    for key, name in (('status', 'counts_status'), ('cmd', 'counts_cmd'), ('base', 'counts_base')):
+        rows = execute_query(conn, name, fetch=True, commit=True, prepared=prepared)
+        summary[key] = {k: int(n) for k, n in rows}
+    out = execute_query(conn, 'sim_oldest_waiting', fetch=True, commit=True, prepared=prepared)
+    summary['oldest_waiting'] = out[0] if len(out) else None
+    rows = execute_query(conn, 'budget_status', fetch=True, commit=True, prepared=prepared)
+    summary['budget'] = {name: (tokens, capacity, int(exhausted)) for name, tokens, capacity, exhausted in rows}
+    return summary
+
+
+# Columns statistics can be grouped by
+GROUP_BY = {'cmd': 'param.cmd', 'base': 'param.path'}
+
+# Percentiles reported by gmxdb stats
+PERCENTILES = (0.5, 0.9, 0.99)
+
+_TRANSITIONS = 'SELECT sim_id, new_stat, t, LEAD(t) OVER (PARTITION BY sim_id ORDER BY id) AS t_next ' \
+               'FROM sim_transition WHERE t >= now() - %s * interval \'1 day\''
+
+
+def transition_stats(conn, by='cmd', days=7.):
+    """
+    Percentiles of the time simulations spent in each status, e.g. the time from depend to submitted
+    :param conn:
+    :param by: Group by command (cmd) or base directory (base)
+    :param days: Only use transitions of the last days
+    :return: A list of (key, status, n, percentiles in seconds)
+    """
+    cmd = f'SELECT {GROUP_BY[by]}, lookup.stat_name, COUNT(*), ' \
+          f'percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM tr.t_next - tr.t)) ' \
+          f'FROM ({_TRANSITIONS}) tr ' \
+          f'JOIN param ON param.sim_id = tr.sim_id ' \
+          f'JOIN sim_status_lookup lookup ON lookup.id = tr.new_stat ' \
+          f'WHERE tr.t_next IS NOT NULL ' \
+          f'GROUP BY {GROUP_BY[by]}, lookup.id, lookup.stat_name ORDER BY {GROUP_BY[by]}, lookup.id;'
+    return execute_cmd(conn, cmd, fetch=True, commit=True, params=[list(PERCENTILES), days])
+
+
+def runtime_stats(conn, by='cmd', days=7.):
+    """
+    Percentiles of queue time, run time and turnaround of running simulations (stat_id 2)
+    Queue and run time require the time a job was first found running, which is only known for Slurm jobs
+    (see job_state), the turnaround is the time from submission until the job finished
+    :param conn:
+    :param by: Group by command (cmd) or base directory (base)
+    :param days: Only use transitions of the last days
+    :return: A list of (key, n, queue time, run time, turnaround) with percentiles in seconds
+    """
+    pct = 'percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM {}))'
+    cmd = f'SELECT {GROUP_BY[by]}, COUNT(*), ' \
+          f'{pct.format("started.t - tr.t")}, {pct.format("tr.t_next - started.t")}, ' \
+          f'{pct.format("tr.t_next - tr.t")} ' \
+          f'FROM ({_TRANSITIONS}) tr ' \
+          f'JOIN param ON param.sim_id = tr.sim_id ' \
+          f'LEFT JOIN LATERAL (SELECT MIN(job_state.started) AS t FROM job_info JOIN job_state ' \
+          f'ON job_state.job_id = CASE WHEN job_info.task_id < 0 THEN job_info.job_id::text ' \
+          f'ELSE job_info.job_id || \'_\' || job_info.task_id END ' \
+          f'WHERE job_info.sim_id = tr.sim_id) started ON true ' \
+          f'WHERE tr.new_stat = 2 AND tr.t_next IS NOT NULL ' \
+          f'GROUP BY {GROUP_BY[by]} ORDER BY {GROUP_BY[by]};'
+    return execute_cmd(conn, cmd, fetch=True, commit=True, params=[list(PERCENTILES)] * 3 + [days])
@@ -0,0 +1,134 @@
+import time
+import random
+from multiprocessing import Lock, RawValue
+
+_description = """
+Retry policies and circuit breakers for the database and the scheduler.
+
+Failed calls are retried with exponential backoff and full jitter, so workers that failed at the same time
+do not retry in lockstep. A circuit breaker opens after a number of consecutive failures. While it is open callers
+fail fast instead of adding load to the failing service. Once reset_timeout passed a single caller is allowed to
+probe the service, the breaker closes if the probe succeeds.
+
+The breakers below are created on import and live in shared memory, thus all processes forked afterwards
+(e.g. all workers of a daemon) share their state.
+"""
+
+
+class CircuitOpen(RuntimeError):
+    """
+    Raised instead of calling a service while its circuit breaker is open
+    """
+    pass
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter
+    """
+    def __init__(self, base=1., factor=2., max_delay=60.):
+        """
+
+        :param base: Upper bound of the first delay in seconds
+        :param factor: The upper bound grows by this factor with every attempt
+        :param max_delay: Maximum delay in seconds
+        """
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """
+        Get the delay before retrying, drawn uniformly between 0 and the upper bound of the attempt
+        :param attempt: Number of failed attempts so far, starting at 0
+        :return:
+        """
+        return random.uniform(0, min(self.max_delay, self.base * self.factor ** attempt))
+
+    def sleep(self, attempt):
+        """
+        Sleep before retrying
+        :param attempt: Number of failed attempts so far, starting at 0
+        :return:
+        """
+        time.sleep(self.delay(attempt))
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker shared between processes
+
+    closed: all calls are allowed, consecutive failures are counted
+    open: no calls are allowed for reset_timeout seconds after the last failure
+    half open: a single probe is allowed per reset_timeout, a success closes and a failure reopens the breaker
+    """
+    def __init__(self, name, threshold=5, reset_timeout=30.):
+        """
+
+        :param name: Name of the service
+        :param threshold: Number of consecutive failures that open the breaker
+        :param reset_timeout: Time in seconds before a probe is allowed
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = Lock()
+        self._failures = RawValue('i', 0)
+        # Time the breaker opened, 0 if closed
+        self._opened = RawValue('d', 0.)
+        # Time the last probe was allowed
+        self._probe = RawValue('d', 0.)
+
+    @property
+    def is_open(self):
+        """
+        True if the breaker is open or half open
+        :return:
+        """
+        return self._opened.value > 0
+
+    def allow(self):
+        """
+        Check if a call is allowed, while the breaker is half open only one caller per reset_timeout is allowed
+        :return:
+        """
+        with self._lock:
+            if self._opened.value == 0:
+                return True
+            t = time.time()
+            if t - self._opened.value < self.reset_timeout or t - self._probe.value < self.reset_timeout:
+                return False
+            self._probe.value = t
+            return True
+
+    def check(self):
+        """
+        Raise CircuitOpen if a call is not allowed
+        :return:
+        """
+        if not self.allow():
+            raise CircuitOpen(f'Circuit breaker for {self.name} is open')
+
+    def success(self):
+        """
+        Record a successful call, closes the breaker
+        :return:
+        """
+        with self._lock:
+            self._failures.value = 0
+            self._opened.value = 0.
+            self._probe.value = 0.
+
+    def failure(self):
+        """
+        Record a failed call, opens the breaker after threshold consecutive failures or if a probe failed
+        :return:
+        """
+        with self._lock:
+            self._failures.value += 1
+            if self._failures.value >= self.threshold or self._opened.value > 0:
+                self._opened.value = time.time()
+
+
+DB_BREAKER = CircuitBreaker('database')
+SCHEDULER_BREAKER = CircuitBreaker('scheduler')
@@ -0,0 +1,75 @@
+import os
+import json
+
+from utils.db import execute_cmd
+
+_description = """
+Search simulations by status, command, arguments, base directory and output files.
+
+All filters are answered from indexes (see bin/create_db.py):
+    arguments     GIN index on param.args (containment, @>)
+    output files  btree index on outfile.path
+    base          btree index on param.path (prefix match)
+"""
+
+
+def _arg_values(value):
+    """
+    Arguments are stored with their json type (e.g. "-days": 0), a value given on the commandline can match
+    either the parsed json value or the string
+    :param value:
+    :return:
+    """
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return [value]
+    if parsed == value:
+        return [value]
+    return [parsed, value]
+
+
+def find_sims(conn, status=None, cmd=None, args=None, outputs=None, base=None, group=None, limit=100):
+    """
+    Find simulations matching all filters, the most recent simulations are returned first
+    :param conn:
+    :param status: A list of status names (e.g. running)
+    :param cmd: A list of commands (e.g. g_submit)
+    :param args: A dictionary of argument values, e.g. {"-deffnm": "axel_rep1"}
+    :param outputs: A list of output files, a simulation matches if it produced any of them
+    :param base: Base directory, matches all simulations in or below the directory
+    :param group: A group name
+    :param limit: Maximum number of simulations returned
+    :return: A list of (sim_id, status, cmd, base, args)
+    """
+    where = []
+    params = []
+    if status:
+        where.append('lookup.stat_name = ANY(%s)')
+        params.append(list(status))
+    if group is not None:
+        where.append('sim.grp = %s')
+        params.append(group)
+    if cmd:
+        where.append('param.cmd = ANY(%s)')
+        params.append(list(cmd))
+    for kw, value in (args or {}).items():
+        where.append('(' + ' OR '.join(['param.args @> %s::jsonb'] * len(_arg_values(value))) + ')')
+        params.extend([json.dumps({kw: v}) for v in _arg_values(value)])
+    if outputs:
+        where.append('sim.id IN (SELECT outfile.sim_id FROM outfile WHERE outfile.path = ANY(%s))')
+        params.append([os.path.abspath(fn) for fn in outputs])
+    if base is not None:
+        base = os.path.abspath(base)
+        where.append('(param.path = %s OR param.path LIKE %s)')
+        escaped = base.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.extend([base, f'{escaped}/%'])
+
+    cmd = 'SELECT sim.id, lookup.stat_name, param.cmd, param.path, param.args FROM sim ' \
+          'JOIN param ON param.sim_id = sim.id ' \
+          'JOIN sim_status_lookup lookup ON lookup.id = sim.stat_id'
+    if len(where):
+        cmd = f'{cmd} WHERE {" AND ".join(where)}'
+    cmd = f'{cmd} ORDER BY sim.id DESC LIMIT %s;'
+    params.append(limit)
+    return execute_cmd(conn, cmd, fetch=True, commit=True, params=params)
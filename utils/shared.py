@@ -0,0 +1,150 @@
+import time
+
+from utils.retry import RetryPolicy
+
+_description = """
+State shared between gmxdb daemons through the database.
+
+Several daemons can run against the same database on the same cluster.
+Anything that is expensive to compute and identical for all of them (e.g. the scheduler state of a job)
+is stored in the database so that only one daemon has to do the work.
+"""
+
+
+class SchedulerStateCache(object):
+    """
+    Cache the raw scheduler state of jobs in the job_state table
+
+    The daemon that finds a stale (or missing) entry claims the refresh by advancing last_polled,
+    all other daemons keep reading the cached state until the claiming daemon stores a new one.
+    Thus every job is queried at most once per max_age seconds, independent of the number of daemons.
+    """
+    # Returned by get while another daemon runs the first query of a job
+    PENDING = 'PENDING_QUERY'
+    def __init__(self, db_exec, max_age=30):
+        """
+
+        :param db_exec: A function executing a query on the database (see DatabaseWorker.db_exec)
+        :param max_age: Time in seconds a cached state is considered fresh
+        """
+        self.db_exec = db_exec
+        self.max_age = max_age
+
+    def get(self, job_id):
+        """
+        Get the cached state of a job.
+        Returns None if the cache is stale, in that case the caller is responsible for querying the scheduler
+        and storing the result with put.
+        Returns PENDING if another daemon claimed the first query of the job but has not stored the result yet,
+        the caller should not query the scheduler itself.
+        :param job_id:
+        :return:
+        """
+        # Try to claim the refresh, this only returns a row if the entry was created or is stale
+        out = self.db_exec('job_state_claim', (str(job_id), self.max_age), fetch=True, commit=True)
+        if out is None or len(out):
+            return
+
+        out = self.db_exec('job_state_get', (str(job_id), ), fetch=True, commit=False)
+        if out is None or len(out) == 0:
+            return
+        # The state is NULL if another daemon claimed the first query but has not stored the result yet
+        if out[0][0] is None:
+            return self.PENDING
+        return out[0][0]
+
+    def put(self, job_id, state):
+        """
+        Store the scheduler state of a job
+        :param job_id: A job id or the id of an array task (<job_id>_<task_id>)
+        :param state: The raw scheduler state (e.g. RUNNING)
+        :return:
+        """
+        self.db_exec('job_state_put', (str(job_id), state), fetch=False, commit=True)
+
+    def peek(self, job_id):
+        """
+        Get the cached state of a job independent of its age
+        :param job_id:
+        :return:
+        """
+        out = self.db_exec('job_state_get', (str(job_id), ), fetch=True, commit=False)
+        if out is None or len(out) == 0:
+            return
+        return out[0][0]
+
+
+class QueryBudget(object):
+    """
+    A token bucket limiting the number of scheduler queries across all workers and daemons
+
+    The bucket is stored in the sched_budget table and refilled lazily whenever a token is taken,
+    so no process has to run in the background. Rate and capacity are set by the first daemon creating the bucket.
+    A caller without a token sleeps until the next token is due plus a jitter that grows with every failed attempt,
+    so waiting callers do not update the bucket in lockstep.
+    Every caller that gives up waiting for a token increments the exhausted counter of the bucket.
+    """
+    def __init__(self, db_exec, name='scheduler', rate=5., capacity=50, timeout=10.):
+        """
+
+        :param db_exec: A function executing a query on the database (see DatabaseWorker.db_exec)
+        :param name: Name of the bucket
+        :param rate: Tokens added per second
+        :param capacity: Maximum number of tokens in the bucket
+        :param timeout: Maximum time in seconds to wait for a token
+        """
+        self.db_exec = db_exec
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.timeout = timeout
+        # Number of times this process did not get a token
+        self.exhausted = 0
+        self._exists = False
+
+    def create(self):
+        """
+        Create the bucket if it does not exist yet, a new bucket is full
+        :return:
+        """
+        self.db_exec('budget_create', (self.name, self.rate, self.capacity), fetch=False, commit=True)
+        self._exists = True
+
+    def take(self):
+        """
+        Try to take a single token
+        :return: (True if a token was taken, seconds until the next token is available or None if unknown)
+        """
+        if not self._exists:
+            self.create()
+        out = self.db_exec('budget_take', (self.name, ), fetch=True, commit=True)
+        if out is None or len(out) == 0:
+            return False, None
+        return out[0]
+
+    def exhaust(self):
+        """
+        Record that a caller gave up waiting for a token
+        :return:
+        """
+        self.db_exec('budget_exhaust', (self.name, ), fetch=False, commit=True)
+        self.exhausted += 1
+
+    def acquire(self):
+        """
+        Wait until a token is available or the timeout is reached
+        :return: True if a token was taken
+        """
+        t = time.time()
+        policy = RetryPolicy(base=1. / self.rate, max_delay=self.timeout)
+        attempt = 0
+        while 1:
+            taken, wait = self.take()
+            if taken:
+                return True
+            remaining = self.timeout - (time.time() - t)
+            if remaining <= 0:
+                self.exhaust()
+                return False
+            time.sleep(min(remaining, (wait or 0.) + policy.delay(attempt)))
+            attempt += 1
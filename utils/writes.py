@@ -0,0 +1,136 @@
+import time
+
+from utils.queries import json_param
+
+_description = """
+Write-behind buffer for status changes and output records of workers.
+
+Workers of DatabaseWorkerMain do not commit status changes (sim_set_stat_id, sims_set_stat_id), outfiles
+(fout_insert) and jobs (job_info_insert) themselves, except for submissions (see below). They put the record on the
+queue they use to signal their exit (see DatabaseWorker.db_write). The main worker collects the records in a
+WriteBuffer and flushes them in a single transaction of multi-row statements once max_records are pending or the
+oldest record is max_age seconds old.
+
+Durability:
+    A worker puts its records on the queue before its exit signal, and the main worker flushes all pending records
+    before it claims and dispatches sims. Thus a sim is never dispatched based on a status that is still buffered.
+    A record is durable once the flush transaction committed. Until then it can be lost:
+    - If the daemon crashes, the records in the buffer (at most max_age seconds or max_records) and all records
+      still in the queue are lost.
+    - multiprocessing.Queue.put hands a record to a feeder thread of the worker, which writes it to the pipe of the
+      queue. A worker that returns from run, also after an exception, waits for its feeder thread. A worker that is
+      killed (e.g. SIGKILL, the OOM killer or Process.terminate) loses the records its feeder thread did not write yet,
+      and a worker killed while writing to the pipe can corrupt the queue for all workers. DatabaseWorkerMain thus asks
+      Monitors of lost sims to stop and only terminates them as a last resort (see DatabaseWorkerMain.stop_monitors).
+    A lost record was never applied, i.e. the sims keep their previous status and are handled again by this or another
+    daemon.
+    Submissions are not buffered: a stage is flagged as being submitted by its owner before it is submitted, and its
+    status, jobs and outfiles are committed right away afterwards, only if the daemon still owns the stage
+    (see GMXSubmit.begin_submit). A stage is only submitted a second time if the daemon crashes between submitting
+    and committing.
+    A flush that fails because the database is not reachable is kept and retried. If the database rejects the batch,
+    the records are retried one by one and records that still fail are logged and dropped.
+"""
+
+# Records accepted by the buffer (name of the single row statement in utils.queries)
+BUFFERED = ('sim_set_stat_id', 'sims_set_stat_id', 'fout_insert', 'job_info_insert')
+
+
+def batch_statements(records):
+    """
+    Combine records into multi-row statements, executed in the returned order within one transaction
+    Outfiles of the same sim are merged and status changes of the same sim are applied in the order they were made
+    :param records: A list of (name, params) of single row statements
+    :return: A list of (name, params) of multi-row statements
+    """
+    jobs = []
+    outfiles = {}
+    # Every round holds at most one status change per sim, later changes go into later rounds
+    rounds = []
+    for name, params in records:
+        if name == 'job_info_insert':
+            jobs.append(params)
+        elif name == 'fout_insert':
+            sim_id, files = params
+            outfiles.setdefault(sim_id, {}).update(getattr(files, 'adapted', files))
+        else:
+            if name == 'sim_set_stat_id':
+                changes = [(params[0], params[1], None)]
+            else:
+                changes = [(sim_id, params[1], params[2]) for sim_id in params[0]]
+            for change in changes:
+                for status in rounds:
+                    if change[0] not in status:
+                        status[change[0]] = change
+                        break
+                else:
+                    rounds.append({change[0]: change})
+
+    statements = []
+    if len(jobs):
+        statements.append(('job_info_insert_many', tuple([list(column) for column in zip(*jobs)])))
+    if len(outfiles):
+        statements.append(('fout_insert_many', (list(outfiles.keys()),
+                                                [json_param(files) for files in outfiles.values()])))
+    for status in rounds:
+        statements.append(('sims_set_stat_ids', tuple([list(column) for column in zip(*status.values())])))
+    return statements
+
+
+class WriteBuffer(object):
+    """
+    Records waiting to be flushed, in the order they were received
+    """
+    def __init__(self, max_records=500, max_age=0.2):
+        """
+
+        :param max_records: Flush once this many records are pending
+        :param max_age: Flush once the oldest pending record is this many seconds old
+        """
+        self.max_records = max_records
+        self.max_age = max_age
+        self.records = []
+        self._t_oldest = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, name, params):
+        """
+        Add a record
+        :param name: One of BUFFERED
+        :param params: The parameters of the single row statement
+        :return:
+        """
+        if name not in BUFFERED:
+            raise ValueError(f'{name} can not be buffered')
+        if len(self.records) == 0:
+            self._t_oldest = time.time()
+        self.records.append((name, params))
+
+    def due(self):
+        """
+        Check if the buffer should be flushed
+        :return:
+        """
+        if len(self.records) == 0:
+            return False
+        return len(self.records) >= self.max_records or time.time() - self._t_oldest >= self.max_age
+
+    def take(self):
+        """
+        Remove and return all pending records
+        :return: A list of (name, params)
+        """
+        records, self.records = self.records, []
+        return records
+
+    def restore(self, records):
+        """
+        Put records that could not be flushed back in front of the pending records
+        :param records:
+        :return:
+        """
+        if len(records):
+            self.records = records + self.records
+            self._t_oldest = time.time()